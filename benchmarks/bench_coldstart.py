@@ -0,0 +1,65 @@
+"""Measures the time from starting a fresh Python process to the end of the
+first call to reformat(). Each sample is a new interpreter, so this includes
+importing coral and xonsh, loading the parser table, and parsing.
+
+The first sample is taken with an empty coral cache directory, so it includes
+building the parser table. The remaining samples use the warmed cache.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import time
+t0 = time.perf_counter()
+from coral.formatter import reformat
+reformat("x = 42\\n")
+print(time.perf_counter() - t0)
+"""
+
+
+def sample(cache_dir):
+    """Runs one cold process, returning its wall time and the time the child
+    reports from the start of its import of coral.
+    """
+    env = dict(os.environ, CORAL_CACHE_DIR=cache_dir)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    t0 = time.perf_counter()
+    out = subprocess.check_output(
+        [sys.executable, "-c", CHILD], env=env, universal_newlines=True
+    )
+    wall = time.perf_counter() - t0
+    return {"wall": wall, "import_to_reformat": float(out.strip())}
+
+
+def main(args=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("-n", "--repeat", type=int, default=5, help="warm samples")
+    p.add_argument("-o", "--output", default=None, help="JSON results file")
+    ns = p.parse_args(args)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cold = sample(cache_dir)
+        warm = [sample(cache_dir) for _ in range(ns.repeat)]
+    results = {
+        "benchmark": "coldstart",
+        "python": sys.version.split()[0],
+        "empty_cache": cold,
+        "warm_cache": warm,
+        "warm_cache_best_wall": min(s["wall"] for s in warm),
+    }
+    s = json.dumps(results, indent=1)
+    if ns.output is None:
+        print(s)
+    else:
+        with open(ns.output, "w") as f:
+            f.write(s)
+
+
+if __name__ == "__main__":
+    main()
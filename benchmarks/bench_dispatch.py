@@ -0,0 +1,146 @@
+"""Measures the per-node overhead of finding visitor methods, comparing a
+getattr() lookup by name for every node, as ast.NodeVisitor does, against
+the dispatch tables of coral.visitor, on a module of about 50k nodes.
+"""
+import os
+import sys
+import ast
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corpus import make_source
+
+from coral import __version__
+from coral.formatter import Formatter
+from coral.visitor import DispatchVisitor
+
+
+class GetattrHandlers(object):
+    """Stands in for a dispatch table, looking up each handler by name."""
+
+    def __init__(self, cls):
+        self.cls = cls
+
+    def __getitem__(self, node_type):
+        cls = self.cls
+        return getattr(cls, "visit_" + node_type.__name__, cls.generic_visit)
+
+
+class GetattrFormatter(Formatter):
+    """Formatter that looks up its visitor methods for every node."""
+
+    def __init__(self, write=None):
+        super().__init__(write=write)
+        self.handlers = GetattrHandlers(type(self))
+
+
+class Counter(ast.NodeVisitor):
+    """Visits a list of nodes, without recursing into them, counting them."""
+
+    def generic_visit(self, node):
+        self.n += 1
+
+    def visit_Name(self, node):
+        self.n += 1
+
+    def visit_BinOp(self, node):
+        self.n += 1
+
+    def run(self, nodes):
+        self.n = 0
+        visit = self.visit
+        for node in nodes:
+            visit(node)
+        return self.n
+
+
+class TableCounter(DispatchVisitor, Counter):
+    """Counter whose visitor methods are found through a dispatch table."""
+
+
+def make_tree(nnodes):
+    """Returns a module with at least nnodes nodes, and its node count."""
+    nlines = 1000
+    while True:
+        tree = ast.parse(make_source("flat", nlines))
+        n = sum(1 for _ in ast.walk(tree))
+        if n >= nnodes:
+            return tree, n
+        nlines = nlines * nnodes // n + 100
+
+
+def best(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def format_with(cls, tree):
+    formatter = cls()
+    formatter.reset()
+    formatter.emit(tree)
+    return "".join(formatter.chunks)
+
+
+def run(nnodes, repeat, log=sys.stderr):
+    """Runs the benchmarks, returning a list of result dicts."""
+    tree, n = make_tree(nnodes)
+    assert format_with(Formatter, tree) == format_with(GetattrFormatter, tree)
+    nodes = list(ast.walk(tree))
+    cases = [
+        ("visit", "getattr", lambda: Counter().run(nodes)),
+        ("visit", "table", lambda: TableCounter().run(nodes)),
+        ("format", "getattr", lambda: format_with(GetattrFormatter, tree)),
+        ("format", "table", lambda: format_with(Formatter, tree)),
+    ]
+    results = []
+    for bench, dispatch, func in cases:
+        t = best(func, repeat)
+        results.append(
+            {
+                "bench": bench,
+                "dispatch": dispatch,
+                "nodes": n,
+                "best": t,
+                "per_node_ns": t / n * 1e9,
+            }
+        )
+        print(
+            "{0:>8} {1:>8} {2:>7} nodes {3:10.4f} s {4:8.1f} ns/node".format(
+                bench, dispatch, n, t, t / n * 1e9
+            ),
+            file=log,
+        )
+    return results
+
+
+def main(args=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--nodes", type=int, default=50000)
+    p.add_argument("-n", "--repeat", type=int, default=5)
+    p.add_argument("-o", "--output", default=None, help="JSON results file")
+    ns = p.parse_args(args)
+    results = run(ns.nodes, ns.repeat)
+    doc = {
+        "benchmark": "dispatch",
+        "python": sys.version.split()[0],
+        "coral": __version__,
+        "results": results,
+    }
+    s = json.dumps(doc, indent=1)
+    if ns.output is None:
+        print(s)
+    else:
+        with open(ns.output, "w") as f:
+            f.write(s)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""Measures format() with and without a FormatMemo of rendered expressions,
+on a repetitive corpus of generated fixtures and on corpora with little
+repetition, reporting the hit rate of the memo and the speedup.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corpus import KINDS, make_source
+
+from coral import __version__
+from coral.formatter import FormatMemo, format
+from coral.parser import parse, add_comments
+
+DEFAULT_KINDS = ("fixtures", "flat", "nested")
+
+
+def best(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def run(kinds, nlines, repeat, maxsize, log=sys.stderr):
+    """Runs the benchmarks, returning a list of result dicts."""
+    results = []
+    for kind in kinds:
+        source = make_source(kind, nlines)
+        tree, comments, lines = parse(source, lang="python")
+        tree = add_comments(tree, comments, lines)
+        memo = FormatMemo(maxsize=maxsize)
+        assert format(tree, memo=memo, source=source) == format(tree)
+        plain = best(lambda: format(tree), repeat)
+        # a fresh memo for each run, so that the first occurrence of each
+        # expression is a miss, as it would be for a single file
+        memo = None
+
+        def memoized():
+            nonlocal memo
+            memo = FormatMemo(maxsize=maxsize)
+            format(tree, memo=memo, source=source)
+
+        t = best(memoized, repeat)
+        result = {
+            "kind": kind,
+            "lines": source.count("\n"),
+            "bytes": len(source),
+            "plain": plain,
+            "memo": t,
+            "speedup": plain / t,
+        }
+        result.update(memo.as_dict())
+        results.append(result)
+        print(
+            "{0:>8} {1:>7} lines {2:10.4f} s {3:10.4f} s memo {4:6.2f}x "
+            "hit rate {5:6.1%}".format(
+                kind, nlines, plain, t, plain / t, memo.hit_rate
+            ),
+            file=log,
+        )
+    return results
+
+
+def main(args=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--kinds", nargs="+", choices=KINDS, default=DEFAULT_KINDS)
+    p.add_argument("--lines", type=int, default=10000)
+    p.add_argument("--maxsize", type=int, default=4096)
+    p.add_argument("-n", "--repeat", type=int, default=5)
+    p.add_argument("-o", "--output", default=None, help="JSON results file")
+    ns = p.parse_args(args)
+    results = run(ns.kinds, ns.lines, ns.repeat, ns.maxsize)
+    doc = {
+        "benchmark": "memo",
+        "python": sys.version.split()[0],
+        "coral": __version__,
+        "results": results,
+    }
+    s = json.dumps(doc, indent=1)
+    if ns.output is None:
+        print(s)
+    else:
+        with open(ns.output, "w") as f:
+            f.write(s)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
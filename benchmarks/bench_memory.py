@@ -0,0 +1,166 @@
+"""Measures the peak memory, with tracemalloc, of keeping the comments of a
+comment-dense source, per 10k comments. The compact CommentStore of
+coral.parser is compared against a list of dict-backed comment nodes and a
+dict of their lines, which is how comments used to be kept. The peak of
+parse(), reformat() and reformat_stream() on the same source is reported as
+well.
+"""
+import io
+import os
+import sys
+import ast
+import gc
+import json
+import argparse
+import tokenize
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corpus import make_source
+
+from coral import __version__
+from coral.formatter import reformat, reformat_stream
+from coral.parser import LANGS, parse, python_comments
+
+
+class DictComment(ast.AST):
+    """Comment node with an instance dict, as coral used to have."""
+
+    _attributes = ("lineno", "col_offset")
+    _fields = ("s",)
+
+
+def tokens(source):
+    """Yields the tokens of a source, without keeping them all in memory."""
+    return tokenize.generate_tokens(io.StringIO(source).readline)
+
+
+def dict_comments(source):
+    """Collects comments into a list of nodes and a dict of lines."""
+    comments = []
+    lines = {}
+    for token in tokens(source):
+        if token.type == tokenize.COMMENT:
+            comment = DictComment(
+                s=token.string, lineno=token.start[0], col_offset=token.start[1]
+            )
+            lines[token.start[0]] = token.line
+            comments.append(comment)
+    return comments, lines
+
+
+def store_comments(source):
+    """Collects comments into a CommentStore."""
+    return python_comments(tokens(source), source=source)
+
+
+def store_nodes(source):
+    """Collects comments into a CommentStore and creates all of their
+    nodes, as the comment adder does.
+    """
+    comments, lines = store_comments(source)
+    return list(comments), lines
+
+
+class NullWriter(object):
+    """Stream that discards what is written to it."""
+
+    def write(self, s):
+        pass
+
+
+def stream_reformat(instream, lang):
+    """Reformats a stream, discarding the output, so that only the memory
+    of formatting is measured.
+    """
+    reformat_stream(instream, NullWriter(), lang=lang)
+
+
+def peak(func, *args):
+    """Returns the result of calling func and the peak memory it allocated
+    while running, in bytes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, top = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, top
+
+
+def make_comments_source(ncomments):
+    """Returns a comment-dense source with at least ncomments comments, and
+    its number of comments.
+    """
+    nlines = ncomments
+    while True:
+        source = make_source("comments", nlines)
+        n = source.count("#")
+        if n >= ncomments:
+            return source, n
+        nlines = nlines * ncomments // n + 100
+
+
+def run(ncomments, lang, log=sys.stderr):
+    """Runs the benchmarks, returning a list of result dicts."""
+    source, n = make_comments_source(ncomments)
+    # load the parser table up front, so it does not count against parse()
+    parse("pass\n", lang=lang)
+    cases = [
+        ("comments", "dict", dict_comments, (source,)),
+        ("comments", "store", store_comments, (source,)),
+        ("nodes", "store", store_nodes, (source,)),
+        ("parse", "store", parse, (source, None, "<code>", "exec", 0, lang)),
+        ("reformat", "store", reformat, (source, 0, None, lang)),
+        ("reformat_stream", "store", stream_reformat, (io.StringIO(source), lang)),
+    ]
+    results = []
+    for bench, kind, func, args in cases:
+        _, top = peak(func, *args)
+        per10k = top * 10000.0 / n
+        results.append(
+            {
+                "bench": bench,
+                "kind": kind,
+                "lang": lang,
+                "comments": n,
+                "peak": top,
+                "peak_per_10k_comments": per10k,
+            }
+        )
+        print(
+            "{0:>15} {1:>6} {2:>7} comments {3:10.1f} KiB per 10k comments".format(
+                bench, kind, n, per10k / 1024.0
+            ),
+            file=log,
+        )
+    return results
+
+
+def main(args=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--comments", type=int, default=10000)
+    p.add_argument("--lang", choices=LANGS, default="auto")
+    p.add_argument("-o", "--output", default=None, help="JSON results file")
+    ns = p.parse_args(args)
+    results = run(ns.comments, ns.lang)
+    doc = {
+        "benchmark": "memory",
+        "python": sys.version.split()[0],
+        "coral": __version__,
+        "results": results,
+    }
+    s = json.dumps(doc, indent=1)
+    if ns.output is None:
+        print(s)
+    else:
+        with open(ns.output, "w") as f:
+            f.write(s)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
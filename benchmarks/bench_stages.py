@@ -0,0 +1,149 @@
+"""Times each stage of coral separately on synthetic corpora: parse(),
+add_comments(), format(), and reformat() end-to-end. Results are written as
+JSON, and may be compared against an earlier results file to catch
+regressions.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corpus import KINDS, make_source
+
+from coral import __version__
+from coral.cache import xonsh_version
+from coral.formatter import format, reformat
+from coral.parser import LANGS, parse, add_comments
+
+STAGES = ("parse", "add_comments", "format", "reformat")
+
+# the xonsh parser re-parses the whole input for every subprocess line it
+# finds, so subprocess-heavy files scale quadratically and get smaller sizes
+DEFAULT_SIZES = {
+    "flat": (1000, 10000),
+    "nested": (1000, 10000),
+    "comments": (1000, 10000),
+    "subproc": (100, 300),
+    "fixtures": (1000, 10000),
+}
+
+
+def time_stages(source, repeat, lang="xonsh"):
+    """Returns a dict mapping stage names to lists of timings, in seconds."""
+    times = {stage: [] for stage in STAGES}
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        tree, comments, lines = parse(source, lang=lang)
+        t1 = time.perf_counter()
+        tree = add_comments(tree, comments, lines)
+        t2 = time.perf_counter()
+        format(tree)
+        t3 = time.perf_counter()
+        reformat(source, lang=lang)
+        t4 = time.perf_counter()
+        times["parse"].append(t1 - t0)
+        times["add_comments"].append(t2 - t1)
+        times["format"].append(t3 - t2)
+        times["reformat"].append(t4 - t3)
+    return times
+
+
+def run(kinds, sizes, repeat, lang="xonsh", log=sys.stderr):
+    """Runs the benchmarks, returning a list of result dicts."""
+    # load the parser table up front, so it does not count against parse()
+    parse("pass\n")
+    results = []
+    for kind in kinds:
+        for nlines in sizes or DEFAULT_SIZES[kind]:
+            source = make_source(kind, nlines)
+            times = time_stages(source, repeat, lang=lang)
+            for stage in STAGES:
+                results.append(
+                    {
+                        "kind": kind,
+                        "lang": lang,
+                        "lines": source.count("\n"),
+                        "bytes": len(source),
+                        "stage": stage,
+                        "best": min(times[stage]),
+                        "mean": sum(times[stage]) / repeat,
+                        "times": times[stage],
+                    }
+                )
+                print(
+                    "{0:>8} {1:>7} lines {2:>12} {3:10.4f} s".format(
+                        kind, nlines, stage, min(times[stage])
+                    ),
+                    file=log,
+                )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of messages about results that are slower than the
+    same benchmark in the baseline by more than the tolerance, as a fraction.
+    """
+    key = lambda r: (r["kind"], r.get("lang", "xonsh"), r["lines"], r["stage"])
+    old = {key(r): r["best"] for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        before = old.get(key(r))
+        if before is None or r["best"] <= before * (1.0 + tolerance):
+            continue
+        msg = "{0} {1} lines {2}: {3:.4f} s -> {4:.4f} s".format(
+            r["kind"], r["lines"], r["stage"], before, r["best"]
+        )
+        regressions.append(msg)
+    return regressions
+
+
+def main(args=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--kinds", nargs="+", choices=KINDS, default=KINDS)
+    p.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        default=None,
+        help="numbers of lines to generate, for all kinds",
+    )
+    p.add_argument("--lang", choices=LANGS, default="xonsh")
+    p.add_argument("-n", "--repeat", type=int, default=3)
+    p.add_argument("-o", "--output", default=None, help="JSON results file")
+    p.add_argument("--compare", default=None, help="baseline JSON results file")
+    p.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown relative to the baseline, as a fraction",
+    )
+    ns = p.parse_args(args)
+    results = run(ns.kinds, ns.sizes, ns.repeat, lang=ns.lang)
+    doc = {
+        "benchmark": "stages",
+        "python": sys.version.split()[0],
+        "coral": __version__,
+        "xonsh": xonsh_version(),
+        "results": results,
+    }
+    s = json.dumps(doc, indent=1)
+    if ns.output is None:
+        print(s)
+    else:
+        with open(ns.output, "w") as f:
+            f.write(s)
+    if ns.compare is None:
+        return 0
+    with open(ns.compare) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, ns.tolerance)
+    for msg in regressions:
+        print("regression: " + msg, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
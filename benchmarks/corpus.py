@@ -0,0 +1,130 @@
+"""Synthetic source generators for coral benchmarks.
+
+Each kind of corpus stresses a different part of coral:
+
+flat
+    Many small top-level statements, functions, and classes.
+nested
+    Blocks nested as deeply as Python allows, repeatedly.
+comments
+    A comment on nearly every line, both on their own lines and inline.
+subproc
+    xonsh subprocess syntax, which the xonsh parser has to retry in
+    subprocess mode.
+fixtures
+    Generated tables of records, which repeat the same sub-expressions
+    over and over.
+"""
+import random
+
+KINDS = ("flat", "nested", "comments", "subproc", "fixtures")
+
+
+def _flat(rng, i):
+    n = rng.randint(0, 9)
+    choice = i % 6
+    if choice == 0:
+        return ["x{0}  =  {1} + {2} * ( y - {0} )".format(i, n, n + 1)]
+    elif choice == 1:
+        return ["items{0} = [ {1}, {2}, 'a' , b'b', None ]".format(i, n, i)]
+    elif choice == 2:
+        return ["table{0} = {{ 'k{0}' :  {1}, 'v' : ( 1, 2 ) }}".format(i, n)]
+    elif choice == 3:
+        return [
+            "def func{0}( a, b = {1}, *args, c = None, **kwargs ) :".format(i, n),
+            "    return  a + b",
+            "",
+        ]
+    elif choice == 4:
+        return [
+            "class Class{0}( object ) :".format(i),
+            "    def method( self, x ) :",
+            "        return [ i * x for i in range( {0} ) if i ]".format(n),
+            "",
+        ]
+    return ["print( 'hello', x{0} if True else {1} )".format(i - 1, n)]
+
+
+def _nested(rng, i):
+    depth = rng.randint(3, 12)
+    lines = []
+    for d in range(depth):
+        indent = "    " * d
+        kind = d % 4
+        if kind == 0:
+            lines.append(indent + "def f{0}_{1}( x ) :".format(i, d))
+        elif kind == 1:
+            lines.append(indent + "for i{0} in range( {0} ) :".format(d))
+        elif kind == 2:
+            lines.append(indent + "if x  >  {0} :".format(d))
+        else:
+            lines.append(indent + "while x :")
+    lines.append("    " * depth + "x  =  x - 1")
+    lines.append("")
+    return lines
+
+
+def _comments(rng, i):
+    n = rng.randint(0, 9)
+    if i % 3 == 0:
+        return ["#comment number {0}".format(i), "x{0} = {1}".format(i, n)]
+    elif i % 3 == 1:
+        return ["y{0}  =  {1}  # inline comment {0}".format(i, n)]
+    return [
+        "def g{0}( ) :  # on the def".format(i),
+        "    # a comment in the body",
+        "    return {0}".format(n),
+        "",
+    ]
+
+
+def _subproc(rng, i):
+    choice = i % 6
+    if choice == 0:
+        return ["ls -l {0}".format(rng.choice(["/tmp", "..", "~"]))]
+    elif choice == 1:
+        return ["echo $HOME @(x{0})".format(i - 1)]
+    elif choice == 2:
+        return ["x{0} = $(git status --short)".format(i)]
+    elif choice == 3:
+        return ["![echo hi | grep h]"]
+    elif choice == 4:
+        return ["$PATH.append( '/opt/bin{0}' )".format(i)]
+    return ["x{0} = !(ls -a)".format(i)]
+
+
+def _fixtures(rng, i):
+    status = rng.choice(["'active'", "'retired'", "None"])
+    return [
+        "RECORD_{0} = {{".format(i),
+        "    'id' : {0},".format(i),
+        "    'status' : {0},".format(status),
+        "    'owner' : {'name' : 'fixture', 'groups' : [ 'admin', 'dev' ]},",
+        "    'limits' : ( 1 << 10, 1 << 20, max( DEFAULT_LIMIT, 64 ) ),",
+        "    'tags' : [ {'key' : 'env', 'value' : 'test'}, "
+        "{'key' : 'tier', 'value' : 'gold'} ],",
+        "}",
+    ]
+
+
+_GENERATORS = {
+    "flat": _flat,
+    "nested": _nested,
+    "comments": _comments,
+    "subproc": _subproc,
+    "fixtures": _fixtures,
+}
+
+
+def make_source(kind, nlines, seed=42):
+    """Returns a source string of the given kind with about nlines lines.
+    The same arguments always produce the same source.
+    """
+    gen = _GENERATORS[kind]
+    rng = random.Random(seed)
+    lines = []
+    i = 0
+    while len(lines) < nlines:
+        lines.extend(gen(rng, i))
+        i += 1
+    return "\n".join(lines) + "\n"
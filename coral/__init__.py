@@ -1,6 +1,3 @@
 """The coral code formatter"""
-from xonsh.main import setup
-setup()
-del setup
 
 __version__ = '0.0.0'
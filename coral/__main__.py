@@ -0,0 +1,6 @@
+"""Allows coral to be run with ``python -m coral``."""
+import sys
+
+from coral.main import main
+
+sys.exit(main())
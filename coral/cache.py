@@ -0,0 +1,286 @@
+"""On-disk caches that let coral skip work on files it has seen before."""
+import os
+import sys
+import time
+import pickle
+import hashlib
+import tempfile
+
+from coral import __version__
+
+
+def cache_dir():
+    """Returns the directory coral stores its caches in. This is
+    $CORAL_CACHE_DIR if set, and a 'coral' directory in the user cache
+    directory otherwise.
+    """
+    d = os.environ.get("CORAL_CACHE_DIR")
+    if d:
+        return d
+    if sys.platform.startswith("win"):
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "coral")
+
+
+def xonsh_version():
+    """Returns the version of xonsh that coral is using."""
+    from xonsh import __version__ as v
+
+    return v
+
+
+def version_key():
+    """Returns a string naming the coral, xonsh, and Python versions, for
+    caches of data that does not carry over between them.
+    """
+    return "coral-{0}-xonsh-{1}-py{2}.{3}".format(
+        __version__, xonsh_version(), *sys.version_info[:2]
+    )
+
+
+def content_hash(s):
+    """Returns a hex digest of the content of a source string."""
+    return hashlib.sha256(s.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class ContentHasher(object):
+    """Computes the content_hash() of a source that is given in pieces."""
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+
+    def update(self, s):
+        self._hash.update(s.encode("utf-8", "surrogatepass"))
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def file_hash(path, blocksize=1 << 20):
+    """Returns the content_hash() of a text file, reading it in blocks."""
+    hasher = ContentHasher()
+    with open(path, "r", encoding="utf-8") as f:
+        block = f.read(blocksize)
+        while block:
+            hasher.update(block)
+            block = f.read(blocksize)
+    return hasher.hexdigest()
+
+
+class Cache(object):
+    """A set of content hashes of sources that are known to already be
+    coral-formatted. Since the output of coral depends on the coral, xonsh,
+    and Python versions, each of them gets its own cache file. The file
+    keeps the time that each hash was last added, and hashes that have not
+    been added for longer than a maximum age are dropped when it is
+    written, so that it does not grow forever.
+    """
+
+    # hashes that are added again are only given a new time, which makes
+    # the file be written, once this many seconds have passed
+    refresh = 24 * 60 * 60
+
+    def __init__(self, filename=None, max_age=30 * 24 * 60 * 60):
+        """Parameters
+        ----------
+        filename : str or None, optional
+            Path to the cache file. If None, a file in cache_dir() named
+            for the current versions is used.
+        max_age : float, optional
+            Number of seconds after which a hash that was not added again is
+            dropped.
+        """
+        if filename is None:
+            basename = "formatted-{0}.txt".format(version_key())
+            filename = os.path.join(cache_dir(), basename)
+        self.filename = filename
+        self.max_age = max_age
+        # maps each hash to the time it was last added
+        self.hashes = self.read()
+        self._added = set()
+
+    def __contains__(self, digest):
+        return digest in self.hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def read(self):
+        """Returns a dict of the hashes currently in the cache file, mapped to
+        the times that they were last added.
+        """
+        hashes = {}
+        try:
+            with open(self.filename, "r") as f:
+                for line in f:
+                    digest, _, t = line.partition(" ")
+                    try:
+                        hashes[digest] = int(t)
+                    except ValueError:
+                        continue
+        except (OSError, UnicodeDecodeError):
+            pass
+        return hashes
+
+    def add(self, digest):
+        """Records that the content with this hash is formatted."""
+        now = int(time.time())
+        if now - self.hashes.get(digest, 0) > self.refresh:
+            self.hashes[digest] = now
+            self._added.add(digest)
+
+    def write(self):
+        """Writes newly added hashes to the cache file, dropping the ones that
+        are too old. Hashes written by other coral processes in the meantime
+        are preserved. Failing to write the cache is not an error.
+        """
+        if not self._added:
+            return
+        hashes = self.read()
+        for digest, t in self.hashes.items():
+            if t > hashes.get(digest, 0):
+                hashes[digest] = t
+        oldest = time.time() - self.max_age
+        hashes = {digest: t for digest, t in hashes.items() if t >= oldest}
+        d = os.path.dirname(self.filename)
+        try:
+            os.makedirs(d, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=d, prefix=".cache-")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                for digest in sorted(hashes):
+                    f.write("{0} {1}\n".format(digest, hashes[digest]))
+            os.replace(tmp, self.filename)
+        except OSError:
+            os.remove(tmp)
+            return
+        self.hashes = hashes
+        self._added.clear()
+
+
+class TreeCache(object):
+    """On-disk cache of parsed trees with their comments, so that tools that
+    parse the same sources again, in the same or in later runs, read them
+    back instead. Entries are keyed by the content hash of the source and
+    how it was parsed, and are pickled, one file per entry, in a directory
+    for the current coral, xonsh, and Python versions. Once the entries
+    take up more than a size limit, the least recently used ones are
+    removed.
+    """
+
+    def __init__(self, directory=None, max_bytes=256 << 20):
+        """Parameters
+        ----------
+        directory : str or None, optional
+            Directory to keep the entries in. If None, a directory in
+            cache_dir() named for the current versions is used.
+        max_bytes : int, optional
+            Size that the entries may take up before some are removed.
+        """
+        if directory is None:
+            directory = os.path.join(cache_dir(), "trees", version_key())
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # total size of the entries, found on first use
+        self._total = None
+
+    def key(self, source, lang="xonsh", mode="exec", ctx=None):
+        """Returns the key of the tree of a source, parsed with the given
+        language, mode, and context, see coral.parser.parse().
+        """
+        names = "" if ctx is None else " ".join(sorted(ctx))
+        return content_hash("\0".join([lang, mode, names, source]))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        """Returns the entry of a key, or None if there is none. Entries
+        that cannot be read are removed.
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        try:
+            # mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Stores an entry, atomically. Failing to store it, for instance
+        because a tree is too deeply nested to be pickled, is not an error.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tree-")
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.replace(tmp, self._path(key))
+        except (OSError, RecursionError, pickle.PicklingError):
+            os.remove(tmp)
+            return
+        if self._total is None:
+            self._total = self.size()
+        else:
+            self._total += size
+        if self._total > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        """Returns the (mtime, size, path) of each entry."""
+        entries = []
+        try:
+            it = os.scandir(self.directory)
+        except OSError:
+            return entries
+        with it:
+            for entry in it:
+                if not entry.name.endswith(".pickle"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def size(self):
+        """Returns the total size of the entries, in bytes."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Removes the least recently used entries until the entries take up
+        at most three quarters of the size limit, so that the cache does
+        not have to be scanned again at every new entry.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_bytes * 3 // 4
+        for _, size, path in entries:
+            if total <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._total = total
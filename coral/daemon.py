@@ -0,0 +1,348 @@
+"""A persistent coral server. The server keeps warmed parsers and a cache of
+results resident, so that editors and hooks do not pay the xonsh startup
+cost on every invocation.
+
+Clients and the server speak newline-delimited JSON over a Unix socket or a
+localhost TCP port. Each request is an object with a "command" key, one of
+"format", "check", "ping", or "stop". The "format" and "check" commands also
+take a "source" string, and optionally the "lang" to parse it as. Each
+response has a "status" key that is either "ok" or "error". Successful format
+and check responses tell whether the source "changed"; format responses also
+hold the formatted "output", which the server has checked to parse to the
+same tree as the source. Error responses carry a "message".
+"""
+import os
+import re
+import sys
+import json
+import signal
+import socket
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from lazyasd import lazyobject
+
+from coral import __version__
+from coral.cache import Cache, cache_dir, content_hash
+
+
+DEFAULT_PORT = 7755
+
+
+@lazyobject
+def re_tcp_address():
+    return re.compile(r"^([\w.\-]+):(\d+)$")
+
+
+def default_address():
+    """Returns the default address of the server. This is a Unix socket in
+    the coral cache directory where supported, and a localhost port otherwise.
+    """
+    if hasattr(socket, "AF_UNIX"):
+        return os.path.join(cache_dir(), "coral-{0}.sock".format(__version__))
+    return "127.0.0.1:{0}".format(DEFAULT_PORT)
+
+
+def parse_address(address):
+    """Converts an address string, either a 'host:port' pair or the path to
+    a Unix socket, to a (socket family, socket address) tuple.
+    """
+    m = re_tcp_address.match(address)
+    if m is not None:
+        return socket.AF_INET, (m.group(1), int(m.group(2)))
+    return socket.AF_UNIX, address
+
+
+class DaemonError(Exception):
+    """Error reported by the coral server."""
+
+
+#
+# Server
+#
+
+
+class FormatService(object):
+    """Formats sources on a pool of threads, each with its own warmed
+    session, and remembers the results. Outputs that differ from their
+    source are checked with coral.formatter.assert_equivalent() before they
+    are returned.
+    """
+
+    def __init__(self, jobs=None, cache=None, maxsize=1024):
+        """Parameters
+        ----------
+        jobs : int or None, optional
+            Number of formatting threads, defaults to the number of CPUs.
+        cache : Cache or None, optional
+            On-disk cache of hashes of formatted sources.
+        maxsize : int, optional
+            Maximum number of formatted outputs that are kept in memory.
+        """
+        self.jobs = jobs or os.cpu_count() or 1
+        self.cache = cache
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self._local = threading.local()
+
+    def session(self):
+        """Returns the session of the current formatting thread. Results are
+        remembered by the service, so the sessions do not keep their own.
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            from coral.session import CoralSession
+
+            session = self._local.session = CoralSession(maxsize=0)
+        return session
+
+    def warm(self):
+        """Creates and exercises the execer of every formatting thread."""
+        barrier = threading.Barrier(self.jobs)
+
+        def warm_thread():
+            try:
+                self.session().reformat("pass\n")
+            finally:
+                # keep this thread busy until every thread has been warmed
+                barrier.wait()
+
+        futures = [self.executor.submit(warm_thread) for _ in range(self.jobs)]
+        for future in futures:
+            future.result()
+
+    def _reformat(self, digest, source, lang):
+        key = (lang, digest)
+        with self.lock:
+            if self.cache is not None and digest in self.cache:
+                # keeps the hash from being dropped as old
+                self.cache.add(digest)
+                return source
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key]
+        session = self.session()
+        output = session.reformat(source, lang=lang)
+        if output != source:
+            # clients write the output without parsing it again
+            session.check_output(source, output, lang=lang)
+        with self.lock:
+            self.results[key] = output
+            if len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+            if self.cache is not None and output == source:
+                self.cache.add(digest)
+        return output
+
+    def reformat(self, source, lang="xonsh"):
+        """Returns the formatted version of a source string."""
+        digest = content_hash(source)
+        future = self.executor.submit(self._reformat, digest, source, lang)
+        return future.result()
+
+    def handle(self, request):
+        """Returns the response to a request dict."""
+        command = request.get("command")
+        if command == "ping" or command == "stop":
+            return {"status": "ok", "version": __version__}
+        elif command not in ("format", "check"):
+            msg = "unknown command {0!r}".format(command)
+            return {"status": "error", "message": msg}
+        source = request.get("source")
+        if not isinstance(source, str):
+            return {"status": "error", "message": "source must be a string"}
+        lang = request.get("lang", "xonsh")
+        try:
+            output = self.reformat(source, lang=lang)
+        except Exception as e:
+            msg = "{0}: {1}".format(e.__class__.__name__, e)
+            return {"status": "error", "message": msg}
+        response = {"status": "ok", "changed": output != source}
+        if command == "format":
+            response["output"] = output
+        return response
+
+    def close(self):
+        """Shuts down the formatting threads and saves the cache."""
+        self.executor.shutdown()
+        if self.cache is not None:
+            self.cache.write()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Handles all of the requests sent on a single connection."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+                if not isinstance(request, dict):
+                    raise ValueError("request is not an object")
+            except ValueError:
+                request = {}
+                response = {"status": "error", "message": "malformed request"}
+            else:
+                response = self.server.service.handle(request)
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+            if request.get("command") == "stop":
+                self.server.shutdown()
+                return
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socket, "AF_UNIX"):
+
+    class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+    except OSError:
+        os.remove(path)
+    else:
+        raise DaemonError("a coral server is already listening on " + path)
+
+
+def make_server(address=None, service=None):
+    """Returns a server bound to an address, which defaults to
+    default_address(). The server is not yet serving.
+    """
+    address = default_address() if address is None else address
+    service = FormatService() if service is None else service
+    family, addr = parse_address(address)
+    if family == socket.AF_INET:
+        server = TCPServer(addr, RequestHandler)
+    else:
+        d = os.path.dirname(addr)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        _remove_stale_socket(addr)
+        server = UnixServer(addr, RequestHandler)
+    server.service = service
+    return server
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(address=None, jobs=None, cache=True):
+    """Runs a coral server until it receives a stop request or is
+    interrupted.
+    """
+    service = FormatService(jobs=jobs, cache=Cache() if cache else None)
+    service.warm()
+    address = default_address() if address is None else address
+    server = make_server(address, service=service)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _raise_interrupt)
+    print("coral server listening on " + address, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+        service.close()
+
+
+#
+# Client
+#
+
+
+class Client(object):
+    """A connection to a coral server."""
+
+    def __init__(self, address=None, timeout=None):
+        address = default_address() if address is None else address
+        family, addr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(addr)
+        except OSError:
+            self.sock.close()
+            raise
+        self.rfile = self.sock.makefile("rb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def request(self, command, **kwargs):
+        """Sends a request to the server, returning the response dict."""
+        kwargs["command"] = command
+        self.sock.sendall(json.dumps(kwargs).encode("utf-8") + b"\n")
+        line = self.rfile.readline()
+        if not line:
+            raise DaemonError("connection closed by the coral server")
+        return json.loads(line.decode("utf-8"))
+
+    def reformat(self, source, lang="xonsh"):
+        """Returns the formatted version of a source string."""
+        response = self.request("format", source=source, lang=lang)
+        if response["status"] != "ok":
+            raise DaemonError(response["message"])
+        return response["output"]
+
+
+#
+# Command line
+#
+
+
+def make_parser():
+    """Returns the argument parser for the coral-d command."""
+    p = argparse.ArgumentParser(prog="coral-d", description="Runs a coral server.")
+    p.add_argument(
+        "--address",
+        default=None,
+        help="Unix socket path or host:port to listen on, defaults to "
+        "a socket in the coral cache directory",
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of formatting threads, defaults to the number of CPUs",
+    )
+    p.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="do not use the on-disk cache of formatted files",
+    )
+    return p
+
+
+def main(args=None):
+    """Main entry point for the coral-d command."""
+    ns = make_parser().parse_args(args)
+    serve(address=ns.address, jobs=ns.jobs, cache=ns.cache)
+    return 0
@@ -1,7 +1,26 @@
 """Formatting tools for xonsh."""
 import ast
-
-from coral.parser import parse, add_comments
+import types
+import bisect
+import builtins
+import itertools
+import functools
+from collections import OrderedDict
+
+from coral.parser import (
+    LineIndex,
+    ModuleNames,
+    parse,
+    add_comments,
+    module_names,
+    top_level_chunks,
+    top_level_starts,
+    _statement_start,
+)
+from coral.visitor import DispatchVisitor
+
+# the formatter renders the nodes that it does not support like this
+PLACEHOLDER = "<coral:"
 
 OP_STRINGS = {
     ast.Add: "+",
@@ -45,9 +64,373 @@ def remove_outer_quotes(s):
     return s.partition('"')[2].rpartition('"')[0]
 
 
+#
+# Subtree memoization
+#
+
+
+_BARE_NODES = (ast.expr_context, ast.operator, ast.unaryop, ast.cmpop, ast.boolop)
+
+
+def _value_key(value):
+    """Returns a key for a field value that is not a node, which tells apart
+    equal values of different types, such as 1 and 1.0.
+    """
+    cls = value.__class__
+    if cls is str or value is None:
+        return value
+    elif cls is float or cls is complex:
+        # 0.0 == -0.0
+        return cls, repr(value)
+    return cls, value
+
+
+class FormatMemo(object):
+    """Remembers the rendered strings of expressions, so that identical
+    expressions, which are common in generated code such as fixtures and
+    large literal tables, are formatted only once.
+
+    Expressions are fingerprinted by their type and by the text that they
+    span in the source, which is found from their positions, so that looking
+    up an expression does not walk its subtree, and a hit skips the subtree
+    entirely. Equal text only gives equal subtrees when it is parsed the
+    same way, so trees must come from the CPython parser without the xonsh
+    transformations, as with lang="python". The parts of f-strings, whose
+    positions are not reliable, are never memoized. Comments are attached
+    to statements, so expressions never include them.
+
+    Nodes without end positions, as with Python < 3.8, are fingerprinted by
+    their structure instead. Each distinct subtree is given an id once, from
+    its type, its fields and the ids of its children, so that the subtrees
+    of a tree are fingerprinted in a single pass over it. That pass costs
+    about as much as formatting the tree, so there the memo only saves time
+    on expressions that are slower to format than to walk.
+
+    A memo may be shared by any number of formatters, and formats, as long
+    as they are of the same Formatter class, but only by one thread at a
+    time.
+    """
+
+    def __init__(self, maxsize=4096, min_length=16, max_length=4096, min_nodes=8):
+        """Parameters
+        ----------
+        maxsize : int, optional
+            Maximum number of rendered strings to remember. The least
+            recently used ones are dropped first.
+        min_length : int, optional
+            Minimum length, in bytes of source, of the expressions to
+            memoize, since looking up small expressions costs more than
+            formatting them.
+        max_length : int, optional
+            Maximum length of the expressions to memoize, which bounds the
+            size of the keys.
+        min_nodes : int, optional
+            Minimum number of nodes of the expressions to memoize, when they
+            are fingerprinted by their structure.
+        """
+        self.maxsize = maxsize
+        self.min_length = min_length
+        self.max_length = max_length
+        self.min_nodes = min_nodes
+        self.results = OrderedDict()
+        # ids of the structures of subtrees, which are never reused, so that
+        # this may be cleared at any time
+        self.structures = {}
+        self._ids = itertools.count()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        s = "FormatMemo(maxsize={0}, size={1}, hits={2}, misses={3})"
+        return s.format(self.maxsize, len(self.results), self.hits, self.misses)
+
+    def __len__(self):
+        return len(self.results)
+
+    @property
+    def hit_rate(self):
+        """Fraction of the lookups that found a rendered string."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        """Forgets all rendered strings and resets the counters."""
+        self.results.clear()
+        self.structures.clear()
+        self.hits = self.misses = 0
+
+    def key(self, node, index, fingerprints=None):
+        """Returns the key of an expression node in the memo, or None if the
+        node should not be memoized. The index is a coral.parser.LineIndex of
+        the UTF-8 encoded source, since CPython positions are byte offsets.
+        Nodes without end positions are fingerprinted by their structure,
+        see fingerprint(), with the given dict of fingerprints.
+        """
+        end_col_offset = getattr(node, "end_col_offset", None)
+        if end_col_offset is None:
+            if fingerprints is None:
+                return None
+            fid, size = self.fingerprint(node, fingerprints)
+            if size < self.min_nodes:
+                return None
+            return node.__class__, fid
+        lineno = node.lineno
+        end_lineno = node.end_lineno
+        if lineno == end_lineno:
+            # rule out most small expressions without finding their offsets
+            n = end_col_offset - node.col_offset
+            if n < self.min_length or n > self.max_length:
+                return None
+        start = index.offset(lineno, node.col_offset)
+        stop = index.offset(end_lineno, end_col_offset)
+        if start < 0 or stop < 0:
+            return None
+        n = stop - start
+        if n < self.min_length or n > self.max_length:
+            return None
+        return node.__class__, index.source[start:stop]
+
+    def fingerprint(self, node, fingerprints):
+        """Returns the (id, size) of the structure of a subtree, where equal
+        ids mean equal subtrees, and the size is the number of nodes. The
+        fingerprints dict maps the id() of the nodes of the tree, which must
+        stay alive while it is used, to their fingerprints, and is filled in
+        for the whole subtree.
+        """
+        found = fingerprints.get(id(node))
+        if found is not None:
+            return found
+        if len(self.structures) > 64 * max(self.maxsize, 64):
+            self.structures.clear()
+        structures = self.structures
+        ids = self._ids
+        ast_node = ast.AST
+        # contexts and operators have no fields, so their type is enough
+        bare = _BARE_NODES
+        # children are fingerprinted before their parents, without recursion
+        stack = [node]
+        while stack:
+            n = stack[-1]
+            parts = [n.__class__]
+            size = 1
+            pending = False
+            for name in n._fields:
+                value = getattr(n, name, None)
+                cls = value.__class__
+                if cls is list:
+                    items = []
+                    for item in value:
+                        if not isinstance(item, ast_node):
+                            items.append(_value_key(item))
+                            continue
+                        found = fingerprints.get(id(item))
+                        if found is None:
+                            stack.append(item)
+                            pending = True
+                        else:
+                            items.append(found[0])
+                            size += found[1]
+                    parts.append(tuple(items))
+                elif not isinstance(value, ast_node):
+                    parts.append(_value_key(value))
+                elif isinstance(value, bare):
+                    parts.append(cls)
+                    size += 1
+                else:
+                    found = fingerprints.get(id(value))
+                    if found is None:
+                        stack.append(value)
+                        pending = True
+                    else:
+                        parts.append(found[0])
+                        size += found[1]
+            if pending:
+                continue
+            stack.pop()
+            structure = tuple(parts)
+            fid = structures.get(structure)
+            if fid is None:
+                fid = structures[structure] = next(ids)
+            fingerprints[id(n)] = (fid, size)
+        return fingerprints[id(node)]
+
+    def get(self, key):
+        """Returns the rendered string of a key, or None if it is unknown."""
+        s = self.results.get(key)
+        if s is None:
+            self.misses += 1
+            return None
+        self.results.move_to_end(key)
+        self.hits += 1
+        return s
 
-class Formatter(ast.NodeVisitor):
-    """Converts a node into a coral-formatted string."""
+    def add(self, key, s):
+        """Remembers the rendered string of a key."""
+        results = self.results
+        results[key] = s
+        if len(results) > self.maxsize:
+            results.popitem(last=False)
+
+    def as_dict(self):
+        """Returns the counters of the memo as a JSON-serializable dict."""
+        return {
+            "size": len(self.results),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+
+class Formatter(DispatchVisitor, ast.NodeVisitor):
+    """Converts a node into coral-formatted code. Expression visitors return
+    strings, while statement visitors write their output in chunks as they
+    go, so that formatting a module does not re-copy the text of its nested
+    blocks.
+
+    Visitors of nodes that have children are generators, which yield each
+    child node that they need formatted, and are sent back its result. The
+    visit() method drives them with an explicit stack rather than by
+    recursion, so that arbitrarily deep trees, such as long chains of binary
+    operators, may be formatted in bounded stack space. Visitors of leaf
+    nodes simply return their result. Visitor methods are found through
+    the dispatch table of the class, see coral.visitor.
+
+    Expression visitors must only depend on the node they are given, so
+    that their results may be reused for identical expressions by a
+    FormatMemo.
+    """
+
+    def __init__(self, write=None, memo=None, source=None, visits=None):
+        """Parameters
+        ----------
+        write : callable or None, optional
+            Function that is called with each chunk of formatted output.
+            If None, chunks are collected in the chunks attribute.
+        memo : FormatMemo or None, optional
+            Memo of rendered expressions to reuse. This is only used if the
+            source is given, see FormatMemo for the trees it supports.
+        source : str or None, optional
+            The source that the formatted trees were parsed from.
+        visits : coral.stats.VisitStats or None, optional
+            Stats to count the visited nodes in, by node type.
+        """
+        super().__init__()
+        if write is None:
+            self.chunks = []
+            write = self.chunks.append
+        self._write = write
+        self._last = ""
+        self.memo = memo
+        self._index = None
+        if memo is not None and source is not None:
+            self._index = LineIndex(source.encode("utf-8", "surrogatepass"))
+        if visits is not None:
+            self.handlers = visits.handlers(self.handlers)
+
+    def reset(self):
+        """Clears the collected chunks and the indentation, so that the
+        formatter may be reused, even after formatting has failed.
+        """
+        if getattr(self, "chunks", None) is not None:
+            self.chunks.clear()
+        self._last = ""
+        self.indent_level = 0
+        self.indent = ""
+        self.nl_indent = "\n"
+
+    def visit(self, node):
+        """Visits a node, returning its result, without recursing into its
+        children.
+        """
+        if self._index is not None:
+            return self._visit_memo(node)
+        handlers = self.handlers
+        generator = types.GeneratorType
+        result = handlers[node.__class__](self, node)
+        if type(result) is not generator:
+            return result
+        stack = [result]
+        push = stack.append
+        value = None
+        while stack:
+            try:
+                node = stack[-1].send(value)
+            except StopIteration as e:
+                stack.pop()
+                value = e.value
+                continue
+            value = handlers[node.__class__](self, node)
+            if type(value) is generator:
+                push(value)
+                value = None
+        return value
+
+    def _visit_memo(self, node):
+        """Visits a node like visit(), reusing the rendered strings of the
+        expressions that are in the memo, and adding the others to it.
+        """
+        memo = self.memo
+        index = self._index
+        handlers = self.handlers
+        generator = types.GeneratorType
+        expr = ast.expr
+        joined_str = ast.JoinedStr
+        stack = []
+        push = stack.append
+        # fingerprints of the nodes of trees without end positions
+        fingerprints = {}
+        # number of f-strings being visited, whose parts are not memoized
+        fstrings = 0
+        while True:
+            key = hit = None
+            if not fstrings and isinstance(node, expr):
+                key = memo.key(node, index, fingerprints)
+                if key is not None:
+                    hit = memo.get(key)
+            if hit is not None:
+                value = hit
+            else:
+                value = handlers[node.__class__](self, node)
+                if type(value) is generator:
+                    fstring = node.__class__ is joined_str
+                    fstrings += fstring
+                    push((value, key, fstring))
+                    value = None
+                elif key is not None:
+                    memo.add(key, value)
+            while stack:
+                gen, key, fstring = stack[-1]
+                try:
+                    node = gen.send(value)
+                except StopIteration as e:
+                    stack.pop()
+                    value = e.value
+                    fstrings -= fstring
+                    if key is not None:
+                        memo.add(key, value)
+                    continue
+                break
+            else:
+                return value
+
+    # output helpers
+
+    def write(self, s):
+        """Writes a chunk of formatted output."""
+        if s:
+            self._write(s)
+            self._last = s
+
+    def endswith_newline(self):
+        """Whether the output written so far ends with a newline."""
+        return self._last.endswith("\n")
+
+    def emit(self, node):
+        """Visits a node and writes its result, if it returns any."""
+        s = self.visit(node)
+        if s is not None:
+            self.write(s)
 
     # indent helpers
 
@@ -68,6 +451,13 @@ class Formatter(ast.NodeVisitor):
 
     # other helpers
 
+    def _visit_all(self, nodes):
+        """yields each node, returning the list of their results"""
+        results = []
+        for node in nodes:
+            results.append((yield node))
+        return results
+
     def _func_args(self, args):
         """converts function arguments to a str"""
         rendered = []
@@ -78,14 +468,14 @@ class Formatter(ast.NodeVisitor):
         for arg in positional_args:
             rendered.append(arg.arg)
         for arg, default in zip(keyword_args, args.defaults):
-            rendered.append(arg.arg + "=" + self.visit(default))
+            rendered.append(arg.arg + "=" + (yield default))
         if args.vararg is not None:
             rendered.append("*" + args.vararg.arg)
         if keywordonly_args:
             if args.vararg is None:
                 rendered.append("*")
             for arg, default in zip(keywordonly_args, args.kw_defaults):
-                rendered.append(arg.arg + "=" + self.visit(default))
+                rendered.append(arg.arg + "=" + (yield default))
         if args.kwarg is not None:
             rendered.append("**" + args.kwarg.arg)
         return ", ".join(rendered)
@@ -93,53 +483,59 @@ class Formatter(ast.NodeVisitor):
     def _generators(self, node):
         s = ""
         for generator in node.generators:
-            s += " for " + self.visit(generator.target)
-            s += " in " + self.visit(generator.iter)
+            s += " for " + (yield generator.target)
+            s += " in " + (yield generator.iter)
             for clause in generator.ifs:
-                s += " if " + self.visit(clause)
+                s += " if " + (yield clause)
         return s
 
-    def _loop_body(self, node):
+    def _body(self, body):
+        """writes an indented block of statements"""
         self.inc_indent()
-        s = self.nl_indent + self.nl_indent.join(map(self.visit, node.body))
+        for n in body:
+            self.write(self.nl_indent)
+            s = yield n
+            if s is not None:
+                self.write(s)
         self.dec_indent()
+
+    def _loop_body(self, node):
+        yield from self._body(node.body)
         if node.orelse:
-            s += "\nelse:"
-            self.inc_indent()
-            s += self.nl_indent + self.nl_indent.join(map(self.visit, node.orelse))
-            self.dec_indent()
-        s += "\n"
-        return s
+            self.write("\nelse:")
+            yield from self._body(node.orelse)
+        self.write("\n")
 
     def _withitem(self, item):
-        s = self.visit(item.context_expr)
+        s = yield item.context_expr
         if item.optional_vars is not None:
-            s += " as " + self.visit(item.optional_vars)
+            s += " as " + (yield item.optional_vars)
         return s
 
     # top-level visitors
 
     def generic_visit(self, node):
-        return "<coral:" + str(node.__class__) + " not implemented>"
+        return PLACEHOLDER + str(node.__class__) + " not implemented>"
 
     def visit_Module(self, node):
-        parts = []
-        for n in node.body:
-            parts.append(self.visit(n))
-        s = "\n".join(parts)
-        if not s.endswith("\n"):
-            s += "\n"
-        return s
+        for i, n in enumerate(node.body):
+            if i:
+                self.write("\n")
+            s = yield n
+            if s is not None:
+                self.write(s)
+        if node.body and not self.endswith_newline():
+            self.write("\n")
 
     visit_Interactive = visit_Module
 
     def visit_Expression(self, node):
-        return self.visit(node.body)
+        return (yield node.body)
 
     # expression visitors
 
     def visit_Expr(self, node):
-        return self.visit(node.value)
+        return (yield node.value)
 
     def visit_Comment(self, node):
         _, _, comment = node.s.partition('#')
@@ -152,9 +548,9 @@ class Formatter(ast.NodeVisitor):
         return '"' + node.s  + '"'
 
     def visit_FormattedValue(self, node):
-        s = "{" + self.visit(node.value)
+        s = "{" + (yield node.value)
         if node.format_spec is not None:
-            s += ":" + remove_outer_quotes(self.visit(node.format_spec))
+            s += ":" + remove_outer_quotes((yield node.format_spec))
         if node.conversion >= 0:
             s += "!" + chr(node.conversion)
         s += "}"
@@ -163,7 +559,7 @@ class Formatter(ast.NodeVisitor):
     def visit_JoinedStr(self, node):
         s = 'f"'
         for value in node.values:
-            s += remove_outer_quotes(self.visit(value))
+            s += remove_outer_quotes((yield value))
         s += '"'
         return s
 
@@ -180,13 +576,11 @@ class Formatter(ast.NodeVisitor):
         return "..."
 
     def visit_Constant(self, node):
-        return "<coral:constant not implemented>"
+        return PLACEHOLDER + "constant not implemented>"
 
     def visit_List(self, node):
         s = "["
-        new_elts = []
-        for elt in node.elts:
-            new_elts.append(self.visit(elt))
+        new_elts = yield from self._visit_all(node.elts)
         s += ", ".join(new_elts)
         s += "]"
         return s
@@ -195,11 +589,9 @@ class Formatter(ast.NodeVisitor):
         if len(node.elts) == 0:
             return "()"
         elif len(node.elts) == 1:
-            return "(" + self.visit(node.elts[0]) + ",)"
+            return "(" + (yield node.elts[0]) + ",)"
         s = "("
-        new_elts = []
-        for elt in node.elts:
-            new_elts.append(self.visit(elt))
+        new_elts = yield from self._visit_all(node.elts)
         s += ", ".join(new_elts)
         s += ")"
         return s
@@ -208,8 +600,8 @@ class Formatter(ast.NodeVisitor):
         s = "{"
         new_elts = []
         for key, value in zip(node.keys, node.values):
-            k = self.visit(key)
-            v = self.visit(value)
+            k = yield key
+            v = yield value
             new_elts.append(k + ": " + v)
         s += ", ".join(new_elts)
         s += "}"
@@ -217,79 +609,81 @@ class Formatter(ast.NodeVisitor):
 
     def visit_Set(self, node):
         s = "{"
-        new_elts = []
-        for elt in node.elts:
-            new_elts.append(self.visit(elt))
+        new_elts = yield from self._visit_all(node.elts)
         s += ", ".join(new_elts)
         s += "}"
         return s
 
     def visit_Lambda(self, node):
         s = "lambda"
-        args = self._func_args(node.args)
+        args = yield from self._func_args(node.args)
         if args:
             s += " " + args
-        s += ": " + self.visit(node.body)
+        s += ": " + (yield node.body)
         return s
 
     def visit_BinOp(self, node):
-        s = self.visit(node.left) + " "
-        s += op_to_str(node.op)
-        s += " " + self.visit(node.right)
+        s = (yield node.left) + " "
+        s += OP_STRINGS[node.op.__class__]
+        s += " " + (yield node.right)
         return s
 
     def visit_BoolOp(self, node):
-        op = " " + op_to_str(node.op) + " "
-        s = op.join(map(self.visit, node.values))
+        op = " " + OP_STRINGS[node.op.__class__] + " "
+        s = op.join((yield from self._visit_all(node.values)))
         return s
 
     def visit_UnaryOp(self, node):
         space = ""
         if isinstance(node.op, ast.Not):
             space = " "
-        s = op_to_str(node.op) + space + self.visit(node.operand)
+        s = OP_STRINGS[node.op.__class__] + space + (yield node.operand)
         return s
 
     def visit_IfExp(self, node):
-        s = self.visit(node.body) + " if " + self.visit(node.test)
-        s += " else " + self.visit(node.orelse)
+        s = (yield node.body) + " if " + (yield node.test)
+        s += " else " + (yield node.orelse)
         return s
 
     def visit_ListComp(self, node):
-        return "[" + self.visit(node.elt) + self._generators(node) + "]"
+        elt = yield node.elt
+        return "[" + elt + (yield from self._generators(node)) + "]"
 
     def visit_DictComp(self, node):
-        s = "{" + self.visit(node.key) + ": " + self.visit(node.value)
-        s += self._generators(node) + "}"
+        s = "{" + (yield node.key) + ": " + (yield node.value)
+        s += (yield from self._generators(node)) + "}"
         return s
 
     def visit_SetComp(self, node):
-        return "{" + self.visit(node.elt) + self._generators(node) + "}"
+        elt = yield node.elt
+        return "{" + elt + (yield from self._generators(node)) + "}"
 
     def visit_GeneratorExp(self, node):
-        return "(" + self.visit(node.elt) + self._generators(node) + ")"
+        elt = yield node.elt
+        return "(" + elt + (yield from self._generators(node)) + ")"
 
     def visit_Await(self, node):
-        return "await " + self.visit(node.value)
+        return "await " + (yield node.value)
 
     def visit_Yield(self, node):
-        return "yield " + self.visit(node.value)
+        return "yield " + (yield node.value)
 
     def visit_YieldFrom(self, node):
-        return "yield from " + self.visit(node.value)
+        return "yield from " + (yield node.value)
 
     def visit_Compare(self, node):
-        s = self.visit(node.left)
+        s = yield node.left
         for op, comparator in zip(node.ops, node.comparators):
-            s += " " + op_to_str(op) + " " + self.visit(comparator)
+            s += " " + OP_STRINGS[op.__class__] + " " + (yield comparator)
         return s
 
     def visit_Call(self, node):
-        s = self.visit(node.func) + "("
+        s = (yield node.func) + "("
         all_args = []
-        all_args.extend(map(self.visit, node.args))
+        for arg in node.args:
+            all_args.append((yield arg))
         for keyword in node.keywords:
-            kw = keyword.arg + "=" + self.visit(keyword.value)
+            kw = keyword.arg + "=" + (yield keyword.value)
             all_args.append(kw)
         s += ", ".join(all_args) +  ")"
         return s
@@ -297,130 +691,128 @@ class Formatter(ast.NodeVisitor):
     def visit_Slice(self, node):
         s = ""
         if node.lower is not None:
-            s += self.visit(node.lower)
+            s += yield node.lower
         s += ":"
         if node.upper is not None:
-            s += self.visit(node.upper)
+            s += yield node.upper
         if node.step is not None:
-            s += ':' + self.visit(node.step)
+            s += ':' + (yield node.step)
         return s
 
     # assignable expression visitors
 
     def visit_Attribute(self, node):
-        return self.visit(node.value) + '.' + node.attr
+        return (yield node.value) + '.' + node.attr
 
     def visit_Subscript(self, node):
-        return  self.visit(node.value) + '[' + self.visit(node.slice) + ']'
+        return  (yield node.value) + '[' + (yield node.slice) + ']'
 
     def visit_Starred(self, node):
-        return '*' + self.visit(node.value)
+        return '*' + (yield node.value)
 
     # statement visitors
 
     def visit_FunctionDef(self, node):
-        s = "def " + node.name + "(" + self._func_args(node.args) + "):"
-        self.inc_indent()
-        s += self.nl_indent + self.nl_indent.join(map(self.visit, node.body))
+        args = yield from self._func_args(node.args)
+        self.write("def " + node.name + "(" + args + "):")
+        yield from self._body(node.body)
         if node.returns:
-            s += self.nl_indent + self.visit(node.returns)
-        self.dec_indent()
-        s += "\n"
-        return s
+            self.inc_indent()
+            self.write(self.nl_indent + (yield node.returns))
+            self.dec_indent()
+        self.write("\n")
 
     def visit_AsyncFunctionDef(self, node):
-        return "async " + self.visit_FunctionDef(node)
+        self.write("async ")
+        yield from self.visit_FunctionDef(node)
 
     def visit_ClassDef(self, node):
         s = "class " + node.name
         if node.bases or node.keywords:
             s += "("
-            parts = list(map(self.visit, node.bases))
+            parts = yield from self._visit_all(node.bases)
             for keyword in node.keywords:
-                parts.append(keyword.arg + '=' + self.visit(keyword.value))
+                parts.append(keyword.arg + '=' + (yield keyword.value))
             s += ", ".join(parts) + ")"
-        self.inc_indent()
-        s += ":" + self.nl_indent
-        parts = list(map(self.visit, node.body))
-        s += self.nl_indent.join(parts)
-        self.dec_indent()
-        s += "\n"
-        return s
+        self.write(s + ":")
+        yield from self._body(node.body)
+        self.write("\n")
 
     def visit_Return(self, node):
         s = "return"
         if node.value is not None:
-            s += " " + self.visit(node.value)
+            s += " " + (yield node.value)
         return s
 
     def visit_Delete(self, node):
-        return "del " + ", ".join(map(self.visit, node.targets))
+        return "del " + ", ".join((yield from self._visit_all(node.targets)))
 
     def visit_Assign(self, node):
         if isinstance(node, ast.AnnAssign):
-            return self.visit_AnnAssign(node)
-        return ", ".join(map(self.visit, node.targets)) + " = " + self.visit(node.value)
+            return (yield from self.visit_AnnAssign(node))
+        targets = []
+        for target in node.targets:
+            targets.append((yield target))
+        return ", ".join(targets) + " = " + (yield node.value)
 
     def visit_AugAssign(self, node):
-        return self.visit(node.target) + " " + op_to_str(node.op) + "= " + self.visit(node.value)
+        target = yield node.target
+        return target + " " + OP_STRINGS[node.op.__class__] + "= " + (yield node.value)
 
     def visit_AnnAssign(self, node):
         use_paren = node.simple == 0 and isinstance(node.target, ast.Name)
         s = "(" if use_paren else ""
-        s += self.visit(node.target)
+        s += yield node.target
         if use_paren:
             s += ")"
-        s += ": " + self.visit(node.annotation)
+        s += ": " + (yield node.annotation)
         if node.value is not None:
-            s += " = " + self.visit(node.value)
+            s += " = " + (yield node.value)
         return s
 
     def visit_For(self, node):
-        s = "for " + self.visit(node.target) + " in "
-        s += self.visit(node.iter) + ":"
-        s += self._loop_body(node)
-        return s
+        s = "for " + (yield node.target) + " in "
+        s += (yield node.iter) + ":"
+        self.write(s)
+        yield from self._loop_body(node)
 
     def visit_AsyncFor(self, node):
-        return "async " + self.visit_For(node)
+        self.write("async ")
+        yield from self.visit_For(node)
 
     def visit_While(self, node):
-        s = "while " + self.visit(node.test) + ":"
-        s += self._loop_body(node)
-        return s
+        self.write("while " + (yield node.test) + ":")
+        yield from self._loop_body(node)
 
     def visit_If(self, node):
-        s = "if " + self.visit(node.test) + ":"
-        self.inc_indent()
-        s += self.nl_indent + self.nl_indent.join(map(self.visit, node.body))
-        self.dec_indent()
+        self.write("if " + (yield node.test) + ":")
+        yield from self._body(node.body)
         if len(node.orelse) == 1 and isinstance(node.orelse[0], ast.If):
-            s += "\nel" + self.visit_If(node.orelse[0])
+            self.write("\nel")
+            yield from self.visit_If(node.orelse[0])
         elif node.orelse:
-            s += "\nelse:"
-            self.inc_indent()
-            s += self.nl_indent + self.nl_indent.join(map(self.visit, node.orelse))
-            self.dec_indent()
-        if not s.endswith("\n"):
-            s += "\n"
-        return s
+            self.write("\nelse:")
+            yield from self._body(node.orelse)
+        if not self.endswith_newline():
+            self.write("\n")
 
     def visit_With(self, node):
-        s = "with " + ", ".join(map(self._withitem, node.items)) + ":"
-        self.inc_indent()
-        s += self.nl_indent + self.nl_indent.join(map(self.visit, node.body))
-        self.dec_indent()
-        return s
+        items = []
+        for item in node.items:
+            items.append((yield from self._withitem(item)))
+        self.write("with " + ", ".join(items) + ":")
+        yield from self._body(node.body)
 
     def visit_AsyncWith(self, node):
-        return "async " + self.visit_With(node)
+        self.write("async ")
+        yield from self.visit_With(node)
 
     def visit_Raise(self, node):
         s = "raise"
         if node.exc is not None:
-            s += " " + self.visit(node.exc)
+            s += " " + (yield node.exc)
             if node.cause is not None:
-                s += " from " + self.visit(node.cause)
+                s += " from " + (yield node.cause)
         return s
 
     def visit_Pass(self, node):
@@ -434,15 +826,489 @@ class Formatter(ast.NodeVisitor):
 
 
 
-def format(tree):
-    """Formats an AST of xonsh code into a nice string"""
+def format_to(tree, stream, memo=None, source=None, visits=None):
+    """Formats an AST of xonsh code, writing the result to a stream (or any
+    object with a write() method) as it is produced. A FormatMemo may be
+    given, along with the source of the tree, to reuse the rendered strings
+    of repeated expressions. If visits is a coral.stats.VisitStats, the
+    visited nodes are counted in it.
+    """
+    formatter = Formatter(stream.write, memo=memo, source=source, visits=visits)
+    formatter.emit(tree)
+
+
+def format(tree, memo=None, source=None, visits=None):
+    """Formats an AST of xonsh code into a nice string. A FormatMemo may be
+    given, along with the source of the tree, to reuse the rendered strings
+    of repeated expressions. If visits is a coral.stats.VisitStats, the
+    visited nodes are counted in it.
+    """
+    formatter = Formatter(memo=memo, source=source, visits=visits)
+    formatter.emit(tree)
+    return "".join(formatter.chunks)
+
+
+class _Mismatch(Exception):
+    """Raised by a ComparingWriter at the first difference."""
+
+
+class ComparingWriter(object):
+    """Write function for a Formatter that compares its output to an expected
+    string as it is produced, rather than collecting it. The first chunk that
+    differs raises an exception, which stops the formatter early.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.pos = 0
+
+    def __call__(self, s):
+        if not self.expected.startswith(s, self.pos):
+            raise _Mismatch()
+        self.pos += len(s)
+
+    @property
+    def matched(self):
+        """Whether all of the expected string has been written."""
+        return self.pos == len(self.expected)
+
+
+def matches(tree, expected, visits=None):
+    """Whether formatting a tree produces exactly the expected string.
+    Formatting stops at the first chunk of output that differs. The visits
+    argument is as for format().
+    """
+    writer = ComparingWriter(expected)
+    try:
+        Formatter(writer, visits=visits).emit(tree)
+    except _Mismatch:
+        return False
+    return writer.matched
+
+
+def run_stages(inp, parse, format, stats=None, commented=False):
+    """Reformats a source with the given parse and format functions. If
+    stats is a coral.stats.ReformatStats object, the time spent in each stage
+    and the sizes of the input are recorded in it. If commented is true, the
+    trees returned by parse already have their comments added, as with
+    coral.parser.parse_commented().
+    """
+    if stats is None:
+        tree, comments, lines = parse(inp)
+        if not commented:
+            tree = add_comments(tree, comments, lines)
+        if tree is None:
+            # empty or blank code
+            tree = ast.Module(body=[])
+        return format(tree)
+    stats.lines = inp.count("\n")
+    with stats.stage("parse"):
+        tree, comments, lines = parse(inp)
+    stats.nodes = 0 if tree is None else sum(1 for _ in ast.walk(tree))
+    stats.comments = len(comments)
+    with stats.stage("comments"):
+        if not commented:
+            tree = add_comments(tree, comments, lines)
+    if tree is None:
+        tree = ast.Module(body=[])
+    with stats.stage("format"):
+        return format(tree)
+
+
+def reformat(inp, debug_level=0, stats=None, lang="xonsh", memo=None):
+    """Reformats xonsh code (str) into a nice string. If stats is a
+    coral.stats.ReformatStats object, the time spent in each stage and the
+    sizes of the input are recorded in it, along with the visited nodes if
+    it has visits. The lang argument is passed to coral.parser.parse(). If
+    memo is a FormatMemo, repeated expressions are formatted only once,
+    which is only supported for lang="python".
+    """
+    parse_inp = functools.partial(parse, debug_level=debug_level, lang=lang)
+    visits = None if stats is None else stats.visits
+    fmt = functools.partial(format, visits=visits)
+    if memo is not None:
+        if lang != "python":
+            raise ValueError("memo requires lang='python', not {0!r}".format(lang))
+        fmt = functools.partial(format, memo=memo, source=inp, visits=visits)
+    return run_stages(inp, parse_inp, fmt, stats=stats)
+
+
+def is_formatted(inp, debug_level=0, stats=None, lang="xonsh"):
+    """Whether xonsh code (str) is already coral-formatted, that is, whether
+    reformat() would return it unchanged. This is cheaper than comparing the
+    result of reformat(), since formatting stops at the first difference.
+    The other arguments are as for reformat().
+    """
+    parse_inp = functools.partial(parse, debug_level=debug_level, lang=lang)
+    visits = None if stats is None else stats.visits
+    check = functools.partial(matches, expected=inp, visits=visits)
+    return run_stages(inp, parse_inp, check, stats=stats)
+
+
+#
+# Safety checks
+#
+
+
+class UnsafeFormatError(ValueError):
+    """Raised for formatted code that must not replace the code it was
+    formatted from.
+    """
+
+
+def _tree_dump(tree):
+    return "" if tree is None or not tree.body else ast.dump(tree)
+
+
+def check_placeholders(inp, out):
+    """Raises an UnsafeFormatError if formatted code contains placeholders
+    for nodes that the formatter does not implement, which the code that it
+    was formatted from did not contain.
+    """
+    if out.count(PLACEHOLDER) > inp.count(PLACEHOLDER):
+        raise UnsafeFormatError("output contains unformatted nodes")
+
+
+def assert_equivalent(inp, out, parse):
+    """Raises an UnsafeFormatError unless formatted code parses to the same
+    tree as the code that it was formatted from, with the given parse
+    function, which returns (tree, comments, lines) as coral.parser.parse()
+    does. Comments and positions are not compared.
+    """
+    check_placeholders(inp, out)
+    try:
+        dst = parse(out)[0]
+    except SyntaxError as e:
+        raise UnsafeFormatError("output does not parse: {0}".format(e))
+    if _tree_dump(parse(inp)[0]) != _tree_dump(dst):
+        raise UnsafeFormatError("output does not parse to the same tree as input")
+
+
+def check_output(inp, out, debug_level=0, lang="xonsh"):
+    """Checks that the result of reformat() is safe to replace the code it
+    was formatted from, see assert_equivalent(). The other arguments are as
+    for reformat().
+    """
+    parse_src = functools.partial(parse, debug_level=debug_level, lang=lang)
+    assert_equivalent(inp, out, parse_src)
+
+
+#
+# Streaming
+#
+
+
+def chunk_statements(chunks, debug_level=0, lang="xonsh", ctx=None):
+    """Parses chunks of code one at a time, yielding their statements and
+    comments. Each chunk is parsed with the names that the chunks before it
+    define added to the context, which starts out as ctx, or the builtins.
+    Chunks may also be given already parsed, as (tree, comments, lines)
+    tuples.
+    """
+    for tree, comments, lines in parse_chunks(chunks, debug_level, lang, ctx):
+        tree = add_comments(tree, comments, lines)
+        if tree is not None:
+            yield from tree.body
+
+
+def parse_chunks(chunks, debug_level=0, lang="xonsh", ctx=None):
+    """Parses chunks of code one at a time, yielding the (tree, comments,
+    lines) of each, see chunk_statements().
+    """
+    if lang == "python":
+        ctx = None
+    else:
+        ctx = set(builtins.__dict__ if ctx is None else ctx)
+    for i, chunk in enumerate(chunks):
+        if isinstance(chunk, tuple):
+            tree, comments, lines = chunk
+        else:
+            tree, comments, lines = parse(
+                chunk,
+                ctx=None if ctx is None else set(ctx),
+                debug_level=debug_level,
+                lang=lang,
+            )
+            if i and isinstance(tree, ast.Expression):
+                # the xonsh parser reads an unterminated lone expression as
+                # such, which the last of several statements cannot be
+                raise SyntaxError("no further code")
+        if ctx is not None and tree is not None:
+            ModuleNames(ctx).visit(tree)
+        yield tree, comments, lines
+
+
+def format_body(stmts):
+    """Formats top-level statements like the module visitor does, except
+    that the result may not end with a newline, so that the results of
+    consecutive runs of statements may be joined with a newline.
+    """
     formatter = Formatter()
-    s = formatter.visit(tree)
-    return s
-
-
-def reformat(inp, debug_level=0):
-    """Reformats xonsh code (str) into a nice string"""
-    tree, comments, lines = parse(inp, debug_level=debug_level)
+    for i, node in enumerate(stmts):
+        if i:
+            formatter.write("\n")
+        formatter.emit(node)
+    return "".join(formatter.chunks)
+
+
+def reformat_stream(instream, outstream, debug_level=0, lang="xonsh"):
+    """Reformats xonsh code read from a stream (or any object with a
+    readline() method), writing the result to another stream (or any object
+    with a write() method). The code is split into top-level statements
+    with coral.parser.top_level_chunks(), which are parsed, commented and
+    formatted one at a time, so that peak memory tracks the largest
+    top-level statement rather than the whole code. The other arguments are
+    as for reformat().
+    """
+    chunks = top_level_chunks(instream.readline)
+    first = next(chunks, None)
+    if first is None:
+        return
+    second = next(chunks, None)
+    if second is None:
+        outstream.write(reformat(first, debug_level=debug_level, lang=lang))
+        return
+    chunks = itertools.chain([first, second], chunks)
+    del first, second
+    # the module visitor pulls the statements from the chunks as it goes
+    module = ast.Module(body=chunk_statements(chunks, debug_level, lang))
+    format_to(module, outstream)
+
+
+def _stream_dumps(instream, debug_level, lang):
+    chunks = top_level_chunks(instream.readline)
+    for tree, _, _ in parse_chunks(chunks, debug_level, lang):
+        if tree is not None:
+            for node in tree.body:
+                yield ast.dump(node)
+
+
+def check_stream(instream, outstream, debug_level=0, lang="xonsh"):
+    """Checks that code formatted by reformat_stream() parses to the same
+    statements as the code it was formatted from, reading both streams one
+    top-level statement at a time, see assert_equivalent(). Placeholders are
+    not looked for. The other arguments are as for reformat_stream().
+    """
+    inp = _stream_dumps(instream, debug_level, lang)
+    out = _stream_dumps(outstream, debug_level, lang)
+    try:
+        for a, b in itertools.zip_longest(inp, out):
+            if a != b:
+                raise UnsafeFormatError(
+                    "output does not parse to the same tree as input"
+                )
+    except SyntaxError as e:
+        raise UnsafeFormatError("output does not parse: {0}".format(e))
+
+
+#
+# Range formatting
+#
+
+_BLOCK_FIELDS = ("body", "handlers", "orelse", "finalbody")
+
+
+def _unwrap(node):
+    # statements with comments wrap the actual statement
+    return getattr(node, "node", node)
+
+
+def _indent_of(line):
+    return len(line) - len(line.lstrip())
+
+
+def _spans(stmts, end, index):
+    """Returns the (start, end) lines of each statement of a block that ends
+    on the given line, along with the end of the region that it owns. Each
+    statement owns the lines up to the next one, but ends before trailing
+    blank lines, and before the lines of a later clause of the enclosing
+    statement, like 'else:', which are indented less.
+    """
+    starts = [_statement_start(n) for n in stmts]
+    col = _indent_of(index.line(starts[0]))
+    spans = []
+    for i, start in enumerate(starts):
+        owned = starts[i + 1] - 1 if i + 1 < len(starts) else end
+        stop = owned
+        while stop > start:
+            line = index.line(stop)
+            if line.strip() and _indent_of(line) >= col:
+                break
+            stop -= 1
+        spans.append((start, stop, owned))
+    return spans
+
+
+def _blocks(node):
+    """Yields the blocks of statements of a compound statement, in order."""
+    node = _unwrap(node)
+    for field in _BLOCK_FIELDS:
+        value = getattr(node, field, None)
+        if not value:
+            continue
+        if field == "handlers":
+            for handler in value:
+                yield handler.body
+        elif isinstance(value, list) and isinstance(value[0], ast.AST):
+            yield value
+
+
+def find_statements(tree, start_line, end_line, index, base_indent="    "):
+    """Finds the smallest run of statements of a single block that covers
+    the lines from start_line to end_line, as long as their indentation in
+    the source is what the formatter would give them.
+
+    Returns
+    -------
+    stmts : list of AST
+        The statements, empty if there are none on the lines.
+    depth : int
+        The nesting depth of the block.
+    span : tuple of int
+        The first and last lines of the statements.
+    """
+    stmts = tree.body
+    end = len(index.starts)
+    # the enclosing runs of statements found so far, outermost first
+    found = []
+    depth = 0
+    while stmts:
+        spans = _spans(stmts, end, index)
+        hit = [
+            i for i, (a, b, _) in enumerate(spans) if a <= end_line and b >= start_line
+        ]
+        if not hit:
+            break
+        i, j = hit[0], hit[-1]
+        found.append((stmts[i : j + 1], depth, (spans[i][0], spans[j][1])))
+        if i != j:
+            break
+        # descend into the block of the statement that contains the whole
+        # range, if any
+        blocks = list(_blocks(stmts[i]))
+        end = spans[i][2]
+        stmts = []
+        for k, block in enumerate(blocks):
+            first = _statement_start(block[0])
+            last = end
+            if k + 1 < len(blocks):
+                last = _statement_start(blocks[k + 1][0]) - 1
+            if first <= start_line and end_line <= last:
+                stmts, end = block, last
+                break
+        depth += 1
+    # blocks whose indentation differs from the formatter's are replaced by
+    # a statement that encloses them
+    while found:
+        selected, depth, span = found[-1]
+        line = index.line(span[0])
+        if line[: _indent_of(line)] == base_indent * depth:
+            return selected, depth, span
+        found.pop()
+    return [], 0, (start_line, start_line - 1)
+
+
+def format_statements(stmts, depth=0):
+    """Formats a run of statements of a block at a nesting depth, as they
+    would be formatted as part of the whole tree.
+    """
+    formatter = Formatter()
+    formatter.reset()
+    for _ in range(depth):
+        formatter.inc_indent()
+    for i, node in enumerate(stmts):
+        formatter.write("\n" + formatter.indent if i else formatter.indent)
+        s = formatter.visit(node)
+        if s is not None:
+            formatter.write(s)
+    if not formatter.endswith_newline():
+        formatter.write("\n")
+    return "".join(formatter.chunks)
+
+
+def _reformat_lines(inp, start_line, end_line, ctx, debug_level, lang):
+    tree, comments, lines = parse(inp, ctx=ctx, debug_level=debug_level, lang=lang)
     tree = add_comments(tree, comments, lines)
-    return format(tree)
+    if tree is None:
+        # blank code
+        return inp
+    if not isinstance(tree, ast.Module):
+        return format(tree)
+    index = LineIndex(inp)
+    stmts, depth, (first, last) = find_statements(
+        tree, start_line, end_line, index, Formatter.base_indent
+    )
+    if not stmts:
+        return inp
+    starts = index.starts
+    begin = starts[first - 1]
+    stop = starts[last] if last < len(starts) else len(inp)
+    return inp[:begin] + format_statements(stmts, depth) + inp[stop:]
+
+
+def reformat_range(inp, start_line, end_line, debug_level=0, lang="xonsh"):
+    """Reformats only the statements of xonsh code (str) on the lines from
+    start_line to end_line, which are 1-based and inclusive, leaving the
+    rest of the code as it is. The smallest run of statements of a single
+    block that covers the lines is formatted, at the indentation of the
+    block. The other arguments are as for reformat().
+
+    Only the top-level statements around the lines are parsed, with the
+    names that the code before them defines in the context, so the cost
+    does not grow with the size of the code. If that code cannot be read
+    by the CPython parser, or the statements cannot be parsed on their
+    own, the whole code is parsed instead.
+
+    Raises a ValueError unless 1 <= start_line <= end_line.
+    """
+    if not 1 <= start_line <= end_line:
+        msg = "invalid range of lines {0} to {1}".format(start_line, end_line)
+        raise ValueError(msg)
+    index = LineIndex(inp)
+    starts = top_level_starts(inp)
+    i = bisect.bisect_right(starts, start_line) - 1
+    first = starts[i] if i >= 0 else 1
+    j = bisect.bisect_right(starts, end_line)
+    nlines = len(index.starts)
+    last = starts[j] - 1 if j < len(starts) else nlines
+    begin = index.offset(first, 0)
+    stop = index.offset(last + 1, 0) if last < nlines else len(inp)
+    try:
+        ctx = None if lang == "python" else module_names(inp[:begin])
+        out = _reformat_lines(
+            inp[begin:stop],
+            start_line - first + 1,
+            end_line - first + 1,
+            ctx,
+            debug_level,
+            lang,
+        )
+    except (SyntaxError, MemoryError):
+        return _reformat_lines(inp, start_line, end_line, None, debug_level, lang)
+    return inp[:begin] + out + inp[stop:]
+
+
+def reformat_ranges(inp, ranges, debug_level=0, lang="xonsh"):
+    """Reformats only the statements of xonsh code (str) on several ranges
+    of lines, given as (start_line, end_line) pairs, as for reformat_range().
+    Ranges within the same top-level statement are formatted together, as a
+    single range, and the others are formatted from the last one up, so
+    that the lines of the ones before stay where they are. The other
+    arguments are as for reformat().
+    """
+    if not ranges:
+        return inp
+    starts = top_level_starts(inp)
+    groups = []
+    for start, end in sorted(ranges):
+        first = bisect.bisect_right(starts, start) - 1
+        last = bisect.bisect_right(starts, end) - 1
+        if groups and first <= groups[-1][2]:
+            group = groups[-1]
+            group[1] = max(group[1], end)
+            group[2] = max(group[2], last)
+        else:
+            groups.append([start, end, last])
+    for start, end, _ in reversed(groups):
+        inp = reformat_range(inp, start, end, debug_level=debug_level, lang=lang)
+    return inp
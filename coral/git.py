@@ -0,0 +1,187 @@
+"""Finding the files, and lines, that changed in a local git repository."""
+import os
+import re
+import subprocess
+
+from lazyasd import lazyobject
+
+
+class GitError(Exception):
+    """Raised when git cannot be run or reports an error."""
+
+
+@lazyobject
+def re_hunk_header():
+    return re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+
+
+@lazyobject
+def re_c_escape():
+    return re.compile(r"\\([0-7]{1,3}|.)")
+
+
+_C_ESCAPES = {
+    "a": "\a",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+    '"': '"',
+    "\\": "\\",
+}
+
+
+def unquote_path(name):
+    """Undoes the C-style quoting that git applies to unusual path names,
+    like '"a\\303\\251.py"' or '"tab\\there.py"'. Octal escapes are bytes
+    of the UTF-8 encoded name. Names that are not quoted are returned as is.
+    """
+    if len(name) < 2 or not (name.startswith('"') and name.endswith('"')):
+        return name
+    out = bytearray()
+    pos = 1
+    for m in re_c_escape.finditer(name, 1, len(name) - 1):
+        out += name[pos : m.start()].encode("utf-8", "surrogateescape")
+        esc = m.group(1)
+        if esc[0] in "01234567":
+            out.append(int(esc, 8) & 0xFF)
+        else:
+            out += _C_ESCAPES.get(esc, esc).encode("utf-8", "surrogateescape")
+        pos = m.end()
+    out += name[pos:-1].encode("utf-8", "surrogateescape")
+    return out.decode("utf-8", "surrogateescape")
+
+
+def git(args, cwd=None):
+    """Runs a git command in a directory, returning its standard output.
+    Raises a GitError if git is not installed or if the command fails.
+    """
+    cmd = ["git", "-c", "core.quotepath=off"] + list(args)
+    try:
+        proc = subprocess.run(
+            cmd,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+    except OSError as e:
+        raise GitError("could not run git: {0}".format(e))
+    if proc.returncode != 0:
+        msg = proc.stderr.strip() or "exit status {0}".format(proc.returncode)
+        raise GitError("git {0}: {1}".format(args[0], msg))
+    return proc.stdout
+
+
+def repo_root(cwd=None):
+    """Returns the top-level directory of the repository containing cwd."""
+    return git(["rev-parse", "--show-toplevel"], cwd=cwd).strip()
+
+
+def _diff_args(since, staged):
+    if staged:
+        return ["diff", "--cached", "--no-ext-diff", "--no-color"]
+    if since is None:
+        raise ValueError("either a ref to diff against or staged must be given")
+    return ["diff", "--no-ext-diff", "--no-color", since]
+
+
+def _pathspecs(paths):
+    # git is run in the repository root, so relative paths are resolved first
+    return ["--"] + [os.path.abspath(p) for p in paths] if paths else []
+
+
+def _list_files(args, root, extensions):
+    files = set()
+    for name in git(args, cwd=root).split("\0"):
+        if not name:
+            continue
+        if extensions is not None and os.path.splitext(name)[1] not in extensions:
+            continue
+        path = os.path.join(root, name)
+        if os.path.isfile(path):
+            files.add(path)
+    return files
+
+
+def _changed_files(since, staged, paths, extensions, root):
+    # returns the sets of changed tracked files and of untracked files
+    specs = _pathspecs(paths)
+    args = _diff_args(since, staged) + ["--name-only", "--diff-filter=ACMR", "-z"]
+    tracked = _list_files(args + specs, root, extensions)
+    if staged:
+        return tracked, set()
+    args = ["ls-files", "--others", "--exclude-standard", "-z"]
+    return tracked, _list_files(args + specs, root, extensions)
+
+
+def changed_files(since=None, staged=False, paths=None, extensions=None, cwd=None):
+    """Returns the sorted absolute paths of the files that were added,
+    copied, modified, or renamed in a git repository.
+
+    Parameters
+    ----------
+    since : str or None, optional
+        Git ref to compare the working tree with. Untracked files that are
+        not ignored count as changed as well.
+    staged : bool, optional
+        Whether to list the files with staged changes instead, comparing
+        the index with HEAD.
+    paths : list of str or None, optional
+        Only list the files under these files and directories.
+    extensions : collection of str or None, optional
+        Only list the files with these extensions, e.g. {".py", ".xsh"}.
+    cwd : str or None, optional
+        Directory in the repository, defaults to the current directory.
+    """
+    root = repo_root(cwd=cwd)
+    tracked, untracked = _changed_files(since, staged, paths, extensions, root)
+    return sorted(tracked | untracked)
+
+
+def parse_diff_ranges(diff, root=""):
+    """Parses the output of 'git diff -U0', returning a dict mapping each
+    changed file, joined to root, to a list of (start, end) line ranges. The
+    ranges are 1-based and inclusive, and refer to the new version of the
+    file. Hunks that only delete lines have no range.
+    """
+    ranges = {}
+    current = None
+    for line in diff.splitlines():
+        if line.startswith("+++ "):
+            name = line[4:]
+            if name == "/dev/null":
+                current = None
+                continue
+            name = unquote_path(name)
+            if name.startswith("b/"):
+                name = name[2:]
+            current = ranges.setdefault(os.path.join(root, name), [])
+            continue
+        m = re_hunk_header.match(line)
+        if m is None or current is None:
+            continue
+        start = int(m.group(1))
+        count = 1 if m.group(2) is None else int(m.group(2))
+        if count:
+            current.append((start, start + count - 1))
+    return ranges
+
+
+def changed_lines(since=None, staged=False, paths=None, extensions=None, cwd=None):
+    """Returns a dict mapping the absolute path of each changed file to a
+    sorted list of its changed (start, end) line ranges, which are 1-based
+    and inclusive. Untracked files map to None, since all of their lines are
+    new. The arguments are as for changed_files().
+    """
+    root = repo_root(cwd=cwd)
+    tracked, untracked = _changed_files(since, staged, paths, extensions, root)
+    args = _diff_args(since, staged) + ["-U0", "--diff-filter=ACMR"]
+    args += ["--src-prefix=a/", "--dst-prefix=b/"]
+    ranges = parse_diff_ranges(git(args + _pathspecs(paths), cwd=root), root=root)
+    lines = dict.fromkeys(untracked)
+    for path in tracked:
+        lines[path] = ranges.get(path, [])
+    return lines
@@ -0,0 +1,758 @@
+"""The coral command line interface."""
+import os
+import sys
+import json
+import argparse
+import functools
+from collections import namedtuple
+
+from coral import __version__
+from coral.cache import Cache, ContentHasher, TreeCache, content_hash, file_hash
+from coral.git import GitError, changed_files, changed_lines
+from coral.output import FSYNC_MODES, AtomicWriter, sync_files, write_atomic
+from coral.parser import LANGS
+from coral.scheduler import Scheduler, WorkerTimeout, largest_first
+from coral.stats import ProfileReport, ReformatStats
+
+
+SOURCE_EXTENSIONS = frozenset([".py", ".xsh"])
+
+# languages that files are parsed as, by extension, see coral.parser.parse()
+LANG_BY_EXTENSION = {".py": "auto", ".xsh": "xonsh"}
+
+REFORMATTED = "reformatted"
+WOULD_REFORMAT = "would reformat"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+TIMED_OUT = "timed out"
+
+
+class FileResult(
+    namedtuple("FileResult", ["path", "status", "message", "digest", "stats"])
+):
+    """The outcome of formatting a single file.
+
+    Attributes
+    ----------
+    path : str
+        The file that was formatted.
+    status : str
+        One of REFORMATTED, WOULD_REFORMAT (when only checking), UNCHANGED,
+        FAILED, or TIMED_OUT (when formatting took longer than the time
+        limit).
+    message : str or None
+        A description of the error, for failed and timed out files.
+    digest : str or None
+        Content hash of the file, for files that were found to be formatted
+        already, None otherwise. The output of the formatter is not known to
+        be formatted until it is checked again, so reformatted files have
+        none either.
+    stats : ReformatStats or None
+        Timings and counts of formatting the file, if they were requested
+        and the file was parsed.
+    """
+
+    __slots__ = ()
+
+
+#
+# File collection
+#
+
+
+def collect_files(paths):
+    """Yields the source files found in a list of file and directory paths.
+    Directories are searched recursively for Python and xonsh files, skipping
+    hidden directories. Files that are named explicitly are always yielded.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for f in sorted(files):
+                if os.path.splitext(f)[1] in SOURCE_EXTENSIONS:
+                    yield os.path.join(root, f)
+
+
+#
+# Workers
+#
+
+
+# content hashes of sources known to be formatted, set per worker process
+_known_hashes = frozenset()
+# the session that formats files in this worker process
+_session = None
+
+
+def _init_worker(known_hashes=frozenset(), trees=None):
+    """Sets up a session, with its xonsh execer, once per worker process."""
+    global _known_hashes, _session
+    from coral.session import CoralSession
+
+    _session = CoralSession(trees=trees)
+    # create the execer up front, rather than while formatting the first file
+    _session.execer
+    _known_hashes = known_hashes
+
+
+class _HashingWriter(object):
+    """Writes text to a file, if one is given, computing its content hash as
+    it goes.
+    """
+
+    def __init__(self, f=None):
+        self.f = f
+        self.hasher = ContentHasher()
+
+    def write(self, s):
+        self.hasher.update(s)
+        if self.f is not None:
+            self.f.write(s)
+
+
+def _stream_file(path, lang, check, fsync=False):
+    """Formats a file one top-level statement at a time, with
+    coral.formatter.reformat_stream(), so that it is never held in memory as
+    a whole. The output is written to a temporary file next to the file,
+    which replaces it if it differs, once it is checked to parse to the same
+    statements as the file, see coral.formatter.check_stream(). When only
+    checking, the output is hashed and never written anywhere.
+    """
+    from coral.formatter import check_stream, reformat_stream
+
+    digest = file_hash(path)
+    if digest in _known_hashes:
+        return FileResult(path, UNCHANGED, None, digest, None)
+    if check:
+        writer = _HashingWriter()
+        with open(path, "r", encoding="utf-8") as f:
+            reformat_stream(f, writer, lang=lang)
+        if writer.hasher.hexdigest() == digest:
+            return FileResult(path, UNCHANGED, None, digest, None)
+        return FileResult(path, WOULD_REFORMAT, None, None, None)
+    with open(path, "r", encoding="utf-8") as f, AtomicWriter(
+        path, fsync=fsync
+    ) as out:
+        writer = _HashingWriter(out)
+        reformat_stream(f, writer, lang=lang)
+        if writer.hasher.hexdigest() == digest:
+            return FileResult(path, UNCHANGED, None, digest, None)
+        out.flush()
+        f.seek(0)
+        with open(out.tmp, "r", encoding="utf-8") as written:
+            check_stream(f, written, lang=lang)
+        out.commit()
+    return FileResult(path, REFORMATTED, None, None, None)
+
+
+def format_file(
+    path,
+    reformat=None,
+    stats=False,
+    profile=False,
+    lang=None,
+    check=False,
+    stream=False,
+    visits=False,
+    fsync=False,
+    lines=None,
+    verify=True,
+):
+    """Reformats a file in-place, returning a FileResult. Files whose content
+    hash is already known to be formatted are skipped without being parsed.
+    Files are only written if their content changes, so that unchanged
+    files keep their modification time, and are then replaced atomically,
+    see coral.output.AtomicWriter. Output that still contains unformatted
+    nodes, or that does not parse to the same tree as the file, is reported
+    as an error rather than written, unless verify is false. Files are read and written as UTF-8.
+    Errors are caught and reported in the result so that a single bad file
+    does not abort the whole run.
+
+    Parameters
+    ----------
+    path : str
+        The file to format.
+    reformat : callable or None, optional
+        Function that formats a source string, defaults to the reformat()
+        method of the session of this worker process.
+    stats : bool, optional
+        Whether to record a ReformatStats for the file. This requires the
+        reformat function to accept a stats keyword argument.
+    profile : bool, optional
+        Whether to also profile each stage, implies stats.
+    lang : str or None, optional
+        Language to parse the file as. If None, this is picked by the
+        extension of the file from LANG_BY_EXTENSION, defaulting to xonsh.
+    check : bool, optional
+        Whether to only check if the file is formatted, without writing it.
+        Files that are not formatted get the WOULD_REFORMAT status.
+    stream : bool, optional
+        Whether to format the file one top-level statement at a time, in
+        bounded memory, for very large files. This ignores the reformat
+        function and does not record stats.
+    visits : bool, optional
+        Whether to count the nodes visited by the formatter, by node type,
+        implies stats.
+    fsync : bool, optional
+        Whether to sync the new content of the file to disk before it
+        replaces the file.
+    lines : list of (int, int) or None, optional
+        If given, only the statements on these ranges of lines are
+        formatted, see coral.formatter.reformat_ranges(), rather than the
+        whole file. This ignores the reformat function and the stats, and
+        the file is not reported as formatted when it is unchanged, since
+        the rest of it may not be.
+    verify : bool, optional
+        Whether to check the output before it is written. This may only be
+        turned off for a reformat function that checks its own output, such
+        as that of a coral server.
+    """
+    if reformat is None:
+        if _session is None:
+            _init_worker(_known_hashes)
+        reformat = _session.reformat
+        is_formatted = _session.is_formatted
+        check_output = _session.check_output
+    else:
+        is_formatted = lambda inp, **kw: reformat(inp, **kw) == inp
+        if verify:
+            from coral.formatter import check_output
+    if lines is not None:
+        from coral.formatter import check_output, reformat_ranges
+
+        # the reformat function is not used, so the output is always checked
+        verify = True
+        reformat = lambda inp, lang, **kw: reformat_ranges(inp, lines, lang=lang)
+        is_formatted = lambda inp, **kw: reformat(inp, **kw) == inp
+    if lang is None:
+        lang = LANG_BY_EXTENSION.get(os.path.splitext(path)[1], "xonsh")
+    if stream:
+        try:
+            return _stream_file(path, lang, check, fsync=fsync)
+        except Exception as e:
+            msg = "{0}: {1}".format(e.__class__.__name__, e)
+            return FileResult(path, FAILED, msg, None, None)
+    s = None
+    if stats or profile or visits:
+        s = ReformatStats(profile=profile, visits=visits)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            inp = f.read()
+        digest = content_hash(inp)
+        if digest in _known_hashes:
+            return FileResult(path, UNCHANGED, None, digest, None)
+        if lines is not None:
+            # only part of the file is looked at
+            digest = None
+        kwargs = {"lang": lang} if s is None else {"lang": lang, "stats": s}
+        if check:
+            if is_formatted(inp, **kwargs):
+                return FileResult(path, UNCHANGED, None, digest, s)
+            return FileResult(path, WOULD_REFORMAT, None, None, s)
+        out = reformat(inp, **kwargs)
+        if out == inp:
+            return FileResult(path, UNCHANGED, None, digest, s)
+        if verify:
+            check_output(inp, out, lang=lang)
+        write_atomic(path, out, fsync=fsync)
+    except Exception as e:
+        msg = "{0}: {1}".format(e.__class__.__name__, e)
+        return FileResult(path, FAILED, msg, None, s)
+    return FileResult(path, REFORMATTED, None, None, s)
+
+
+def run(
+    paths,
+    jobs=None,
+    cache=None,
+    stats=False,
+    profile=False,
+    lang=None,
+    check=False,
+    fail_fast=False,
+    stream=False,
+    split=False,
+    trees=None,
+    visits=False,
+    timeout=None,
+    fsync="none",
+    changed=None,
+):
+    """Formats all files in paths, yielding a FileResult for each one
+    as it completes. With several worker processes, the largest files are
+    started first, see coral.scheduler.
+
+    Parameters
+    ----------
+    paths : iterable of str
+        Files to format.
+    jobs : int or None, optional
+        Number of worker processes to use. If None, this is the number of
+        CPUs on the machine. If 1, files are formatted in this process.
+    cache : Cache or None, optional
+        Cache of formatted content hashes. Files in the cache are skipped,
+        and files that are found to be formatted already are added to it.
+    stats, profile : bool, optional
+        Whether to record stats, and profiles, for each file. See
+        format_file().
+    lang : str or None, optional
+        Language to parse all files as, picked per file if None.
+    check : bool, optional
+        Whether to only check which files would be reformatted, without
+        writing them. Files that are found to be formatted are still added
+        to the cache.
+    fail_fast : bool, optional
+        Whether to stop at the first file that would be reformatted or that
+        failed, once its result has been yielded.
+    stream : bool, optional
+        Whether to format each file one top-level statement at a time, in
+        bounded memory. See format_file().
+    split : bool, optional
+        Whether to format the files one at a time, splitting each one at
+        its top-level statements across all worker processes, see
+        coral.parallel. This is faster for a few very large files.
+    trees : TreeCache or None, optional
+        On-disk cache of commented parse trees, shared by the sessions of
+        the worker processes. Files whose trees are in it are not parsed.
+    visits : bool, optional
+        Whether to count the nodes visited by the formatter in the stats of
+        each file, see format_file().
+    timeout : float or None, optional
+        Time limit for formatting each file, in seconds. The worker process
+        of a file that takes longer is killed and replaced, and the file
+        gets the TIMED_OUT status. Files are always formatted in worker
+        processes when this is given. This does not apply with split.
+    fsync : str, optional
+        When to sync reformatted files to disk, one of FSYNC_MODES: never,
+        each file before it is replaced, or all of them at the end, along
+        with their directories.
+    changed : dict or None, optional
+        Maps files to the ranges of lines to format in them, see the lines
+        argument of format_file(). Files that are not in it, or that map to
+        None, are formatted whole. This does not apply with stream or split.
+    """
+    paths = list(paths)
+    jobs = jobs or os.cpu_count() or 1
+    if not split:
+        jobs = min(jobs, len(paths))
+    known = frozenset() if cache is None else frozenset(cache.hashes)
+    func = format_file
+    options = (stats, profile, lang is not None, check, stream, visits)
+    if any(options) or fsync == "each":
+        func = functools.partial(
+            format_file,
+            stats=stats,
+            profile=profile,
+            lang=lang,
+            check=check,
+            stream=stream,
+            visits=visits,
+            fsync=fsync == "each",
+        )
+    if changed is not None:
+        func = functools.partial(_format_changed, func, changed)
+    scheduler = splitter = None
+    if jobs <= 1 and (timeout is None or split):
+        _init_worker(known, trees)
+        results = map(func, paths)
+    elif split:
+        from coral.parallel import ParallelReformatter
+
+        _init_worker(known, trees)
+        splitter = ParallelReformatter(jobs)
+        func = functools.partial(
+            format_file,
+            reformat=splitter.reformat,
+            lang=lang,
+            check=check,
+            fsync=fsync == "each",
+        )
+        results = map(func, paths)
+    else:
+        scheduler = Scheduler(
+            func,
+            jobs,
+            timeout=timeout,
+            initializer=_init_worker,
+            initargs=(known, trees),
+        )
+        results = _scheduled_results(scheduler, largest_first(paths))
+    written = []
+    try:
+        for result in results:
+            if cache is not None and result.digest is not None:
+                cache.add(result.digest)
+            if result.status == REFORMATTED:
+                written.append(result.path)
+            yield result
+            if fail_fast and result.status != UNCHANGED:
+                break
+    finally:
+        if fsync == "end" and written:
+            sync_files(written)
+        if scheduler is not None:
+            scheduler.close()
+        if splitter is not None:
+            splitter.close()
+        if cache is not None:
+            cache.write()
+
+
+def _format_changed(func, changed, path):
+    """Formats only the changed lines of a file with a format_file()
+    function, given a dict of the changed lines of each file.
+    """
+    return func(path, lines=changed.get(path))
+
+
+def _scheduled_results(scheduler, paths):
+    """Yields the FileResult of each file formatted by a scheduler, reporting
+    the files whose worker was lost as timed out or failed.
+    """
+    for task in scheduler.imap(paths):
+        if task.ok:
+            yield task.value
+        elif isinstance(task.error, WorkerTimeout):
+            yield FileResult(task.item, TIMED_OUT, str(task.error), None, None)
+        else:
+            msg = "{0}: {1}".format(task.error.__class__.__name__, task.error)
+            yield FileResult(task.item, FAILED, msg, None, None)
+
+
+def run_client(
+    paths, address=None, lang=None, check=False, fail_fast=False, fsync="none"
+):
+    """Formats all files in paths by sending them to a coral server,
+    yielding a FileResult for each one. Caching, and checking the output, is
+    left to the server. The
+    check, fail_fast and fsync arguments are as for run().
+    """
+    from coral.daemon import Client
+
+    written = []
+    try:
+        with Client(address) as client:
+            for path in paths:
+                result = format_file(
+                    path,
+                    reformat=client.reformat,
+                    lang=lang,
+                    check=check,
+                    fsync=fsync == "each",
+                    # the server checks the output that it sends back
+                    verify=False,
+                )
+                if result.status == REFORMATTED:
+                    written.append(result.path)
+                yield result
+                if fail_fast and result.status != UNCHANGED:
+                    break
+    finally:
+        if fsync == "end" and written:
+            sync_files(written)
+
+
+#
+# Command line
+#
+
+
+def _plural(n, word):
+    return "{0} {1}{2}".format(n, word, "" if n == 1 else "s")
+
+
+def summarize(results, check=False):
+    """Returns a one-line summary of a list of results. If check is true,
+    the files were only checked, so the summary tells what would have been
+    done to them.
+    """
+    counts = {
+        REFORMATTED: 0,
+        WOULD_REFORMAT: 0,
+        UNCHANGED: 0,
+        FAILED: 0,
+        TIMED_OUT: 0,
+    }
+    for result in results:
+        counts[result.status] += 1
+    if check or counts[WOULD_REFORMAT]:
+        parts = [
+            _plural(counts[WOULD_REFORMAT], "file") + " would be reformatted",
+            _plural(counts[UNCHANGED], "file") + " would be left unchanged",
+        ]
+    else:
+        parts = [
+            _plural(counts[REFORMATTED], "file") + " reformatted",
+            _plural(counts[UNCHANGED], "file") + " left unchanged",
+        ]
+    if counts[FAILED]:
+        parts.append(_plural(counts[FAILED], "file") + " failed to reformat")
+    if counts[TIMED_OUT]:
+        parts.append(_plural(counts[TIMED_OUT], "file") + " timed out")
+    return ", ".join(parts)
+
+
+def make_parser():
+    """Returns the argument parser for the coral command."""
+    p = argparse.ArgumentParser(
+        prog="coral",
+        description="The animating and life-affirming code formatter for "
+        "Xonsh & Python",
+    )
+    p.add_argument("paths", nargs="*", help="files and directories to format")
+    p.add_argument(
+        "--changed-since",
+        metavar="REF",
+        default=None,
+        help="only format the files that changed in the local git repository "
+        "since REF, including untracked files",
+    )
+    p.add_argument(
+        "--staged",
+        action="store_true",
+        help="only format the files with changes staged in the local git "
+        "repository, for use in pre-commit hooks; the files are formatted in "
+        "the working tree, and the changes are not staged",
+    )
+    p.add_argument(
+        "--changed-lines",
+        action="store_true",
+        help="with --changed-since or --staged, only format the statements "
+        "on the lines that changed, rather than the whole files",
+    )
+    p.add_argument(
+        "--check",
+        action="store_true",
+        help="do not write files, only report the files that would be "
+        "reformatted, exiting with 1 if there are any",
+    )
+    p.add_argument(
+        "--fail-fast",
+        action="store_true",
+        help="with --check, stop at the first file that would be reformatted "
+        "or that failed",
+    )
+    p.add_argument(
+        "--stream",
+        action="store_true",
+        help="format each file one top-level statement at a time, so that "
+        "memory use tracks the largest statement rather than the whole file",
+    )
+    p.add_argument(
+        "--split",
+        action="store_true",
+        help="format files one at a time, splitting each one at its top-level "
+        "statements across all jobs, for a few very large files",
+    )
+    p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of worker processes, defaults to the number of CPUs",
+    )
+    p.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="time limit for formatting each file, after which its worker "
+        "process is restarted and the file is reported as timed out",
+    )
+    p.add_argument(
+        "--fsync",
+        choices=FSYNC_MODES,
+        default="none",
+        help="sync reformatted files to disk: never, each before it replaces "
+        "the file, or all at the end of the run",
+    )
+    p.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="do not skip files that are known to be formatted",
+    )
+    p.add_argument(
+        "--tree-cache",
+        action="store_true",
+        help="keep the parse trees of files in an on-disk cache, so that "
+        "files that are parsed again, such as unformatted files checked "
+        "repeatedly, are read from there",
+    )
+    p.add_argument(
+        "--daemon",
+        action="store_true",
+        help="run a coral server that formats files for clients",
+    )
+    p.add_argument(
+        "--client",
+        action="store_true",
+        help="send files to a running coral server to be formatted",
+    )
+    p.add_argument(
+        "--address",
+        default=None,
+        help="Unix socket path or host:port of the coral server",
+    )
+    p.add_argument(
+        "--lang",
+        choices=LANGS,
+        default=None,
+        help="language to parse files as, defaults to auto for .py files, "
+        "which uses the faster CPython parser where possible, and xonsh "
+        "for other files",
+    )
+    p.add_argument(
+        "--profile",
+        action="store_true",
+        help="report the time spent in each stage and the slowest files",
+    )
+    p.add_argument(
+        "--profile-dir",
+        default=None,
+        help="also profile each stage, writing <stage>.pstats files to "
+        "this directory, implies --profile",
+    )
+    p.add_argument(
+        "--visit-stats",
+        default=None,
+        metavar="FILE",
+        help="write the number of visits, time and fallbacks of the formatter "
+        "for each node type to this JSON file",
+    )
+    p.add_argument(
+        "-q", "--quiet", action="store_true", help="only report errors"
+    )
+    p.add_argument("--version", action="version", version="coral " + __version__)
+    return p
+
+
+def main(args=None):
+    """Main entry point for the coral command. Returns the exit code, which
+    is non-zero if any file failed to be formatted or timed out, or, with
+    --check, if any file would be reformatted.
+    """
+    parser = make_parser()
+    ns = parser.parse_args(args)
+    if ns.daemon:
+        from coral.daemon import serve
+
+        serve(address=ns.address, jobs=ns.jobs, cache=ns.cache)
+        return 0
+    changed = ns.changed_since is not None or ns.staged
+    if not ns.paths and not changed:
+        parser.print_usage(sys.stderr)
+        return 0
+    if ns.jobs is not None and ns.jobs < 1:
+        parser.error("--jobs must be a positive integer")
+    profile = ns.profile or ns.profile_dir is not None
+    if ns.client and profile:
+        parser.error("--profile cannot be used with --client")
+    visits = ns.visit_stats is not None
+    if visits and (ns.client or ns.stream or ns.split):
+        parser.error("--visit-stats cannot be used with --client, --stream or --split")
+    if ns.stream and (ns.client or profile):
+        parser.error("--stream cannot be used with --client or --profile")
+    if ns.split and (ns.client or profile or ns.stream):
+        parser.error("--split cannot be used with --client, --profile or --stream")
+    if ns.tree_cache and ns.client:
+        parser.error("--tree-cache cannot be used with --client")
+    if ns.timeout is not None and ns.timeout <= 0:
+        parser.error("--timeout must be positive")
+    if ns.timeout is not None and (ns.client or ns.split):
+        parser.error("--timeout cannot be used with --client or --split")
+    if ns.fail_fast and not ns.check:
+        parser.error("--fail-fast requires --check")
+    if ns.changed_since is not None and ns.staged:
+        parser.error("--changed-since cannot be used with --staged")
+    if ns.changed_lines and not changed:
+        parser.error("--changed-lines requires --changed-since or --staged")
+    if ns.changed_lines and (ns.client or profile or visits or ns.stream or ns.split):
+        parser.error(
+            "--changed-lines cannot be used with --client, --profile, "
+            "--visit-stats, --stream or --split"
+        )
+    lines = None
+    if changed:
+        try:
+            files = changed_files(
+                since=ns.changed_since,
+                staged=ns.staged,
+                paths=ns.paths,
+                extensions=SOURCE_EXTENSIONS,
+            )
+            if ns.changed_lines and files:
+                # staged files are formatted in the working tree, so their
+                # lines are found there
+                since = "HEAD" if ns.staged else ns.changed_since
+                lines = changed_lines(
+                    since=since, paths=files, extensions=SOURCE_EXTENSIONS
+                )
+        except GitError as e:
+            print("error: " + str(e), file=sys.stderr)
+            return 1
+    else:
+        files = collect_files(ns.paths)
+    if ns.client:
+        results_iter = run_client(
+            files,
+            address=ns.address,
+            lang=ns.lang,
+            check=ns.check,
+            fail_fast=ns.fail_fast,
+            fsync=ns.fsync,
+        )
+    else:
+        cache = Cache() if ns.cache else None
+        results_iter = run(
+            files,
+            jobs=ns.jobs,
+            cache=cache,
+            stats=profile,
+            profile=ns.profile_dir is not None,
+            visits=visits,
+            lang=ns.lang,
+            check=ns.check,
+            fail_fast=ns.fail_fast,
+            stream=ns.stream,
+            split=ns.split,
+            trees=TreeCache() if ns.tree_cache else None,
+            timeout=ns.timeout,
+            fsync=ns.fsync,
+            changed=lines,
+        )
+    results = []
+    for result in results_iter:
+        results.append(result)
+        if result.status == FAILED:
+            msg = "error: cannot format {0}: {1}".format(result.path, result.message)
+            print(msg, file=sys.stderr)
+        elif result.status == TIMED_OUT:
+            msg = "error: {0} {1}".format(result.path, result.message)
+            print(msg, file=sys.stderr)
+        elif result.status == WOULD_REFORMAT:
+            print("would reformat " + result.path, file=sys.stderr)
+        elif result.status == REFORMATTED and not ns.quiet:
+            print("reformatted " + result.path, file=sys.stderr)
+    if not ns.quiet:
+        print(summarize(results, check=ns.check), file=sys.stderr)
+    if profile or visits:
+        report = ProfileReport()
+        for result in results:
+            if result.stats is not None:
+                report.add(result.path, result.stats)
+    if profile:
+        print(report.format(), file=sys.stderr)
+        if ns.profile_dir is not None:
+            for filename in report.dump(ns.profile_dir):
+                print("wrote " + filename, file=sys.stderr)
+    if visits:
+        with open(ns.visit_stats, "w") as f:
+            json.dump(report.visits.as_dict(), f, indent=1)
+        if not ns.quiet:
+            print("wrote " + ns.visit_stats, file=sys.stderr)
+    errors = (FAILED, TIMED_OUT, WOULD_REFORMAT)
+    return 1 if any(r.status in errors for r in results) else 0
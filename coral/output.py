@@ -0,0 +1,114 @@
+"""Writing formatted files back to disk."""
+import os
+import shutil
+import tempfile
+
+
+# when files are synced to disk: never, each before it replaces the file,
+# or all of them at the end of the run
+FSYNC_MODES = ("none", "each", "end")
+
+
+def fsync_dir(path):
+    """Syncs a directory to disk, so that the files that were renamed into
+    it stay there. This does nothing where directories cannot be opened,
+    such as on Windows.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # some file systems cannot sync directories
+        pass
+    finally:
+        os.close(fd)
+
+
+class AtomicWriter(object):
+    """Writes text to a temporary file next to a file, which replaces the
+    file when it is committed, so that readers never see a partly written
+    file. The mode of the file is kept, and symbolic links to it are
+    followed rather than replaced. The temporary file is removed if the
+    writer is closed without being committed, or if an error is raised in
+    its with block.
+    """
+
+    def __init__(self, path, fsync=False):
+        """Parameters
+        ----------
+        path : str
+            The file to replace.
+        fsync : bool, optional
+            Whether to sync the new content to disk before replacing the
+            file, and the directory of the file after it.
+        """
+        self.path = os.path.realpath(path)
+        self.fsync = fsync
+        d = os.path.dirname(self.path)
+        fd, self.tmp = tempfile.mkstemp(dir=d, prefix=".coral-")
+        self.file = os.fdopen(fd, "w", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, s):
+        self.file.write(s)
+
+    def flush(self):
+        """Flushes what has been written to the temporary file."""
+        self.file.flush()
+
+    def commit(self):
+        """Replaces the file with what has been written."""
+        f = self.file
+        if self.fsync:
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+        if os.path.exists(self.path):
+            shutil.copymode(self.path, self.tmp)
+        os.replace(self.tmp, self.path)
+        self.tmp = None
+        if self.fsync:
+            fsync_dir(os.path.dirname(self.path))
+
+    def close(self):
+        """Removes the temporary file, unless it has been committed."""
+        if self.tmp is None:
+            return
+        self.file.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+        self.tmp = None
+
+
+def write_atomic(path, s, fsync=False):
+    """Replaces a file with a string, atomically, see AtomicWriter."""
+    with AtomicWriter(path, fsync=fsync) as writer:
+        writer.write(s)
+        writer.commit()
+
+
+def sync_files(paths):
+    """Syncs written files to disk, with the directories that they were
+    replaced in, each directory once.
+    """
+    dirs = set()
+    for path in paths:
+        path = os.path.realpath(path)
+        try:
+            with open(path, "ab") as f:
+                os.fsync(f.fileno())
+        except OSError:
+            pass
+        dirs.add(os.path.dirname(path))
+    for d in sorted(dirs):
+        fsync_dir(d)
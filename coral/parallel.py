@@ -0,0 +1,155 @@
+"""Reformatting a single large source with several processes."""
+import io
+import os
+import builtins
+import multiprocessing
+from ast import PyCF_ONLY_AST
+
+from coral.formatter import chunk_statements, format_body, reformat
+from coral.parser import ModuleNames, parse, top_level_chunks
+
+
+def split_source(source):
+    """Returns the list of the top-level chunks of a source string, see
+    coral.parser.top_level_chunks().
+    """
+    return list(top_level_chunks(io.StringIO(source).readline))
+
+
+def batch_chunks(chunks, n):
+    """Splits a list of chunks into at most n contiguous runs of about the
+    same total size, returning a list of lists of chunks.
+    """
+    target = sum(len(chunk) for chunk in chunks) / n
+    batches = []
+    batch = []
+    size = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        size += len(chunk)
+        if size >= target and len(batches) < n - 1:
+            batches.append(batch)
+            batch = []
+            size = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _prepare_batches(batches, debug_level, lang):
+    """Returns a task for each batch of chunks, holding the context that
+    the batch starts with. This needs the names that each chunk defines,
+    which are found with the CPython parser. Chunks that it cannot read are
+    parsed here, with the xonsh parser, and passed on already parsed, since
+    the chunks after them could not be parsed without them.
+    """
+    names = set(builtins.__dict__)
+    tasks = []
+    for batch in batches:
+        if lang == "python":
+            tasks.append((batch, None, lang, debug_level))
+            continue
+        ctx = frozenset(names)
+        items = []
+        for chunk in batch:
+            try:
+                tree = compile(chunk, "<code>", "exec", PyCF_ONLY_AST, dont_inherit=True)
+            except (SyntaxError, ValueError, MemoryError):
+                parsed = parse(
+                    chunk, ctx=set(names), debug_level=debug_level, lang=lang
+                )
+                tree = parsed[0]
+                items.append(parsed)
+            else:
+                items.append(chunk)
+            if tree is not None:
+                ModuleNames(names).visit(tree)
+        tasks.append((items, ctx, lang, debug_level))
+    return tasks
+
+
+def format_batch(task):
+    """Parses, comments and formats a batch of chunks, returning the result
+    of format_body() for their statements. This runs in the worker
+    processes.
+    """
+    items, ctx, lang, debug_level = task
+    stmts = chunk_statements(items, debug_level=debug_level, lang=lang, ctx=ctx)
+    return format_body(stmts)
+
+
+def join_results(results):
+    """Stitches the formatted batches of a module back together."""
+    out = "\n".join(result for result in results if result)
+    if not out.endswith("\n"):
+        out += "\n"
+    return out
+
+
+class ParallelReformatter(object):
+    """Reformats sources by splitting them at top-level statements and
+    formatting the pieces in a pool of worker processes, so that a single
+    large source may use several cores. The output is the same as that of
+    coral.formatter.reformat(), since each piece gets the same comments as
+    in the whole source. Sources that fail to format, and xonsh code that
+    does not end with a newline, are formatted again in this process, so
+    that they raise the same error as coral.formatter.reformat(). Each
+    piece is parsed with the names that the code before it defines in the
+    context, as with range formatting.
+    """
+
+    def __init__(self, jobs=None, debug_level=0, min_chunks=2):
+        """Parameters
+        ----------
+        jobs : int or None, optional
+            Number of worker processes, defaults to the number of CPUs.
+        debug_level : int, optional
+            Debugging level passed down to yacc.
+        min_chunks : int, optional
+            Sources with fewer top-level statements than this are formatted
+            in this process.
+        """
+        self.jobs = jobs or os.cpu_count() or 1
+        self.debug_level = debug_level
+        self.min_chunks = max(min_chunks, 2)
+        self.pool = multiprocessing.Pool(self.jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def reformat(self, source, lang="xonsh"):
+        """Returns the formatted version of a source string."""
+        chunks = split_source(source)
+        if len(chunks) < self.min_chunks or (
+            lang != "python" and not source.endswith("\n")
+        ):
+            # the xonsh parser reads unterminated code differently, depending
+            # on all of it
+            return reformat(source, debug_level=self.debug_level, lang=lang)
+        # a few batches per worker, to even out the load
+        batches = batch_chunks(chunks, 4 * self.jobs)
+        del chunks
+        try:
+            tasks = _prepare_batches(batches, self.debug_level, lang)
+            results = self.pool.map(format_batch, tasks, chunksize=1)
+        except Exception:
+            # the pieces fail in whatever order they are formatted in, rather
+            # than at the first statement that fails
+            return reformat(source, debug_level=self.debug_level, lang=lang)
+        return join_results(results)
+
+    def close(self):
+        """Shuts down the worker processes."""
+        self.pool.terminate()
+        self.pool.join()
+
+
+def reformat_parallel(source, jobs=None, debug_level=0, lang="xonsh"):
+    """Reformats xonsh code (str) into a nice string, formatting its
+    top-level statements in several processes. See ParallelReformatter.
+    """
+    with ParallelReformatter(jobs=jobs, debug_level=debug_level) as reformatter:
+        return reformatter.reformat(source, lang=lang)
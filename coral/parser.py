@@ -1,26 +1,106 @@
 """A custom parser and AST for analyzing xonsh code."""
+import io
 import os
 import re
+import sys
+import types
+import bisect
+import pickle
+import keyword
 import builtins
-from ast import AST, NodeTransformer, Module, If
+import tempfile
+import tokenize
+import threading
+from array import array
+from collections.abc import Mapping, Sequence
+from ast import (
+    AST,
+    NodeVisitor,
+    NodeTransformer,
+    Module,
+    Expression,
+    If,
+    While,
+    Expr,
+    Name,
+    List,
+    Tuple,
+    Assign,
+    AugAssign,
+    AnnAssign,
+    AsyncFor,
+    AsyncWith,
+    AsyncFunctionDef,
+    UnaryOp,
+    Not,
+    IfExp,
+    BoolOp,
+    Compare,
+    BinOp,
+    Add,
+    Sub,
+    Mult,
+    MatMult,
+    Div,
+    Mod,
+    FloorDiv,
+    LShift,
+    RShift,
+    BitAnd,
+    BitXor,
+    BitOr,
+    PyCF_ONLY_AST,
+    stmt,
+    walk,
+)
 from contextlib import contextmanager
 
-from xonsh import lexer
-from xonsh.ply.ply.lex import LexToken
-from xonsh.tokenize import NL, COMMENT, ENCODING, ENDMARKER
-from xonsh.execer import Execer
-
 from lazyasd import lazyobject
 
+from coral.cache import cache_dir, version_key
+from coral.visitor import DispatchVisitor
+
+
+@lazyobject
+def lexer():
+    import xonsh.lexer
+
+    return xonsh.lexer
+
 
 #
 # AST Nodes
 #
 
 
-class Comment(AST):
+class SlotsNode(AST):
+    """Base class for coral nodes, which keep their fields and attributes in
+    slots rather than in an instance dict, since there is one node for every
+    comment in a source. Subclasses list their fields and attributes in
+    __slots__.
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        return {
+            name: getattr(self, name)
+            for name in self.__slots__
+            if hasattr(self, name)
+        }
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __reduce__(self):
+        return (self.__class__, (), self.__getstate__())
+
+
+class Comment(SlotsNode):
+    __slots__ = ("s", "lineno", "col_offset")
     _attributes = ("lineno", "col_offset")
-    _fields = "s"
+    _fields = ("s",)
 
     def __eq__(self, other):
         return (
@@ -35,7 +115,8 @@ class Comment(AST):
         )
 
 
-class NodeWithComment(AST):
+class NodeWithComment(SlotsNode):
+    __slots__ = ("node", "comment", "lineno", "col_offset")
     _attributes = ("lineno", "col_offset")
     _fields = ("node", "comment")
 
@@ -53,7 +134,8 @@ class NodeWithComment(AST):
         )
 
 
-class IfWithComments(AST):
+class IfWithComments(SlotsNode):
+    __slots__ = ("node", "comment", "elsecomment", "lineno", "col_offset")
     _attributes = ("lineno", "col_offset")
     _fields = ("node", "comment", "elsecomment")
 
@@ -61,7 +143,7 @@ class IfWithComments(AST):
         return (
             self.node == other.node
             and self.comment == other.comment
-            and self.elsecomment == other.elseomment
+            and self.elsecomment == other.elsecomment
             and self.lineno == other.lineno
             and self.col_offset == other.col_offset
         )
@@ -72,46 +154,404 @@ class IfWithComments(AST):
         )
 
 
+#
+# Comment storage
+#
+
+
+class LineIndex(object):
+    """Finds the lines of a source string, or bytes, by their 1-based
+    number. The offsets at which the lines start are found on first use, and
+    kept in an array.
+    """
+
+    __slots__ = ("source", "_starts")
+
+    def __init__(self, source):
+        self.source = source
+        self._starts = None
+
+    @property
+    def starts(self):
+        """Array of the offsets at which each line starts."""
+        if self._starts is None:
+            starts = array("l", [0])
+            find = self.source.find
+            nl = "\n" if isinstance(self.source, str) else b"\n"
+            i = find(nl)
+            while i >= 0:
+                starts.append(i + 1)
+                i = find(nl, i + 1)
+            self._starts = starts
+        return self._starts
+
+    def offset(self, lineno, col_offset):
+        """Returns the offset in the source of a line and column, or -1 if
+        the line does not exist.
+        """
+        starts = self.starts
+        if not 0 < lineno <= len(starts):
+            return -1
+        return starts[lineno - 1] + col_offset
+
+    def line(self, lineno):
+        """Returns a line of the source, including its newline, or an empty
+        string if the line does not exist.
+        """
+        starts = self.starts
+        if not 0 < lineno <= len(starts):
+            return ""
+        end = starts[lineno] if lineno < len(starts) else len(self.source)
+        return self.source[starts[lineno - 1] : end]
+
+
+class CommentStore(Sequence):
+    """The comments found in a source, kept in parallel arrays of line
+    numbers, columns, and offsets into the source, rather than as one node
+    per comment. Indexing creates a Comment node. Comments whose text is not
+    found verbatim in the source, such as those of lines that xonsh rewrote
+    as subprocess calls, keep their text separately.
+    """
+
+    def __init__(self, source=None):
+        """Parameters
+        ----------
+        source : str or None, optional
+            The source the comments are found in. If None, the text of all
+            comments, and the lines that they are on, are kept separately.
+        """
+        self.index = LineIndex(source or "")
+        self.source = source
+        self.linenos = array("l")
+        self.col_offsets = array("l")
+        # offsets into the source, or for comments not found there, -1 minus
+        # their index in extra
+        self.offsets = array("l")
+        self.lengths = array("l")
+        self.extra = []
+        self._lines = {}
+
+    def append(self, s, lineno, col_offset, line=None):
+        """Adds a comment, given its text and position. The line that it is
+        on is only kept if the source was not given.
+        """
+        offset = self.index.offset(lineno, col_offset)
+        if offset < 0 or not self.index.source.startswith(s, offset):
+            offset = -1 - len(self.extra)
+            self.extra.append(s)
+        self.linenos.append(lineno)
+        self.col_offsets.append(col_offset)
+        self.offsets.append(offset)
+        self.lengths.append(len(s))
+        if self.source is None and line is not None:
+            self._lines[lineno] = line
+
+    def __len__(self):
+        return len(self.linenos)
+
+    def text(self, i):
+        """Returns the text of the i-th comment."""
+        offset = self.offsets[i]
+        if offset < 0:
+            return self.extra[-1 - offset]
+        return self.index.source[offset : offset + self.lengths[i]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Comment(
+                s=self.text(i),
+                lineno=self.linenos[i],
+                col_offset=self.col_offsets[i],
+            )
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return Comment(
+            s=self.text(i), lineno=self.linenos[i], col_offset=self.col_offsets[i]
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "CommentStore({0!r})".format(list(self))
+
+    def lines(self):
+        """Returns a mapping of the line numbers of the comments to the
+        lines that they are on.
+        """
+        return CommentLines(self)
+
+
+class CommentLines(Mapping):
+    """Read-only mapping of the line numbers of the comments in a
+    CommentStore to the lines that they are on. Lines are sliced from the
+    source as they are looked up.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._keys = None
+        self._size = -1
+
+    def _keys_dict(self):
+        store = self.store
+        if self._size != len(store):
+            # comments may still be added while parsing
+            self._keys = dict.fromkeys(store.linenos)
+            self._size = len(store)
+        return self._keys
+
+    def __getitem__(self, lineno):
+        if lineno not in self._keys_dict():
+            raise KeyError(lineno)
+        store = self.store
+        if store.source is None:
+            return store._lines[lineno]
+        return store.index.line(lineno)
+
+    def __iter__(self):
+        return iter(self._keys_dict())
+
+    def __len__(self):
+        return len(self._keys_dict())
+
+    def __repr__(self):
+        return "CommentLines({0!r})".format(dict(self))
+
+
+#
+# Parser tables
+#
+
+TABLE_FILE = "parser_table.pickle"
+TABLE_ATTRS = (
+    "_tabversion",
+    "_lr_method",
+    "_lr_signature",
+    "_lr_action",
+    "_lr_goto",
+    "_lr_productions",
+)
+_table = None
+_table_lock = threading.Lock()
+
+
+def table_key():
+    """Returns a string naming the coral, xonsh, and Python versions that a
+    parser table is built for.
+    """
+    return version_key()
+
+
+def table_dir():
+    """Returns the directory in the user cache that holds the parser table
+    for the current versions.
+    """
+    return os.path.join(cache_dir(), "tables", table_key())
+
+
+def read_table(filename):
+    """Reads a pickled parser table, returning it as a module object that
+    PLY can use in place of a table module. None is returned if the table
+    cannot be read or was built for other versions.
+    """
+    try:
+        with open(filename, "rb") as f:
+            attrs = pickle.load(f)
+    except Exception:
+        return None
+    if attrs.pop("key", None) != table_key():
+        return None
+    table = types.ModuleType("coral_parser_table")
+    table.__dict__.update(attrs)
+    return table
+
+
+def write_table(table, filename):
+    """Pickles a parser table module to a file, atomically."""
+    attrs = {name: getattr(table, name) for name in TABLE_ATTRS}
+    attrs["key"] = table_key()
+    d = os.path.dirname(filename)
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=d, prefix=".table-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(attrs, f, protocol=4)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def build_table():
+    """Builds a parser table for the current xonsh grammar, returning it as a
+    module. The table that ships with xonsh is used if it matches the
+    grammar, otherwise yacc generates a new one, which takes a few seconds.
+    """
+    from xonsh.parser import Parser as XonshParser
+
+    with tempfile.TemporaryDirectory() as d:
+        parser = XonshParser(
+            yacc_table="xonsh.parser_table", yacc_optimize=False, outputdir=d
+        )
+        parser.parse("pass\n")
+        generated = os.path.join(d, "parser_table.py")
+        if not os.path.isfile(generated):
+            return sys.modules["xonsh.parser_table"]
+        with open(generated, "r") as f:
+            code = compile(f.read(), generated, "exec")
+    table = types.ModuleType("coral_parser_table")
+    exec(code, table.__dict__)
+    return table
+
+
+def load_table():
+    """Returns the parser table used by coral's parsers. This is, in order of
+    preference, the table shipped with coral, the table in the user cache
+    for this version, or a newly built table, which is then stored in the
+    user cache. Pickled tables load far faster than yacc table modules.
+    """
+    global _table
+    with _table_lock:
+        if _table is not None:
+            return _table
+        here = os.path.dirname(os.path.abspath(__file__))
+        cached = os.path.join(table_dir(), TABLE_FILE)
+        table = read_table(os.path.join(here, TABLE_FILE)) or read_table(cached)
+        if table is None:
+            table = build_table()
+            try:
+                write_table(table, cached)
+            except OSError:
+                pass
+        _table = table
+    return _table
+
+
+def Parser(**kwargs):
+    """Returns a new xonsh parser that uses coral's parser table. Keyword
+    arguments are passed to the xonsh parser. Since the grammar signature is
+    checked when the table is loaded, a stale table is never used, yacc
+    regenerates the table instead.
+    """
+    from xonsh.parser import Parser as XonshParser
+
+    if "yacc_table" not in kwargs:
+        kwargs["yacc_table"] = load_table()
+    kwargs.setdefault("yacc_optimize", False)
+    return XonshParser(**kwargs)
+
+
 #
 # Execution tools
 #
 
 
+# per-thread parsing state: the execer and the active comment collector
+_local = threading.local()
+_handler_lock = threading.RLock()
+_default_comment_handler = None
+
+
+def make_execer(filename="<code>", debug_level=0):
+    """Returns a new execer that is only capable of parsing. Unlike a normal
+    xonsh execer, this does not load the xonsh builtins, so it does not
+    require a xonsh session and may be created in any thread. Since
+    Execer.__init__() always loads the builtins, it is not called, and the
+    attributes that it sets in the versions of xonsh that setup.py allows
+    are set here instead. The tests check them against the installed xonsh.
+    """
+    from xonsh.ast import CtxAwareTransformer
+    from xonsh.execer import Execer
+
+    execer = Execer.__new__(Execer)
+    execer.parser = Parser()
+    execer.filename = execer._default_filename = filename
+    execer.debug_level = debug_level
+    # keeps the execer from unloading the builtins when it is deleted
+    execer.unload = False
+    execer.scriptcache = False
+    execer.cacheall = False
+    execer.ctxtransformer = CtxAwareTransformer(execer.parser)
+    return execer
+
+
+def thread_execer():
+    """Returns the execer for the current thread. Each thread gets its own
+    execer, since xonsh parsers hold the state of the parse in progress.
+    """
+    execer = getattr(_local, "execer", None)
+    if execer is None:
+        execer = _local.execer = make_execer()
+    return execer
+
+
+def handle_comment(state, token):
+    """Lexer handler for comment tokens. Comments are recorded by the
+    collector that is active in the current thread, if any. Otherwise, this
+    defers to the normal xonsh handling of comments.
+    """
+    collector = getattr(_local, "collector", None)
+    if collector is None:
+        yield from _default_comment_handler(state, token)
+        return
+    lineno, col_offset = token.start
+    collector.append(token.string, lineno, col_offset, token.line)
+
+
+def install_comment_handler():
+    """Installs handle_comment() into the xonsh lexer, once per process."""
+    global _default_comment_handler
+    if _default_comment_handler is not None:
+        return
+    from xonsh.tokenize import COMMENT
+
+    with _handler_lock:
+        if _default_comment_handler is None:
+            _default_comment_handler = lexer.special_handlers[COMMENT]
+            lexer.special_handlers[COMMENT] = handle_comment
+
+
 @contextmanager
-def swapexec(debug_level):
-    """Performs some global lexer context switching"""
-    execer = builtins.__xonsh__.execer
+def swapexec(debug_level, execer=None, source=None):
+    """Sets up the execer and comment collector of the current thread for
+    parsing. This does not modify state shared between threads, so parsing
+    may happen concurrently in several threads. The previous state is
+    restored on exit, even if parsing fails. An execer other than the one of
+    the current thread may be given, as long as no other thread uses it.
+    Comments are collected in a CommentStore of the source, if given.
+    """
+    execer = thread_execer() if execer is None else execer
+    install_comment_handler()
+    comments = CommentStore(source)
+    lines = comments.lines()
     orig_debug_level, execer.debug_level = execer.debug_level, debug_level
-    lines = {}
-    comments = []
-
-    def handle_comment(state, token):
-        comment = Comment(
-            s=token.string, lineno=token.start[0], col_offset=token.start[1]
-        )
-        lines[token.start[0]] = token.line
-        comments.append(comment)
-        yield from []
-
-    shold = lexer.special_handlers.copy()
-    shnew = {
-        # NL: handle_nl,
-        COMMENT: handle_comment,
-        # ENCODING: handle_indentity,
-        # ENDMARKER: handle_indentity,
-    }
-    lexer.special_handlers.update(shnew)
-    yield (execer, comments, lines)
-    execer.debug_level = orig_debug_level
-    lexer.special_handlers.clear()
-    lexer.special_handlers.update(shold)
+    orig_collector = getattr(_local, "collector", None)
+    _local.collector = comments
+    try:
+        yield (execer, comments, lines)
+    finally:
+        execer.debug_level = orig_debug_level
+        _local.collector = orig_collector
 
 
 #
 # Parser tools
 #
 
-def parse(s, ctx=None, filename="<code>", mode="exec", debug_level=0):
+LANGS = ("xonsh", "python", "auto")
+
+
+def parse(
+    s, ctx=None, filename="<code>", mode="exec", debug_level=0, lang="xonsh", execer=None
+):
     """Returns an abstract syntax tree of xonsh code. Unlike the
     normal xonsh parser, this also returns additional information about
     the file being parsed.
@@ -128,23 +568,562 @@ def parse(s, ctx=None, filename="<code>", mode="exec", debug_level=0):
         Execution mode, one of: exec, eval, or single.
     debug_level : str, optional
         Debugging level passed down to yacc.
+    lang : str, optional
+        Language of the code, one of: xonsh, python, or auto. Python code
+        is parsed with the much faster CPython parser, and is not checked
+        for subprocess lines. In auto mode, code is parsed with the CPython
+        parser and then transformed like xonsh would, and code that CPython
+        cannot parse falls back to the xonsh parser. This produces the same
+        tree as the xonsh parser, as far as the formatter is concerned.
+    execer : Execer, optional
+        Execer to parse with, defaults to the execer of the current thread.
 
     Returns
     -------
     tree : AST
         Normal xonsh AST, as returned by the xonsh parser
-    lines : dict
-        Maps line numbers to string lines
-    comments : list of Comment
-        A list of xonsh comment instances.
+    comments : CommentStore
+        The comments in the code, a sequence of Comment nodes.
+    lines : mapping
+        Maps the line numbers of the comments to the lines that they are on.
     """
+    if lang not in LANGS:
+        raise ValueError("lang must be one of {0}, not {1!r}".format(LANGS, lang))
     if ctx is None:
         ctx = set(__builtins__.keys())
-    with swapexec(debug_level) as (execer, comments, lines):
+    if lang == "python":
+        return parse_python(s, filename=filename, mode=mode)
+    elif lang == "auto" and mode == "exec" and s.endswith("\n"):
+        # the xonsh parser reads unterminated input as an expression, so only
+        # terminated code gives the same tree from both parsers
+        try:
+            return parse_python(
+                s, ctx=ctx, filename=filename, mode=mode, execer=execer
+            )
+        except (SyntaxError, MemoryError):
+            # CPython raises a MemoryError for very deeply nested code
+            pass
+    with swapexec(debug_level, execer=execer, source=s) as (execer, comments, lines):
         tree = execer.parse(s, ctx, filename=filename, mode=mode)
+    tree = match_while_starts(tree, s)
+    return tree, comments, lines
+
+
+@lazyobject
+def re_while():
+    return re.compile(r"\s*while\b")
+
+
+def match_while_starts(tree, s):
+    """Moves the while loops of a tree parsed by xonsh to the start of the
+    loop, where CPython puts them. The xonsh parser puts a loop where it
+    finishes reading it, at the statement after it, which would attach the
+    comments around the loop by the code that follows it. The start is the
+    line of the loop test, or the line before it that begins with "while",
+    for a test in parentheses.
+    """
+    if tree is None:
+        return tree
+    lines = None
+    for node in walk(tree):
+        if not isinstance(node, While):
+            continue
+        if lines is None:
+            lines = s.splitlines()
+        row = node.test.lineno
+        while row > 1 and not re_while.match(lines[row - 1]):
+            row -= 1
+        line = lines[row - 1]
+        if re_while.match(line):
+            node.lineno = row
+            node.col_offset = len(line) - len(line.lstrip())
+    return tree
+
+
+#
+# CPython fast path
+#
+
+
+def python_tokens(s):
+    """Returns the list of tokens in Python code, as found by the standard
+    library tokenizer.
+    """
+    return list(tokenize.generate_tokens(io.StringIO(s).readline))
+
+
+def python_comments(tokens, source=None):
+    """Returns a CommentStore of the comments in a list of Python tokens of
+    a source, and the mapping of the lines that they appear on.
+    """
+    comments = CommentStore(source)
+    comment = tokenize.COMMENT
+    for token in tokens:
+        if token.type == comment:
+            lineno, col_offset = token.start
+            comments.append(token.string, lineno, col_offset, token.line)
+    return comments, comments.lines()
+
+
+_NON_CODE_TOKENS = frozenset(
+    [tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT]
+)
+
+
+class _TokenIndex(object):
+    """Finds tokens by position, and the first token of each logical line."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.index = {}
+        self.starts = []
+        new_line = True
+        for i, token in enumerate(tokens):
+            if token.type in _NON_CODE_TOKENS:
+                continue
+            self.index[token.start] = i
+            if token.type == tokenize.NEWLINE:
+                new_line = True
+            elif new_line or token.type == tokenize.ENDMARKER:
+                self.starts.append(token.start)
+                new_line = False
+
+    def at(self, pos):
+        """Returns the code token starting at a position, or None."""
+        i = self.index.get(pos)
+        return None if i is None else self.tokens[i]
+
+    def after(self, pos):
+        """Returns the code token that follows the one at a position."""
+        i = self.index[pos] + 1
+        while self.tokens[i].type in _NON_CODE_TOKENS:
+            i += 1
+        return self.tokens[i]
+
+    def statement_start(self, row):
+        """Returns the start of the last statement that begins before a row."""
+        j = bisect.bisect_left(self.starts, (row, -1)) - 1
+        pos = self.starts[j]
+        token = self.at(pos)
+        while token.type != tokenize.NEWLINE:
+            token = self.after(token.start)
+            if token.start[0] >= row:
+                break
+            elif token.string == ";":
+                pos = self.after(token.start).start
+        return pos
+
+    def expression_end(self, pos, unary=False):
+        """Returns the start of the token that follows the expression
+        starting at a position, at which the xonsh parser finishes reading
+        it. If unary is true, the expression is the operand of a unary
+        arithmetic operator, which ends at the first binary operator.
+        """
+        token = self.at(pos)
+        depth = 0
+        operand = False
+        while True:
+            string = token.string
+            if token.type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                break
+            elif string in _OPEN_BRACKETS:
+                depth += 1
+                operand = False
+            elif string in _CLOSE_BRACKETS:
+                if depth == 0:
+                    break
+                depth -= 1
+                operand = True
+            elif depth > 0:
+                pass
+            elif string in _EXPRESSION_ENDS:
+                break
+            elif token.type == tokenize.OP and string.endswith("=") and (
+                string not in _BINARY_OPS
+            ):
+                break
+            elif unary and operand and string in _BINARY_OPS:
+                break
+            elif token.type == tokenize.OP or keyword.iskeyword(string):
+                operand = string in ("None", "True", "False")
+            else:
+                operand = True
+            token = self.after(token.start)
+        return token.start
+
+    def before(self, pos):
+        """Returns the start of the code token that precedes a position,
+        skipping over opening parentheses.
+        """
+        i = self.index[pos] - 1
+        while self.tokens[i].type in _NON_CODE_TOKENS or self.tokens[i].string == "(":
+            i -= 1
+        return self.tokens[i].start
+
+    def open_paren(self, node, following):
+        """Returns the position of the parenthesis that encloses a node, if
+        the parentheses end before the following node, and None otherwise.
+        """
+        i = self.index.get((node.lineno, node.col_offset))
+        if i is None:
+            return None
+        i -= 1
+        while self.tokens[i].type in _NON_CODE_TOKENS:
+            i -= 1
+        if self.tokens[i].string != "(":
+            return None
+        paren = self.tokens[i].start
+        depth = 0
+        token = self.tokens[i]
+        while True:
+            if token.string in _OPEN_BRACKETS:
+                depth += 1
+            elif token.string in _CLOSE_BRACKETS:
+                depth -= 1
+                if depth == 0:
+                    break
+            token = self.after(token.start)
+        if token.start < (following.lineno, following.col_offset):
+            return paren
+        return None
+
+    def xonsh_start(self, node):
+        """Returns the position that the xonsh parser gives an expression.
+        This differs from the CPython position when the expression starts
+        with a unary operator or a conditional expression, which xonsh puts
+        at the token following them.
+        """
+        while True:
+            if isinstance(node, UnaryOp):
+                unary = not isinstance(node.op, Not)
+                operand = self.after((node.lineno, node.col_offset)).start
+                return self.expression_end(operand, unary=unary)
+            elif isinstance(node, IfExp):
+                return self.expression_end((node.lineno, node.col_offset))
+            elif isinstance(node, BoolOp):
+                paren = self.open_paren(node.values[0], node.values[1])
+                if paren is not None:
+                    return paren
+                node = node.values[0]
+            elif isinstance(node, Compare):
+                node = node.left
+            elif isinstance(node, BinOp):
+                left = node.left
+                group = _BINOP_GROUPS.get(type(node.op))
+                if isinstance(left, BinOp) and _BINOP_GROUPS.get(type(left.op)) == group:
+                    # chains of three or more operands are put at their last
+                    # operator
+                    return self.before((node.right.lineno, node.right.col_offset))
+                paren = self.open_paren(left, node.right)
+                if paren is not None:
+                    return paren
+                node = left
+            else:
+                return (node.lineno, node.col_offset)
+
+
+_BINOP_GROUPS = {
+    Add: "arith",
+    Sub: "arith",
+    Mult: "term",
+    MatMult: "term",
+    Div: "term",
+    Mod: "term",
+    FloorDiv: "term",
+    LShift: "shift",
+    RShift: "shift",
+    BitAnd: "and",
+    BitXor: "xor",
+    BitOr: "or",
+}
+_OPEN_BRACKETS = frozenset(["(", "[", "{"])
+_CLOSE_BRACKETS = frozenset([")", "]", "}"])
+_EXPRESSION_ENDS = frozenset(
+    [":", ",", ";", "and", "or", "if", "else", "for", "async", "as", "from"]
+)
+_BINARY_OPS = frozenset(
+    "+ - * / // % @ << >> & | ^ < > == != <= >= in not is".split()
+)
+
+
+def match_xonsh_positions(tree, tokens):
+    """Moves the statements of a tree parsed by CPython to the positions
+    that the xonsh parser gives them, since comments are attached to
+    statements by position. These differ for statements starting with a
+    multi-line string, elif clauses, async statements, and parenthesized
+    tuple targets. While loops are moved the other way, see
+    match_while_starts().
+    """
+    index = _TokenIndex(tokens)
+    for node in walk(tree):
+        if not isinstance(node, stmt):
+            continue
+        pos = (node.lineno, node.col_offset)
+        if node.col_offset < 0:
+            # CPython puts multi-line strings at their last line
+            pos = index.statement_start(node.lineno)
+        elif isinstance(node, (AsyncFunctionDef, AsyncFor, AsyncWith)):
+            token = index.at(pos)
+            if token is not None and token.string == "async":
+                pos = index.after(pos).start
+        elif isinstance(node, (Assign, AugAssign, AnnAssign, Expr)):
+            first = node.targets[0] if isinstance(node, Assign) else None
+            first = first or getattr(node, "target", None) or node.value
+            while isinstance(first, Tuple) and first.elts:
+                token = index.at((first.lineno, first.col_offset))
+                if token is None or token.string != "(":
+                    break
+                first = first.elts[0]
+                pos = (first.lineno, first.col_offset)
+        if isinstance(node, If) and len(node.orelse) == 1:
+            # xonsh puts elif clauses at the start of their test
+            orelse = node.orelse[0]
+            token = index.at((orelse.lineno, orelse.col_offset))
+            if isinstance(orelse, If) and token is not None and token.string == "elif":
+                orelse.lineno, orelse.col_offset = index.xonsh_start(orelse.test)
+        node.lineno, node.col_offset = pos
+    return tree
+
+
+def parse_python(s, ctx=None, filename="<code>", mode="exec", execer=None):
+    """Parses Python code with the CPython parser, returning the same
+    (tree, comments, lines) tuple as parse(). Statements are placed where
+    the xonsh parser would put them. If a context is given, the tree is then
+    transformed by the xonsh context-aware transformer, so that lines like
+    'ls -l' become subprocess calls, just like in parse(). This uses the
+    transformer of the given execer, or of the execer of the current thread.
+    """
+    tree = compile(s, filename, mode, PyCF_ONLY_AST, dont_inherit=True)
+    tokens = python_tokens(s)
+    comments, lines = python_comments(tokens, source=s)
+    if isinstance(tree, Module) and not tree.body:
+        # the xonsh parser returns None for code without statements
+        return None, comments, lines
+    tree = match_xonsh_positions(tree, tokens)
+    if (
+        isinstance(tree, Module)
+        and not s.endswith("\n")
+        and len(tree.body) == 1
+        and isinstance(tree.body[0], Expr)
+    ):
+        # xonsh reads an unterminated expression as an expression
+        value = tree.body[0].value
+        tree = Expression(body=value, lineno=value.lineno, col_offset=value.col_offset)
+    if ctx is not None:
+        execer = thread_execer() if execer is None else execer
+        transformer = execer.ctxtransformer
+        tree = transformer.ctxvisit(tree, s, set(ctx), mode=mode, filename=filename)
     return tree, comments, lines
 
 
+#
+# Statement chunks
+#
+
+
+@lazyobject
+def re_chunk_tokens():
+    # the tokens that decide where logical lines start: strings, comments,
+    # brackets, explicit line joins, and newlines
+    prefix = r"[rRbBuUfFpP]{0,2}"
+    return re.compile(
+        prefix + r"""'''(?:[^'\\]|\\.|'(?!''))*(?:'''|$)"""
+        r"|" + prefix + r'''"""(?:[^"\\]|\\.|"(?!""))*(?:"""|$)'''
+        r"|" + prefix + r"""'(?:[^'\\\n]|\\.)*'?"""
+        r"|" + prefix + r'''"(?:[^"\\\n]|\\.)*"?'''
+        r"|#[^\n]*"
+        r"|\\\n"
+        r"|[()\[\]{}\n]",
+        re.DOTALL,
+    )
+
+
+@lazyobject
+def re_clause():
+    return re.compile(r"(else|elif|except|finally)\b")
+
+
+def logical_line_starts(s):
+    """Returns the list of the 1-based numbers of the lines of code that
+    start a logical line, that is, that are not inside brackets or strings,
+    and do not follow an explicit line join.
+    """
+    starts = [1]
+    lineno = 1
+    depth = 0
+    for m in re_chunk_tokens.finditer(s):
+        tok = m.group()
+        c = tok[0]
+        if c == "\n":
+            lineno += 1
+            if depth == 0:
+                starts.append(lineno)
+        elif c in "([{":
+            depth += 1
+        elif c in ")]}":
+            depth = max(depth - 1, 0)
+        elif c == "\\":
+            lineno += 1
+        elif c != "#":
+            lineno += tok.count("\n")
+    return starts
+
+
+def top_level_starts(s):
+    """Returns the sorted list of the 1-based numbers of the lines that start
+    a top-level statement of code, along with its decorators. The clauses of
+    compound statements, like 'else:', and comment lines do not start
+    statements.
+    """
+    index = LineIndex(s)
+    starts = []
+    decorated = False
+    for lineno in logical_line_starts(s):
+        line = index.line(lineno)
+        if not line or line[0] in " \t\r\n\x0c#":
+            continue
+        if re_clause.match(line) is not None:
+            continue
+        if not decorated:
+            starts.append(lineno)
+        decorated = line[0] == "@"
+    return starts
+
+
+_CLAUSES = frozenset(["else", "elif", "except", "finally"])
+
+
+def top_level_chunks(readline):
+    """Yields the code of each top-level statement, along with its
+    decorators and the comments and blank lines that follow it, reading
+    lines with readline only as they are needed, so that the whole code is
+    never held in memory. Statements are found with the Python tokenizer,
+    which reads xonsh code well enough to tell where they start. If the
+    tokenizer fails, the rest of the code is yielded as a single chunk.
+    """
+    lines = []
+    # the line number of the first line in lines
+    first = 1
+
+    def read():
+        line = readline()
+        if line:
+            lines.append(line)
+        return line
+
+    new_line = True
+    decorated = False
+    started = False
+    try:
+        for token in tokenize.generate_tokens(read):
+            if token.type == tokenize.NEWLINE:
+                new_line = True
+                continue
+            elif token.type in _NON_CODE_TOKENS or not new_line:
+                continue
+            new_line = False
+            if token.type == tokenize.ENDMARKER:
+                break
+            row, col = token.start
+            if col != 0 or token.string in _CLAUSES:
+                continue
+            if started and not decorated:
+                n = row - first
+                yield "".join(lines[:n])
+                del lines[:n]
+                first = row
+            started = True
+            decorated = token.string == "@"
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    while read():
+        pass
+    if lines:
+        yield "".join(lines)
+
+
+class ModuleNames(DispatchVisitor, NodeVisitor):
+    """Collects the names that the xonsh context-aware transformer would
+    have in its context after visiting a tree at module level, so that code
+    following the tree may be parsed on its own with the same context.
+    """
+
+    def __init__(self, names):
+        super().__init__()
+        self.names = names
+        self.depth = 0
+
+    def add(self, names):
+        if self.depth == 0:
+            self.names.update(names)
+            self.names.discard(None)
+
+    def visit_Assign(self, node):
+        from xonsh.ast import leftmostname
+
+        targets = getattr(node, "targets", None) or [node.target]
+        for target in targets:
+            if isinstance(target, (Tuple, List)):
+                self.add(leftmostname(elt) for elt in target.elts)
+            else:
+                self.add([leftmostname(target)])
+
+    visit_AnnAssign = visit_Assign
+
+    def visit_Import(self, node):
+        self.add(name.asname or name.name for name in node.names)
+
+    visit_ImportFrom = visit_Import
+
+    def visit_With(self, node):
+        from xonsh.ast import gather_names
+
+        for item in node.items:
+            if item.optional_vars is not None:
+                self.add(gather_names(item.optional_vars))
+        self.generic_visit(node)
+
+    def visit_For(self, node):
+        from xonsh.ast import gather_names
+
+        self.add(gather_names(node.target))
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        self.add([node.name])
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_Delete(self, node):
+        if self.depth == 0:
+            for target in node.targets:
+                if isinstance(target, Name):
+                    self.names.discard(target.id)
+        self.generic_visit(node)
+
+    def visit_Try(self, node):
+        self.add(h.name for h in node.handlers if h.name is not None)
+        self.generic_visit(node)
+
+    def visit_Global(self, node):
+        self.names.update(node.names)
+
+
+def module_names(s, ctx=None):
+    """Returns the context that the xonsh parser would have after parsing
+    Python code at module level, starting from ctx, which defaults to the
+    builtins. The code is parsed with the CPython parser, so this raises a
+    SyntaxError for code that uses xonsh syntax.
+    """
+    tree = compile(s, "<code>", "exec", PyCF_ONLY_AST, dont_inherit=True)
+    names = set(builtins.__dict__ if ctx is None else ctx)
+    ModuleNames(names).visit(tree)
+    return names
+
+
 #
 # commented tree
 #
@@ -156,25 +1135,53 @@ def re_else_comment():
 
 def merge_body_comments(body, comments):
     """Takes a body (list of nodes) and adds in comments
-    that appear at the root level of the body. This operates in-place
+    that appear at the root level of the body. This operates in-place,
+    in a single pass over the body and the comments, which must both be
+    sorted by line number. The comments list is emptied.
     """
-    i = 0
-    while comments and i < len(body):
-        if comments[0].lineno < body[i].lineno:
-            body.insert(i, comments.pop(0))
-        i += 1
-    body.extend(comments)
+    if not comments:
+        return
+    merged = []
+    i, n = 0, len(comments)
+    for node in body:
+        lineno = node.lineno
+        while i < n and comments[i].lineno < lineno:
+            merged.append(comments[i])
+            i += 1
+        merged.append(node)
+    merged.extend(comments[i:])
+    body[:] = merged
+    comments.clear()
 
 
-class CommentAdder(NodeTransformer):
-    """Transformer for adding comment nodes to a tree"""
+def _statement_start(node):
+    """Returns the first line of a statement, including its decorators.
+    Statements with comments wrap the actual statement.
+    """
+    decorators = getattr(getattr(node, "node", node), "decorator_list", None)
+    if not decorators:
+        return node.lineno
+    return min(node.lineno, min(d.lineno for d in decorators))
+
+
+class CommentAdder(DispatchVisitor, NodeTransformer):
+    """Transformer for adding comment nodes to a tree.
+
+    The comments that trail the body of a compound statement are only taken
+    up to the statement after it, so that the comments of a top-level
+    statement never depend on the code after it, and statements may be
+    commented one at a time, see coral.formatter.chunk_statements().
+    """
 
     def __init__(self, comments, lines=None):
+        super().__init__()
         self.lines = {} if lines is None else lines
-        self._comments = list(reversed(comments))
-        self._next_comment = self._comments.pop() if self._comments else None
+        self._comments = iter(comments)
+        self._next_comment = next(self._comments, None)
         # this is a list of lists of comments, representing the stack
         self._comments_in_body = []
+        # the line of the statement after the one being visited, if any
+        self._limit = None
 
     def _attach_comment(self, node, node_with_comment_class=None):
         # attach comments to current node or continue
@@ -186,7 +1193,7 @@ class CommentAdder(NodeTransformer):
                 lineno=node.lineno,
                 col_offset=node.col_offset,
             )
-            self._next_comment = self._comments.pop() if self._comments else None
+            self._next_comment = next(self._comments, None)
         else:
             new_node = node
         return new_node
@@ -196,7 +1203,26 @@ class CommentAdder(NodeTransformer):
             self._next_comment is not None and self._next_comment.lineno < node.lineno
         ):
             self._comments_in_body[-1].append(self._next_comment)
-            self._next_comment = self._comments.pop() if self._comments else None
+            self._next_comment = next(self._comments, None)
+
+    def _next_comment_trails(self, col_offset):
+        # whether the next comment trails a body indented at col_offset
+        comment = self._next_comment
+        return (
+            comment is not None
+            and comment.col_offset >= col_offset
+            and (self._limit is None or comment.lineno < self._limit)
+        )
+
+    def _visit_body(self, body, limit):
+        # the trailing comments of each statement come before the next one,
+        # and those of the last one before the limit of the body
+        outer = self._limit
+        last = len(body) - 1
+        for i, n in enumerate(body):
+            self._limit = limit if i == last else _statement_start(body[i + 1])
+            body[i] = self.visit(n)
+        self._limit = outer
 
     def _next_comment_on_else_line(self):
         # we have to look at the actual line contents for this because
@@ -222,8 +1248,7 @@ class CommentAdder(NodeTransformer):
             # this can happen if the module contains nothing but comments
             comments = [self._next_comment]
             self._next_comment = None
-            comments.extend(reversed(self._comments))
-            self._comments.clear()
+            comments.extend(self._comments)
             new_node = Module(body=comments)
             return new_node
 
@@ -236,15 +1261,12 @@ class CommentAdder(NodeTransformer):
         new_node = self._attach_comment(node)
         if hasattr(node, "body"):
             self._comments_in_body.append([])
-            for i, n in enumerate(node.body):
-                node.body[i] = self.visit(n)
+            self._visit_body(node.body, self._limit)
+            n = node.body[-1]
             # grab trainling body comments
-            while (
-                self._next_comment is not None
-                and self._next_comment.col_offset >= n.col_offset
-            ):
+            while self._next_comment_trails(n.col_offset):
                 self._comments_in_body[-1].append(self._next_comment)
-                self._next_comment = self._comments.pop() if self._comments else None
+                self._next_comment = next(self._comments, None)
             merge_body_comments(node.body, self._comments_in_body.pop())
         elif node is not new_node:
             self.visit(node)
@@ -259,55 +1281,49 @@ class CommentAdder(NodeTransformer):
 
         new_node = self._attach_comment(node, IfWithComments)
         new_node.elsecomment = None
-        # go through body
-        self._comments_in_body.append([])
-        for i, n in enumerate(node.body):
-            node.body[i] = self.visit(n)
-            # grab trainling body comments
         # figure out if the else-clause exists and if it is an actual "else"
         # rather than an "elif"
         orelse0 = node.orelse[0] if len(node.orelse) > 0 else None
         orelse0_iselse = orelse0 is not None and not isinstance(orelse0, If)
+        # go through body
+        self._comments_in_body.append([])
+        limit = self._limit if orelse0 is None else _statement_start(orelse0)
+        self._visit_body(node.body, limit)
+        n = node.body[-1]
+        # grab trainling body comments
         while (
-            self._next_comment is not None
+            self._next_comment_trails(n.col_offset)
             and (orelse0 is None or self._next_comment.lineno < orelse0.lineno)
-            and self._next_comment.col_offset >= n.col_offset
             and (not orelse0_iselse or (orelse0_iselse and not self._next_comment_on_else_line()))
         ):
             self._comments_in_body[-1].append(self._next_comment)
-            self._next_comment = self._comments.pop() if self._comments else None
+            self._next_comment = next(self._comments, None)
         merge_body_comments(node.body, self._comments_in_body.pop())
         # add else comment
         if self._next_comment is not None and orelse0_iselse and self._next_comment_on_else_line():
             new_node.elsecomment = self._next_comment
-            self._next_comment = self._comments.pop() if self._comments else None
+            self._next_comment = next(self._comments, None)
         # go through orelse
         self._comments_in_body.append([])
-        for i, n in enumerate(node.orelse):
-            node.orelse[i] = self.visit(n)
-            # grab trainling body comments
-        while (
-            self._next_comment is not None
-            and self._next_comment.col_offset >= n.col_offset
-        ):
+        self._visit_body(node.orelse, self._limit)
+        n = node.orelse[-1] if node.orelse else n
+        # grab trainling body comments
+        while self._next_comment_trails(n.col_offset):
             self._comments_in_body[-1].append(self._next_comment)
-            self._next_comment = self._comments.pop() if self._comments else None
+            self._next_comment = next(self._comments, None)
         merge_body_comments(node.orelse, self._comments_in_body.pop())
         return new_node
 
     def visit_Module(self, node):
         # ast.Module does not have a lineno attr
         self._comments_in_body.append([])
-        for i, n in enumerate(node.body):
-            node.body[i] = self.visit(n)
+        self._visit_body(node.body, None)
         merge_body_comments(node.body, self._comments_in_body.pop())
         # if there are any remaining comments, add them to the end
         if self._next_comment is not None:
             node.body.append(self._next_comment)
             self._next_comment = None
-        if self._comments:
-            node.body.extend(reversed(self._comments))
-            self._comments.clear()
+        node.body.extend(self._comments)
         return node
 
 
@@ -316,3 +1332,46 @@ def add_comments(tree, comments, lines=None):
     adder = CommentAdder(comments, lines=lines)
     new_tree = adder.visit(tree)
     return new_tree
+
+
+def parse_commented(
+    s,
+    ctx=None,
+    filename="<code>",
+    mode="exec",
+    debug_level=0,
+    lang="xonsh",
+    execer=None,
+    cache=None,
+):
+    """Returns the (tree, comments, lines) of xonsh code, like parse(), but
+    with the comments already added to the tree. If cache is a
+    coral.cache.TreeCache, the result is looked up there first, and stored
+    there after parsing. The other arguments are as for parse().
+    """
+    if cache is None:
+        tree, comments, lines = parse(
+            s,
+            ctx=ctx,
+            filename=filename,
+            mode=mode,
+            debug_level=debug_level,
+            lang=lang,
+            execer=execer,
+        )
+        return add_comments(tree, comments, lines), comments, lines
+    # the key is found before parsing, which may change the context
+    key = cache.key(s, lang=lang, mode=mode, ctx=ctx)
+    result = cache.get(key)
+    if result is None:
+        result = parse_commented(
+            s,
+            ctx=ctx,
+            filename=filename,
+            mode=mode,
+            debug_level=debug_level,
+            lang=lang,
+            execer=execer,
+        )
+        cache.put(key, result)
+    return result
@@ -0,0 +1,226 @@
+"""Scheduling the files of a batch run across worker processes."""
+import os
+import time
+import multiprocessing
+from collections import deque, namedtuple
+from multiprocessing.connection import wait
+
+
+class WorkerError(Exception):
+    """Raised for a task whose worker process was lost."""
+
+
+class WorkerTimeout(WorkerError):
+    """Raised for a task that took longer than the time limit, whose worker
+    process was killed.
+    """
+
+
+class TaskResult(namedtuple("TaskResult", ["item", "value", "error"])):
+    """The outcome of a single task run by a Scheduler.
+
+    Attributes
+    ----------
+    item : object
+        The item that the task was run on.
+    value : object
+        What the task function returned, None if it failed.
+    error : Exception or None
+        The error raised by the task, or a WorkerError if its worker process
+        was killed or died, None if the task succeeded.
+    """
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        """Whether the task succeeded."""
+        return self.error is None
+
+
+def largest_first(paths):
+    """Returns a list of paths sorted by decreasing file size, so that the
+    largest files are started first and do not hold up the end of a run.
+    Files that cannot be found sort last, and files of the same size keep
+    their order.
+    """
+
+    def size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return -1
+
+    return sorted(paths, key=size, reverse=True)
+
+
+def _worker_main(conn, func, initializer, initargs):
+    """Runs tasks sent over a connection until it is closed."""
+    if initializer is not None:
+        initializer(*initargs)
+    # tell the scheduler that setting up is done, so that it is not counted
+    # against the time of the first task
+    conn.send(None)
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            break
+        try:
+            result = (func(item), None)
+        except Exception as e:
+            result = (None, e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # the value or error could not be pickled
+            msg = "{0}: {1}".format(e.__class__.__name__, e)
+            conn.send((None, WorkerError(msg)))
+
+
+class _Worker(object):
+    """A worker process, with its end of the connection to it."""
+
+    __slots__ = ("process", "conn", "item", "deadline")
+
+    def __init__(self, func, initializer, initargs):
+        conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_conn, func, initializer, initargs),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = conn
+        self.item = None
+        self.deadline = None
+
+    def kill(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+class Scheduler(object):
+    """Runs a function on many items in a set of worker processes, one item
+    at a time per worker, handing out the items in the order they are given.
+    Unlike a multiprocessing pool, a worker that takes longer than a time
+    limit on an item is killed and replaced, and a worker that dies is
+    replaced too, with the item reported as failed rather than the run
+    hanging.
+    """
+
+    def __init__(self, func, jobs=None, timeout=None, initializer=None, initargs=()):
+        """Parameters
+        ----------
+        func : callable
+            Function that is called with each item in the workers. It, and
+            its results, must be picklable.
+        jobs : int or None, optional
+            Number of worker processes, defaults to the number of CPUs.
+        timeout : float or None, optional
+            Time limit for each item, in seconds, None for no limit.
+        initializer : callable or None, optional
+            Function that is called once in each new worker process, with
+            the initargs.
+        """
+        self.func = func
+        self.jobs = jobs or os.cpu_count() or 1
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _start(self):
+        worker = _Worker(self.func, self.initializer, self.initargs)
+        self.workers.append(worker)
+        return worker
+
+    def _retire(self, worker, starting, pending):
+        """Kills a worker, starting a new one if there are items left."""
+        self.workers.remove(worker)
+        worker.kill()
+        if pending:
+            starting.add(self._start())
+
+    def imap(self, items):
+        """Runs the function on each item, yielding a TaskResult for each
+        one as it completes.
+        """
+        pending = deque(items)
+        idle = []
+        # workers that are still setting up
+        starting = set()
+        while len(self.workers) < min(self.jobs, len(pending)):
+            starting.add(self._start())
+        busy = {}
+        while pending or busy:
+            while idle and pending:
+                worker = idle.pop()
+                worker.item = pending.popleft()
+                if self.timeout is not None:
+                    worker.deadline = time.monotonic() + self.timeout
+                try:
+                    worker.conn.send(worker.item)
+                except OSError:
+                    # the worker died while idle
+                    pending.appendleft(worker.item)
+                    self._retire(worker, starting, pending)
+                    continue
+                busy[worker.conn] = worker
+            conns = list(busy)
+            conns.extend(worker.conn for worker in starting)
+            wait_time = None
+            if self.timeout is not None and busy:
+                deadline = min(worker.deadline for worker in busy.values())
+                wait_time = max(0.0, deadline - time.monotonic())
+            for conn in wait(conns, wait_time):
+                worker = busy.pop(conn, None)
+                if worker is None:
+                    # a new worker is ready, or failed to set up
+                    worker = next(w for w in starting if w.conn is conn)
+                    starting.remove(worker)
+                    try:
+                        conn.recv()
+                    except (EOFError, OSError):
+                        self.workers.remove(worker)
+                        worker.kill()
+                        if not self.workers:
+                            raise WorkerError("worker processes failed to start")
+                        continue
+                    idle.append(worker)
+                    continue
+                try:
+                    value, error = conn.recv()
+                except (EOFError, OSError):
+                    self._retire(worker, starting, pending)
+                    code = worker.process.exitcode
+                    msg = "worker process died with exit code {0}".format(code)
+                    yield TaskResult(worker.item, None, WorkerError(msg))
+                    continue
+                idle.append(worker)
+                yield TaskResult(worker.item, value, error)
+            if self.timeout is None:
+                continue
+            now = time.monotonic()
+            for conn, worker in list(busy.items()):
+                if worker.deadline > now:
+                    continue
+                del busy[conn]
+                self._retire(worker, starting, pending)
+                msg = "timed out after {0:g} s".format(self.timeout)
+                yield TaskResult(worker.item, None, WorkerTimeout(msg))
+
+    def close(self):
+        """Shuts down the worker processes."""
+        for worker in self.workers:
+            worker.kill()
+        self.workers = []
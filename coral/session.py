@@ -0,0 +1,235 @@
+"""Sessions for reformatting many sources with the same setup."""
+import builtins
+import functools
+from collections import OrderedDict, namedtuple
+
+from coral.cache import content_hash
+from coral.formatter import Formatter, assert_equivalent, matches, run_stages
+from coral.parser import (
+    LANGS,
+    install_comment_handler,
+    make_execer,
+    parse,
+    parse_commented,
+)
+
+
+class ReformatResult(namedtuple("ReformatResult", ["output", "error"])):
+    """The outcome of reformatting a single source in a batch.
+
+    Attributes
+    ----------
+    output : str or None
+        The formatted source, None if formatting failed.
+    error : Exception or None
+        The error raised while formatting, None if formatting succeeded.
+    """
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        """Whether the source was formatted."""
+        return self.error is None
+
+
+class CoralSession(object):
+    """Holds everything needed to reformat sources: an execer, the execution
+    context, the comment handler, a formatter, and caches of results. All of
+    this is set up once per session rather than once per source.
+
+    A session must only be used by one thread at a time. Each thread that
+    reformats concurrently should have its own session.
+    """
+
+    def __init__(
+        self,
+        ctx=None,
+        lang="xonsh",
+        debug_level=0,
+        cache=None,
+        maxsize=1024,
+        trees=None,
+    ):
+        """Parameters
+        ----------
+        ctx : iterable of str, optional
+            Names known to the execution context, defaults to the builtins.
+        lang : str, optional
+            Default language to parse sources as, see coral.parser.parse().
+        debug_level : int, optional
+            Debugging level passed down to yacc.
+        cache : Cache or None, optional
+            On-disk cache of hashes of formatted sources. Sources in the cache
+            are returned as they are, and sources that are found to be
+            formatted already are added to it.
+        maxsize : int, optional
+            Maximum number of formatted outputs to remember in memory, zero
+            to not remember any.
+        trees : TreeCache or None, optional
+            On-disk cache of commented parse trees. Sources are looked up
+            there before being parsed, and their trees are added to it.
+        """
+        if lang not in LANGS:
+            raise ValueError("lang must be one of {0}, not {1!r}".format(LANGS, lang))
+        self.ctx = frozenset(builtins.__dict__ if ctx is None else ctx)
+        self.lang = lang
+        self.debug_level = debug_level
+        self.cache = cache
+        self.maxsize = maxsize
+        self.trees = trees
+        self.results = OrderedDict()
+        self.formatter = Formatter()
+        self._execer = None
+        install_comment_handler()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def execer(self):
+        """The execer of this session, which is created when it is first
+        needed, since pure Python sources may not need one.
+        """
+        if self._execer is None:
+            self._execer = make_execer(debug_level=self.debug_level)
+        return self._execer
+
+    def parse(self, source, lang=None, filename="<code>"):
+        """Returns the (tree, comments, lines) of a source, see
+        coral.parser.parse().
+        """
+        lang = self.lang if lang is None else lang
+        return parse(
+            source,
+            # the xonsh transformer may remove names from the context
+            ctx=set(self.ctx),
+            filename=filename,
+            debug_level=self.debug_level,
+            lang=lang,
+            execer=None if lang == "python" else self.execer,
+        )
+
+    def parse_commented(self, source, lang=None, filename="<code>"):
+        """Returns the (tree, comments, lines) of a source, with the comments
+        added to the tree, using the tree cache of the session, if any. See
+        coral.parser.parse_commented().
+        """
+        lang = self.lang if lang is None else lang
+        return parse_commented(
+            source,
+            ctx=set(self.ctx),
+            filename=filename,
+            debug_level=self.debug_level,
+            lang=lang,
+            execer=None if lang == "python" else self.execer,
+            cache=self.trees,
+        )
+
+    def _run_stages(self, source, lang, format, stats):
+        """Runs the stages of reformatting a source, parsing it through the
+        tree cache, if any.
+        """
+        if self.trees is None:
+            parse_source = functools.partial(self.parse, lang=lang)
+        else:
+            parse_source = functools.partial(self.parse_commented, lang=lang)
+        return run_stages(
+            source,
+            parse_source,
+            format,
+            stats=stats,
+            commented=self.trees is not None,
+        )
+
+    def format(self, tree, visits=None):
+        """Formats a tree into a string with the formatter of the session.
+        If visits is a coral.stats.VisitStats, a formatter that counts the
+        visited nodes in it is used instead.
+        """
+        if visits is not None:
+            formatter = Formatter(visits=visits)
+            formatter.emit(tree)
+            return "".join(formatter.chunks)
+        formatter = self.formatter
+        formatter.reset()
+        try:
+            formatter.emit(tree)
+            return "".join(formatter.chunks)
+        finally:
+            formatter.reset()
+
+    def reformat(self, source, lang=None, stats=None):
+        """Returns the formatted version of a source string. If stats is a
+        coral.stats.ReformatStats object, the time spent in each stage is
+        recorded in it, and the in-memory results are not used.
+        """
+        lang = self.lang if lang is None else lang
+        digest = content_hash(source)
+        if self.cache is not None and digest in self.cache:
+            return source
+        key = (lang, digest)
+        if stats is None and key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+        fmt = self.format
+        if stats is not None and stats.visits is not None:
+            fmt = functools.partial(self.format, visits=stats.visits)
+        output = self._run_stages(source, lang, fmt, stats)
+        if self.maxsize > 0:
+            self.results[key] = output
+            if len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+        if self.cache is not None and output == source:
+            self.cache.add(digest)
+        return output
+
+    def is_formatted(self, source, lang=None, stats=None):
+        """Whether a source string is already formatted, see
+        coral.formatter.is_formatted(). Sources that are found to be
+        formatted are added to the on-disk cache, if any, so that they are
+        not parsed again.
+        """
+        lang = self.lang if lang is None else lang
+        digest = content_hash(source)
+        if self.cache is not None and digest in self.cache:
+            return True
+        key = (lang, digest)
+        if stats is None and key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key] == source
+        visits = None if stats is None else stats.visits
+        check = functools.partial(matches, expected=source, visits=visits)
+        formatted = self._run_stages(source, lang, check, stats)
+        if formatted and self.cache is not None:
+            self.cache.add(digest)
+        return formatted
+
+    def check_output(self, source, output, lang=None):
+        """Raises a coral.formatter.UnsafeFormatError unless a formatted
+        output is safe to replace the source it was formatted from, see
+        coral.formatter.assert_equivalent().
+        """
+        lang = self.lang if lang is None else lang
+        assert_equivalent(source, output, functools.partial(self.parse, lang=lang))
+
+    def reformat_many(self, sources, lang=None):
+        """Reformats an iterable of source strings, yielding a ReformatResult
+        for each one, in order. Errors are caught and reported in the results,
+        so that a single bad source does not stop the batch.
+        """
+        for source in sources:
+            try:
+                output = self.reformat(source, lang=lang)
+            except Exception as e:
+                yield ReformatResult(None, e)
+            else:
+                yield ReformatResult(output, None)
+
+    def close(self):
+        """Saves the on-disk cache, if any."""
+        if self.cache is not None:
+            self.cache.write()
@@ -0,0 +1,336 @@
+"""Instrumentation for finding out where coral spends its time."""
+import os
+import time
+import types
+from contextlib import contextmanager
+
+from coral.formatter import PLACEHOLDER
+
+
+STAGES = ("parse", "comments", "format")
+
+
+class ReformatStats(object):
+    """Timings and counts recorded while reformatting a single source.
+    Pass an instance as the stats argument of reformat() to fill it in.
+
+    Attributes
+    ----------
+    times : dict
+        Wall time in seconds spent in each stage, by stage name.
+    nodes : int
+        Number of nodes in the parsed tree.
+    comments : int
+        Number of comments found in the source.
+    lines : int
+        Number of lines in the source.
+    profiles : dict or None
+        Raw cProfile statistics of each stage, by stage name, if profiling
+        was requested. These are plain dicts, so that they can be sent
+        between processes, and may be loaded with profile_stats().
+    visits : VisitStats or None
+        Counts and times of the formatter visitors, by node type, if they
+        were requested.
+    """
+
+    def __init__(self, profile=False, visits=False):
+        """Parameters
+        ----------
+        profile : bool, optional
+            Whether to run each stage under cProfile as well.
+        visits : bool, optional
+            Whether to count the nodes visited by the formatter.
+        """
+        self.times = {}
+        self.nodes = 0
+        self.comments = 0
+        self.lines = 0
+        self.profiles = {} if profile else None
+        self.visits = VisitStats() if visits else None
+
+    def __repr__(self):
+        s = "ReformatStats(times={0!r}, nodes={1}, comments={2}, lines={3})"
+        return s.format(self.times, self.nodes, self.comments, self.lines)
+
+    @property
+    def total(self):
+        """Total wall time of all stages, in seconds."""
+        return sum(self.times.values())
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that times, and optionally profiles, a stage."""
+        prof = None
+        if self.profiles is not None:
+            import cProfile
+
+            prof = cProfile.Profile()
+            prof.enable()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - t0
+            if prof is not None:
+                prof.disable()
+                prof.create_stats()
+                self.profiles[name] = prof.stats
+
+    def as_dict(self):
+        """Returns the timings and counts as a JSON-serializable dict."""
+        return {
+            "times": dict(self.times),
+            "total": self.total,
+            "nodes": self.nodes,
+            "comments": self.comments,
+            "lines": self.lines,
+            "visits": None if self.visits is None else self.visits.as_dict(),
+        }
+
+
+class VisitStats(object):
+    """Counts of the nodes visited by Formatters, and of the time spent in
+    their visitors, by node type. Visits that fell back to a placeholder,
+    either through generic_visit() or through a visitor that is not
+    implemented yet, are counted separately. Pass an instance as the visits
+    argument of a Formatter to fill it in. The same instance may be used by
+    many formatters, and instances may be added together.
+
+    The time of a node type is the time spent in its own visitors, not in
+    those of its children, like the total time of cProfile. Expressions
+    that are found in a FormatMemo are not visited, and so are not counted.
+
+    Attributes
+    ----------
+    entries : dict
+        Maps node type names to lists of their number of visits, the time
+        spent in their visitors, in seconds, and their number of fallbacks.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def __repr__(self):
+        return "VisitStats(visits={0}, time={1:.6f}, fallbacks={2})".format(
+            self.visits, self.time, self.fallbacks
+        )
+
+    def _entry(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            entry = self.entries[name] = [0, 0.0, 0]
+        return entry
+
+    @property
+    def visits(self):
+        """Total number of visits."""
+        return sum(entry[0] for entry in self.entries.values())
+
+    @property
+    def time(self):
+        """Total time spent in the visitors, in seconds."""
+        return sum(entry[1] for entry in self.entries.values())
+
+    @property
+    def fallbacks(self):
+        """Total number of visits that fell back to a placeholder."""
+        return sum(entry[2] for entry in self.entries.values())
+
+    def handlers(self, table):
+        """Returns a mapping of node types to visitor functions, like the
+        dispatch table of a visitor class, whose functions count their
+        visits in this object.
+        """
+        return _CountingHandlers(self, table)
+
+    def wrap(self, node_type, func, fallback=False):
+        """Returns a visitor function that calls func, counting its visits
+        under the name of the node type. If fallback is true, all visits are
+        counted as fallbacks.
+        """
+        entry = self._entry(node_type.__name__)
+        clock = time.perf_counter
+        generator = types.GeneratorType
+
+        def visit(formatter, node):
+            entry[0] += 1
+            t0 = clock()
+            result = func(formatter, node)
+            entry[1] += clock() - t0
+            if type(result) is generator:
+                return _timed(result, entry, fallback)
+            if fallback or (type(result) is str and result.startswith(PLACEHOLDER)):
+                entry[2] += 1
+            return result
+
+        return visit
+
+    def add(self, other):
+        """Adds the counts and times of another VisitStats to this one."""
+        for name, (visits, t, fallbacks) in other.entries.items():
+            entry = self._entry(name)
+            entry[0] += visits
+            entry[1] += t
+            entry[2] += fallbacks
+
+    def as_dict(self):
+        """Returns the counts and times as a JSON-serializable dict."""
+        return {
+            "visits": self.visits,
+            "time": self.time,
+            "fallbacks": self.fallbacks,
+            "nodes": {
+                name: {"visits": visits, "time": t, "fallbacks": fallbacks}
+                for name, (visits, t, fallbacks) in sorted(self.entries.items())
+            },
+        }
+
+    def format(self, n=10):
+        """Returns a human-readable report, listing the n node types that
+        took the most time, and all node types that fell back.
+        """
+        total = self.time
+        lines = [
+            "visited {0} nodes in {1:.3f} s, {2} fallbacks".format(
+                self.visits, total, self.fallbacks
+            )
+        ]
+        by_time = sorted(self.entries.items(), key=lambda x: x[1][1], reverse=True)
+        for name, (visits, t, _) in by_time[:n]:
+            frac = t / total if total else 0.0
+            lines.append(
+                "  {0:<20} {1:10} {2:10.3f} s {3:6.1%}".format(name, visits, t, frac)
+            )
+        fallbacks = [(name, entry[2]) for name, entry in by_time if entry[2]]
+        if fallbacks:
+            lines.append("fallbacks:")
+        for name, count in sorted(fallbacks, key=lambda x: x[1], reverse=True):
+            lines.append("  {0:<20} {1:10}".format(name, count))
+        return "\n".join(lines)
+
+
+def _timed(gen, entry, fallback):
+    """Drives a visitor generator on behalf of the formatter, adding the
+    time spent in it to its entry.
+    """
+    clock = time.perf_counter
+    value = None
+    while True:
+        t0 = clock()
+        try:
+            node = gen.send(value)
+        except StopIteration as e:
+            entry[1] += clock() - t0
+            result = e.value
+            break
+        entry[1] += clock() - t0
+        value = yield node
+    if fallback or (type(result) is str and result.startswith(PLACEHOLDER)):
+        entry[2] += 1
+    return result
+
+
+class _CountingHandlers(dict):
+    """Dispatch table of a formatter whose visitor functions are wrapped by
+    a VisitStats, see VisitStats.handlers().
+    """
+
+    __slots__ = ("stats", "table")
+
+    def __init__(self, stats, table):
+        super().__init__()
+        self.stats = stats
+        self.table = table
+
+    def __missing__(self, node_type):
+        func = self.table[node_type]
+        fallback = func is self.table.cls.generic_visit
+        wrapped = self[node_type] = self.stats.wrap(node_type, func, fallback)
+        return wrapped
+
+
+class _RawProfile(object):
+    """Adapts raw cProfile statistics to what pstats.Stats() loads."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def profile_stats(*profiles):
+    """Returns a pstats.Stats object that combines any number of raw
+    profiles from ReformatStats.profiles.
+    """
+    import pstats
+
+    stats = pstats.Stats(_RawProfile(profiles[0]))
+    for profile in profiles[1:]:
+        stats.add(_RawProfile(profile))
+    return stats
+
+
+class ProfileReport(object):
+    """Aggregates the stats of many reformatted files."""
+
+    def __init__(self):
+        self.files = []
+        self.times = dict.fromkeys(STAGES, 0.0)
+        self.nodes = 0
+        self.comments = 0
+        self.lines = 0
+        self.profiles = {}
+        self.visits = VisitStats()
+
+    def add(self, path, stats):
+        """Adds the ReformatStats of a file."""
+        self.files.append((path, stats))
+        for stage, t in stats.times.items():
+            self.times[stage] = self.times.get(stage, 0.0) + t
+        self.nodes += stats.nodes
+        self.comments += stats.comments
+        self.lines += stats.lines
+        for stage, profile in (stats.profiles or {}).items():
+            self.profiles.setdefault(stage, []).append(profile)
+        if stats.visits is not None:
+            self.visits.add(stats.visits)
+
+    def slowest(self, n=10):
+        """Returns the (path, stats) pairs of the n slowest files."""
+        return sorted(self.files, key=lambda x: x[1].total, reverse=True)[:n]
+
+    def format(self, n=10):
+        """Returns a human-readable report, listing the n slowest files."""
+        total = sum(self.times.values())
+        lines = [
+            "profiled {0} files, {1} lines, {2} nodes, {3} comments "
+            "in {4:.3f} s".format(
+                len(self.files), self.lines, self.nodes, self.comments, total
+            )
+        ]
+        for stage, t in self.times.items():
+            frac = t / total if total else 0.0
+            lines.append("  {0:<10} {1:10.3f} s {2:6.1%}".format(stage, t, frac))
+        if self.files:
+            lines.append("slowest files:")
+        for path, stats in self.slowest(n):
+            parts = " ".join(
+                "{0}={1:.3f}".format(stage, t) for stage, t in stats.times.items()
+            )
+            lines.append("  {0:10.3f} s  {1}  ({2})".format(stats.total, path, parts))
+        if self.visits.entries:
+            lines.append(self.visits.format(n))
+        return "\n".join(lines)
+
+    def dump(self, directory):
+        """Writes the combined cProfile statistics of each stage to a
+        '<stage>.pstats' file in a directory, returning the file names.
+        """
+        os.makedirs(directory, exist_ok=True)
+        filenames = []
+        for stage, profiles in self.profiles.items():
+            filename = os.path.join(directory, stage + ".pstats")
+            profile_stats(*profiles).dump_stats(filename)
+            filenames.append(filename)
+        return filenames
@@ -0,0 +1,53 @@
+"""Node type dispatch shared by the coral visitors."""
+
+
+class DispatchTable(dict):
+    """Maps node types to the visitor functions of a visitor class. Entries
+    are looked up by name the first time a node type is seen, and are then
+    reused by every instance of the class.
+    """
+
+    __slots__ = ("cls",)
+
+    def __init__(self, cls):
+        super().__init__()
+        self.cls = cls
+
+    def __repr__(self):
+        return "DispatchTable({0}, {1})".format(self.cls.__name__, dict.__repr__(self))
+
+    def __missing__(self, node_type):
+        cls = self.cls
+        func = getattr(cls, "visit_" + node_type.__name__, cls.generic_visit)
+        self[node_type] = func
+        return func
+
+
+def dispatch_table(cls):
+    """Returns the dispatch table of a visitor class, creating it on first
+    use. Each subclass gets a table of its own, so that overriding a visitor
+    method in a subclass is honored.
+    """
+    table = cls.__dict__.get("_dispatch_table")
+    if table is None:
+        table = DispatchTable(cls)
+        cls._dispatch_table = table
+    return table
+
+
+class DispatchVisitor(object):
+    """Mixin for ast.NodeVisitor subclasses, which finds the visitor method
+    of each node through the dispatch table of the class, rather than by
+    building its name and calling getattr() for every node. It must come
+    before ast.NodeVisitor in the bases.
+
+    Visitor methods should be defined on the class. Methods that are set on
+    an instance are not seen by the dispatch table.
+    """
+
+    def __init__(self):
+        self.handlers = dispatch_table(type(self))
+
+    def visit(self, node):
+        """Visits a node with the handler of its type."""
+        return self.handlers[node.__class__](self, node)
@@ -7,32 +7,32 @@ from setuptools.command.install import install
 from setuptools.command.develop import develop
 
 
+# xonsh's lexer is not table-driven, so only the yacc table is prebuilt
 TABLES = [
-    "coral/lexer_table.py",
-    "coral/parser_table.py",
+    "coral/parser_table.pickle",
 ]
 
 
 def clean_tables():
-    """Remove the lexer/parser modules that are dynamically created."""
+    """Remove the parser tables that are dynamically created."""
     for f in TABLES:
         if os.path.isfile(f):
             os.remove(f)
             print("Removed " + f)
 
 def build_tables():
-    """Build the lexer/parser modules."""
-    print("Building lexer and parser tables.")
+    """Build the parser tables."""
+    print("Building parser tables.")
     sys.path.insert(0, os.path.dirname(__file__))
-    from coral.parser import Parser
+    try:
+        from coral.parser import build_table, write_table
 
-    Parser(
-        lexer_table="lexer_table",
-        yacc_table="parser_table",
-        outputdir="coral",
-        yacc_debug=True,
-    )
-    sys.path.pop(0)
+        # xonsh is only imported here, by build_table()
+        write_table(build_table(), TABLES[0])
+    except ImportError:
+        print("xonsh is not available, tables will be built on first use.")
+    finally:
+        sys.path.pop(0)
 
 
 class cinstall(install):
@@ -90,13 +90,20 @@ def main():
         ],
         package_dir={"coral": "coral"},
         package_data={
-            "coral": ["*.xsh"],
+            "coral": ["*.xsh", "*.pickle"],
         },
-        #cmdclass=cmdclass,
+        cmdclass=cmdclass,
         scripts=scripts,
+        entry_points={
+            "console_scripts": [
+                "coral = coral.main:main",
+                "coral-d = coral.daemon:main",
+            ],
+        },
         install_requires=[
             'lazyasd',
-            'xonsh',
+            # coral.parser relies on the internals of the xonsh parser
+            'xonsh>=0.9.27,<0.10',
         ],
     )
     skw["python_requires"] = ">=3.5"
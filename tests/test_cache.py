@@ -0,0 +1,100 @@
+"""Tests coral caches"""
+import os
+import sys
+import time
+
+from coral.cache import Cache, TreeCache, content_hash, version_key
+from coral.formatter import format
+from coral.parser import parse_commented
+
+
+def test_content_hash():
+    assert content_hash("x = 42\n") == content_hash("x = 42\n")
+    assert content_hash("x = 42\n") != content_hash("x = 43\n")
+
+
+def test_cache_roundtrip(tmpdir):
+    filename = os.path.join(str(tmpdir), "sub", "cache.txt")
+    cache = Cache(filename)
+    assert len(cache) == 0
+    cache.add("abc")
+    assert "abc" in cache
+    cache.write()
+    assert "abc" in Cache(filename)
+
+
+def test_cache_write_merges(tmpdir):
+    filename = os.path.join(str(tmpdir), "cache.txt")
+    first, second = Cache(filename), Cache(filename)
+    first.add("abc")
+    second.add("def")
+    first.write()
+    second.write()
+    assert set(Cache(filename).hashes) == {"abc", "def"}
+
+
+def test_cache_drops_old_hashes(tmpdir):
+    filename = os.path.join(str(tmpdir), "cache.txt")
+    day = 24 * 60 * 60
+    now = int(time.time())
+    with open(filename, "w") as f:
+        f.write("old {0}\nseen {1}\nnew {2}\n".format(now - 4 * day, now - 2 * day, now))
+    cache = Cache(filename, max_age=3 * day)
+    assert "old" in cache
+    # hashes are given a new time when they are added again
+    cache.add("seen")
+    cache.add("abc")
+    cache.write()
+    hashes = Cache(filename).hashes
+    assert set(hashes) == {"seen", "new", "abc"}
+    assert hashes["seen"] >= now
+
+
+def test_cache_default_location(monkeypatch, tmpdir):
+    monkeypatch.setenv("CORAL_CACHE_DIR", str(tmpdir))
+    cache = Cache()
+    assert os.path.dirname(cache.filename) == str(tmpdir)
+    assert version_key() in os.path.basename(cache.filename)
+    assert "py{0}.{1}".format(*sys.version_info[:2]) in cache.filename
+
+
+def test_tree_cache_roundtrip(tmpdir):
+    cache = TreeCache(str(tmpdir))
+    key = cache.key("x = 42\n", lang="python")
+    assert key != cache.key("x = 42\n", lang="xonsh")
+    assert cache.get(key) is None
+    cache.put(key, ("tree", [1, 2], {3: "x = 42\n"}))
+    assert TreeCache(str(tmpdir)).get(key) == ("tree", [1, 2], {3: "x = 42\n"})
+
+
+def test_tree_cache_drops_corrupt_entries(tmpdir):
+    cache = TreeCache(str(tmpdir))
+    key = cache.key("x = 42\n")
+    cache.put(key, "tree")
+    (filename,) = os.listdir(str(tmpdir))
+    with open(os.path.join(str(tmpdir), filename), "wb") as f:
+        f.write(b"not a pickle")
+    assert cache.get(key) is None
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_tree_cache_evicts_least_recently_used(tmpdir):
+    cache = TreeCache(str(tmpdir), max_bytes=10000)
+    keys = [cache.key(str(i)) for i in range(4)]
+    for i, key in enumerate(keys):
+        cache.put(key, "x" * 3000)
+        path = os.path.join(str(tmpdir), key + ".pickle")
+        os.utime(path, (i, i))
+    assert cache.size() <= 7500
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[3]) is not None
+
+
+def test_parse_commented_uses_cache(tmpdir):
+    cache = TreeCache(str(tmpdir))
+    source = "x = 42  # the answer\n"
+    tree, comments, lines = parse_commented(source, lang="python", cache=cache)
+    assert len(os.listdir(str(tmpdir))) == 1
+    cached, _, _ = parse_commented(source, lang="python", cache=cache)
+    assert cached is not tree
+    assert format(cached) == format(tree)
@@ -0,0 +1,113 @@
+"""Tests the coral server and client"""
+import os
+import json
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from coral.cache import Cache, content_hash
+from coral.daemon import Client, DaemonError, FormatService, make_server, parse_address
+from coral.main import main
+
+
+@pytest.fixture
+def address(tmpdir):
+    address = os.path.join(str(tmpdir), "coral.sock")
+    service = FormatService(jobs=2)
+    service.warm()
+    server = make_server(address, service=service)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield address
+    server.shutdown()
+    thread.join()
+    server.server_close()
+    service.close()
+
+
+def test_parse_address():
+    assert parse_address("localhost:7755")[1] == ("localhost", 7755)
+    assert parse_address("/tmp/coral.sock")[1] == "/tmp/coral.sock"
+
+
+def test_ping(address):
+    with Client(address) as client:
+        assert client.request("ping")["status"] == "ok"
+
+
+def test_format_and_check(address):
+    with Client(address) as client:
+        response = client.request("format", source="x    =    42\n")
+        assert response == {"status": "ok", "changed": True, "output": "x = 42\n"}
+        response = client.request("check", source="x = 42\n")
+        assert response == {"status": "ok", "changed": False}
+        assert client.reformat("x    =    42\n") == "x = 42\n"
+
+
+def test_service_caches_unchanged_sources(tmpdir):
+    service = FormatService(jobs=1, cache=Cache(os.path.join(str(tmpdir), "c")))
+    try:
+        assert service.reformat("x    =    42\n") == "x = 42\n"
+        assert content_hash("x = 42\n") not in service.cache
+        assert service.reformat("x = 42\n") == "x = 42\n"
+        assert content_hash("x = 42\n") in service.cache
+    finally:
+        service.close()
+
+
+def test_service_rejects_unsafe_output(address):
+    # inline comments on returns are not formatted yet
+    source = "def f(a):\n    return  a  # inline\n"
+    with Client(address) as client:
+        response = client.request("format", source=source)
+    assert response["status"] == "error"
+    assert response["message"].startswith("UnsafeFormatError")
+
+
+def test_format_error(address):
+    with Client(address) as client:
+        response = client.request("format", source="def (:\n")
+        assert response["status"] == "error"
+        assert response["message"].startswith("SyntaxError")
+        with pytest.raises(DaemonError):
+            client.reformat("def (:\n")
+        assert client.request("bogus")["status"] == "error"
+
+
+def test_malformed_requests(address):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(address)
+        f = s.makefile("rwb")
+        f.write(b'[]\n"x"\n1\n{\n{"command": "ping"}\n')
+        f.flush()
+        responses = [json.loads(f.readline().decode("utf-8")) for _ in range(5)]
+    malformed = {"status": "error", "message": "malformed request"}
+    assert responses[:4] == [malformed] * 4
+    assert responses[4]["status"] == "ok"
+
+
+def test_concurrent_clients(address):
+    def check(i):
+        with Client(address) as client:
+            return client.reformat("x    =    {0}\n".format(i))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        obs = list(pool.map(check, range(32)))
+    assert obs == ["x = {0}\n".format(i) for i in range(32)]
+
+
+def test_main_client(address, tmpdir, monkeypatch):
+    path = os.path.join(str(tmpdir), "a.py")
+    with open(path, "w") as f:
+        f.write("x    =    42\n")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("output was checked by the client")
+
+    # the server checks the output, so the client does not parse it again
+    monkeypatch.setattr("coral.formatter.check_output", fail)
+    assert main(["--client", "--address", address, path]) == 0
+    with open(path) as f:
+        assert f.read() == "x = 42\n"
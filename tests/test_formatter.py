@@ -1,15 +1,31 @@
-import builtins
+import io
+import ast
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
 from xonsh.ast import pdump, pprint_ast
 
-from coral.formatter import reformat
+from coral.formatter import (
+    ComparingWriter,
+    FormatMemo,
+    UnsafeFormatError,
+    check_output,
+    format,
+    format_to,
+    is_formatted,
+    matches,
+    reformat,
+    reformat_range,
+    reformat_ranges,
+    reformat_stream,
+)
+from coral.parser import parse, add_comments
 
-from tools import nodes_equal
+from tools import MULTI_FUNCTION_SOURCE, nodes_equal, xonsh_session
 
 
-@pytest.mark.parametrize("inp, exp", [
+CASES = [
 ("#a bad comment\n", "# a bad comment\n"),
 ("'single quotes'", '"single quotes"'),
 # (r'r"\raw"', r'r"\raw"'),
@@ -142,9 +158,12 @@ from tools import nodes_equal
 ("raise   \n", "raise\n"),
 ("raise     Exception\n", "raise Exception\n"),
 ("raise     Exception  from   KeyError  \n", "raise Exception from KeyError\n"),
-])
+]
+
+
+@pytest.mark.parametrize("inp, exp", CASES)
 def test_formatting(inp, exp):
-    execer =  builtins.__xonsh__.execer
+    execer = xonsh_session().execer
     # first check that we get what we expect
     try:
         obs = reformat(inp)
@@ -161,3 +180,321 @@ def test_formatting(inp, exp):
     exp_tree = execer.parse(exp, {})
     obs_tree = execer.parse(obs, {})
     assert nodes_equal(exp_tree, obs_tree, check_attributes=False)
+
+
+@pytest.mark.parametrize("inp, exp", CASES)
+@pytest.mark.parametrize("lang", ["auto", "python"])
+def test_formatting_lang(inp, exp, lang):
+    assert reformat(inp, lang=lang) == exp
+
+
+# defines the names used below, which would otherwise be read as commands
+NAMES = "a = b = c = x = y = 1\n"
+# code whose statements CPython and xonsh put in different places
+POSITION_CASES = [
+    NAMES + "while x:\n    y = 1\n    # in the while\nz = 2\n",
+    NAMES + "def f():\n    while x:\n        y = 1\n# after f\n",
+    NAMES + "if a:\n    pass\nelif not b:\n    pass\n# trailing\n",
+    NAMES + "if a:\n    pass\nelif not b:\n        pass\n      # trailing\n",
+    NAMES + "if a:\n    pass\nelif (a) and b:\n          pass\n     # trailing\n",
+    NAMES + "if a:\n    pass\nelif a + b - c > 1:\n          pass\n      # trailing\n",
+    NAMES + '"""a\ndocstring"""  # on docstring\nx = 1\n',
+    NAMES + "if x:\n    (a, b), c = x\n    # trailing\n",
+    NAMES + "class A:\n    async def f():\n        pass\n    # trailing\n",
+    NAMES + "while (\n    x\n):\n    y = 1\n    # in the while\n# after\nz = 2\n",
+    # a while loop that ends the code, with no statement before it
+    "while x:\n    a = 1\n# c\n",
+]
+
+
+@pytest.mark.parametrize("inp", POSITION_CASES)
+def test_formatting_lang_positions(inp):
+    exp = reformat(inp, lang="xonsh")
+    assert reformat(inp, lang="auto") == exp
+    assert reformat(inp, lang="python") == exp
+
+
+def test_formatting_lang_subproc():
+    inp = "ls -l\nx = $HOME\n"
+    assert reformat(inp, lang="auto") == reformat(inp, lang="xonsh")
+    assert reformat("ls -l\n", lang="python") == "ls - l\n"
+
+
+def test_format_deep_tree():
+    n = 20000
+    tree = ast.Name(id="a0", ctx=ast.Load())
+    for i in range(1, n):
+        tree = ast.BinOp(left=tree, op=ast.Add(), right=ast.Name(id="a" + str(i)))
+    tree = ast.Module(body=[ast.Expr(value=tree)])
+    exp = " + ".join("a" + str(i) for i in range(n)) + "\n"
+    assert format(tree) == exp
+    assert nodes_equal(tree, tree, check_attributes=False)
+
+
+@pytest.mark.parametrize("lang", ["xonsh", "python"])
+def test_reformat_deep_chains(lang):
+    inp = "x = " + "+".join(["a"] * 3000) + "\n"
+    assert reformat(inp, lang=lang) == "x = " + " + ".join(["a"] * 3000) + "\n"
+    inp = "x = a" + ".b()" * 2000 + "\n"
+    assert reformat(inp, lang=lang) == inp
+
+
+def test_formatting_threaded():
+    inps = [inp for inp, exp in CASES] * 4
+    exps = [exp for inp, exp in CASES] * 4
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        obs = list(pool.map(reformat, inps))
+    assert obs == exps
+
+
+def test_format_to():
+    code = (
+        "class   A :\n"
+        "  def f( x ) :\n"
+        "    for  i   in x :\n"
+        "      while  i :  break\n"
+        "    return   x\n"
+        "if  y :\n"
+        "  y  =  1\n"
+        "else :\n"
+        "  y  =  2\n"
+    )
+    tree, comments, lines = parse(code)
+    tree = add_comments(tree, comments, lines)
+    exp = format(tree)
+    stream = io.StringIO()
+    format_to(tree, stream)
+    assert stream.getvalue() == exp
+    assert reformat(exp) == exp
+
+
+@pytest.mark.parametrize("inp, exp", CASES)
+def test_is_formatted(inp, exp):
+    assert is_formatted(exp)
+    assert is_formatted(inp) == (inp == exp)
+
+
+def test_is_formatted_stops_early():
+    writer = ComparingWriter("x = 1\n")
+    writer("x = ")
+    with pytest.raises(Exception):
+        writer("2")
+    assert writer.pos == 4
+    assert not writer.matched
+    # the second statement cannot be formatted, so formatting has to stop
+    # at the difference in the first one
+    tree = ast.parse("x = 1\ny = 2\n")
+    tree.body[1].targets[0].id = None
+    assert not matches(tree, "x = 2\ny = 2\n")
+    with pytest.raises(TypeError):
+        matches(tree, "x = 1\ny = 2\n")
+    assert not is_formatted("x = 1\ny = 2", lang="python")
+    assert not is_formatted("x = 1\ny = 2\n\n")
+
+
+@pytest.mark.parametrize("inp", ["", "\n", "\n\n"])
+@pytest.mark.parametrize("lang", ["xonsh", "python"])
+def test_reformat_empty(inp, lang):
+    assert reformat(inp, lang=lang) == ""
+    assert is_formatted("", lang=lang)
+
+
+def test_check_output():
+    check_output("x  =  1\n", "x = 1\n")
+    check_output("", "")
+    check_output("'<coral:'\n", '"<coral:"\n', lang="python")
+    with pytest.raises(UnsafeFormatError):
+        check_output("x = 1\n", "x = <coral:Foo not implemented>\n")
+    with pytest.raises(UnsafeFormatError):
+        check_output("x = 1\n", "x = 2\n")
+    with pytest.raises(UnsafeFormatError):
+        check_output("x = 1\n", "x = (\n", lang="python")
+
+
+MEMO_SOURCE = (
+    "x = {'key': [alpha + beta, (gamma, delta)], 'other': f(alpha, beta=1)}\n"
+    "y = {'key': [alpha + beta, (gamma, delta)], 'other': f(alpha, beta=1)}\n"
+    'z = f"{alpha + beta + gamma}-{alpha + beta + delta}"\n'
+    'w = "\u00e9" + (alpha + beta + gamma)\n'
+    "v = (alpha + beta + gamma)\n"
+)
+
+
+def test_format_memo():
+    memo = FormatMemo()
+    exp = reformat(MEMO_SOURCE, lang="python")
+    assert reformat(MEMO_SOURCE, lang="python", memo=memo) == exp
+    assert memo.hits == 2
+    assert 0.0 < memo.hit_rate < 1.0
+    # a shared memo is reused across sources
+    assert reformat(MEMO_SOURCE, lang="python", memo=memo) == exp
+    assert memo.misses == memo.as_dict()["misses"] == len(memo)
+
+
+def test_format_memo_bounded():
+    memo = FormatMemo(maxsize=2)
+    exp = reformat(MEMO_SOURCE, lang="python")
+    assert reformat(MEMO_SOURCE, lang="python", memo=memo) == exp
+    assert len(memo) == 2
+    memo.clear()
+    assert len(memo) == memo.hits == memo.misses == 0
+
+
+def test_format_memo_fingerprint():
+    memo = FormatMemo()
+    tree = ast.parse("f(a, [1, 2]) + f(a, [1, 2]) + f(a, [1.0, 2]) + f(b, [1, 2])")
+    fingerprints = {}
+    calls = [n for n in ast.walk(tree) if isinstance(n, ast.Call)]
+    ids = {memo.fingerprint(n, fingerprints)[0] for n in calls}
+    assert len(ids) == 3
+    assert memo.fingerprint(calls[0], fingerprints)[1] > 8
+    # ids are not reused once the structures are cleared
+    memo.clear()
+    assert not ids & {memo.fingerprint(n, {})[0] for n in calls}
+
+
+def test_format_memo_requires_python():
+    with pytest.raises(ValueError):
+        reformat(MEMO_SOURCE, memo=FormatMemo())
+
+
+@pytest.mark.parametrize(
+    "inp",
+    [
+        "x  =  1\n",
+        "x",
+        "# a comment\nx  =  1\ndef f( a ) :\n    return  a  # inline\n"
+        "    # trailing\n\ny = [1,\n 2]\nif x :\n  pass\nelse :\n  pass\nz=3\n",
+        "@dec\ndef f():\n  pass\nclass C:\n  x = 1\n# the end\n",
+        # names defined by earlier statements are in the context
+        "ls = 1\nls -l\nls\n",
+        "echo hi\nx  =  $(pwd)\n",
+        # the comment is between the loop and the next statement
+        "while x:\n    a = 1\n# c\nz = 3\n",
+        MULTI_FUNCTION_SOURCE,
+    ],
+)
+@pytest.mark.parametrize("lang", ["xonsh", "auto", "python"])
+def test_reformat_stream(inp, lang):
+    if lang == "python" and "echo" in inp:
+        pytest.skip("xonsh code")
+    out = io.StringIO()
+    reformat_stream(io.StringIO(inp), out, lang=lang)
+    assert out.getvalue() == reformat(inp, lang=lang)
+
+
+def test_reformat_stream_while():
+    out = io.StringIO()
+    reformat_stream(io.StringIO("while x:\n    a  =  1\n# c\nz = 3\n"), out)
+    assert out.getvalue() == "while x:\n    a = 1\n\n# c\nz = 3\n"
+
+
+@pytest.mark.parametrize("lang", ["xonsh", "auto", "python"])
+def test_reformat_stream_unterminated(lang):
+    out = io.StringIO()
+    inp = "x  =  1\ny  =  2"
+    if lang == "python":
+        reformat_stream(io.StringIO(inp), out, lang=lang)
+        assert out.getvalue() == "x = 1\ny = 2\n"
+    else:
+        # the xonsh parser reads unterminated code as an expression
+        with pytest.raises(SyntaxError):
+            reformat_stream(io.StringIO(inp), out, lang=lang)
+        with pytest.raises(SyntaxError):
+            reformat(inp, lang=lang)
+
+
+RANGE_SOURCE = (
+    "x  =  1\n"
+    "y  =  2\n"
+    "\n"
+    "def f( a ) :\n"
+    "    b  =  a\n"
+    "    for i in a :\n"
+    "        c  =  i\n"
+    "    return  c\n"
+    "\n"
+    "z  =  3\n"
+)
+
+
+@pytest.mark.parametrize(
+    "start, end, exp",
+    [
+        (1, 1, "x = 1\n" + RANGE_SOURCE[8:]),
+        (2, 2, RANGE_SOURCE.replace("y  =  2", "y = 2")),
+        # only blank lines
+        (3, 3, RANGE_SOURCE),
+        (5, 5, RANGE_SOURCE.replace("b  =  a", "b = a")),
+        (7, 7, RANGE_SOURCE.replace("c  =  i", "c = i")),
+        (
+            6,
+            6,
+            RANGE_SOURCE.replace(
+                "for i in a :\n        c  =  i", "for i in a:\n        c = i"
+            ),
+        ),
+        (1, 10, reformat(RANGE_SOURCE)),
+    ],
+)
+def test_reformat_range(start, end, exp):
+    assert reformat_range(RANGE_SOURCE, start, end) == exp
+
+
+def test_reformat_range_other_indentation():
+    inp = "x  =  1\ndef f():\n  a  =  1\n  b  =  2\n"
+    # the block cannot be indented differently, so all of f is formatted
+    exp = "x  =  1\ndef f():\n    a = 1\n    b = 2\n"
+    assert reformat_range(inp, 3, 3) == exp
+
+
+def test_reformat_range_context():
+    # names defined before the formatted lines are in the context, so 'ls'
+    # is a name rather than a subprocess command
+    inp = "ls = 1\nx  =  2\nls\n"
+    assert reformat_range(inp, 3, 3) == inp
+    assert reformat_range(inp, 2, 2) == "ls = 1\nx = 2\nls\n"
+    # xonsh code before the lines is parsed along with them
+    inp = "echo hi\nx  =  1\n"
+    assert reformat_range(inp, 2, 2) == "echo hi\nx = 1\n"
+
+
+@pytest.mark.parametrize("inp", ["", "\n\n", "# only a comment\n"])
+def test_reformat_range_blank(inp):
+    assert reformat_range(inp, 1, 1) == inp
+
+
+@pytest.mark.parametrize("start, end", [(0, 0), (0, 1), (2, 1), (-1, 3)])
+def test_reformat_range_invalid(start, end):
+    with pytest.raises(ValueError):
+        reformat_range(RANGE_SOURCE, start, end)
+
+
+def test_reformat_ranges():
+    assert reformat_ranges(RANGE_SOURCE, []) == RANGE_SOURCE
+    exp = RANGE_SOURCE.replace("y  =  2", "y = 2").replace("z  =  3", "z = 3")
+    assert reformat_ranges(RANGE_SOURCE, [(10, 10), (2, 2)]) == exp
+    # ranges in the same top-level statement are formatted together, even
+    # if formatting one of them moves the lines of the other
+    inp = "x = [1,\n  2,\n  3]\ny  =  2\n"
+    exp = "x = [1, 2, 3]\ny  =  2\n"
+    assert reformat_ranges(inp, [(1, 1), (3, 3)]) == exp
+
+
+@pytest.mark.parametrize("lang", ["xonsh", "auto", "python"])
+def test_reformat_range_statements(lang):
+    inp = (
+        "x = (1,\n"
+        "  2)\n"
+        "@dec\n"
+        "def f( a ) :\n"
+        "    if a :\n"
+        "        return  a\n"
+        "    else :\n"
+        "        return  2\n"
+        "y  =  3\n"
+    )
+    exp = inp.replace("return  2", "return 2")
+    assert reformat_range(inp, 8, 8, lang=lang) == exp
+    exp = "x = (1, 2)\n" + inp[inp.index("@dec") :]
+    assert reformat_range(inp, 2, 2, lang=lang) == exp
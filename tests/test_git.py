@@ -0,0 +1,200 @@
+"""Tests finding changed files with git"""
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from coral.git import (
+    GitError,
+    unquote_path,
+    changed_files,
+    changed_lines,
+    parse_diff_ranges,
+)
+from coral.main import main
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir_factory, monkeypatch):
+    d = str(tmpdir_factory.mktemp("cache"))
+    monkeypatch.setenv("CORAL_CACHE_DIR", d)
+    return d
+
+
+def git(repo, *args):
+    cmd = ["git", "-c", "user.name=coral", "-c", "user.email=coral@example.com"]
+    subprocess.run(cmd + list(args), cwd=repo, check=True, stdout=subprocess.PIPE)
+
+
+def write(repo, name, content):
+    path = os.path.join(repo, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+def read(repo, name):
+    with open(os.path.join(repo, name)) as f:
+        return f.read()
+
+
+@pytest.fixture
+def repo(tmpdir):
+    repo = os.path.realpath(str(tmpdir))
+    git(repo, "init", "-q")
+    write(repo, "a.py", "a = 1\nb = 2\nc = 3\nd = 4\n")
+    write(repo, "b.py", "x    =    1\n")
+    write(repo, "sub/c.xsh", "y    =    2\n")
+    write(repo, "notes.txt", "z    =    3\n")
+    git(repo, "add", ".")
+    git(repo, "commit", "-q", "-m", "initial")
+    return repo
+
+
+def test_changed_files(repo):
+    exts = {".py", ".xsh"}
+    assert changed_files(since="HEAD", cwd=repo) == []
+    write(repo, "a.py", "a = 1\nb  =  2\nc = 3\nd = 4\n")
+    write(repo, "notes.txt", "changed\n")
+    write(repo, "new.py", "n = 1\n")
+    write(repo, "sub/c.xsh", "y  =  2\n")
+    obs = changed_files(since="HEAD", extensions=exts, cwd=repo)
+    exp = [os.path.join(repo, p) for p in ["a.py", "new.py", "sub/c.xsh"]]
+    assert obs == exp
+    obs = changed_files(since="HEAD", paths=[os.path.join(repo, "sub")], cwd=repo)
+    assert obs == [os.path.join(repo, "sub", "c.xsh")]
+    assert changed_files(staged=True, cwd=repo) == []
+    git(repo, "add", "new.py")
+    assert changed_files(staged=True, cwd=repo) == [os.path.join(repo, "new.py")]
+
+
+def test_changed_lines(repo):
+    write(repo, "a.py", "a = 1\nb  =  2\nc = 3\nnew = 0\nd = 4\n")
+    write(repo, "b.py", "")
+    write(repo, "new.py", "n = 1\n")
+    obs = changed_lines(since="HEAD", cwd=repo)
+    assert obs == {
+        os.path.join(repo, "a.py"): [(2, 2), (4, 4)],
+        os.path.join(repo, "b.py"): [],
+        os.path.join(repo, "new.py"): None,
+    }
+
+
+def test_parse_diff_ranges():
+    diff = (
+        "diff --git a/x.py b/x.py\n"
+        "--- a/x.py\n"
+        "+++ b/x.py\n"
+        "@@ -1 +1 @@\n"
+        "-a\n"
+        "+b\n"
+        "@@ -5,0 +6,3 @@\n"
+        "@@ -10,2 +12,0 @@\n"
+        "diff --git a/gone.py b/gone.py\n"
+        "--- a/gone.py\n"
+        "+++ /dev/null\n"
+        "@@ -1 +0,0 @@\n"
+    )
+    assert parse_diff_ranges(diff, root="r") == {
+        os.path.join("r", "x.py"): [(1, 1), (6, 8)]
+    }
+
+
+@pytest.mark.parametrize(
+    "name, exp",
+    [
+        ("a.py", "a.py"),
+        ('"b/a\\303\\251.py"', "b/a\u00e9.py"),
+        ('"b/tab\\there.py"', "b/tab\there.py"),
+        ('"b/q\\"uote\\\\d.py"', 'b/q"uote\\d.py'),
+        ('"b/new\\nline.py"', "b/new\nline.py"),
+    ],
+)
+def test_unquote_path(name, exp):
+    assert unquote_path(name) == exp
+
+
+def test_parse_diff_ranges_quoted():
+    diff = (
+        '+++ "b/a\\303\\251 \\"x\\".py"\n'
+        "@@ -1 +1,2 @@\n"
+    )
+    assert parse_diff_ranges(diff, root="r") == {
+        os.path.join("r", 'a\u00e9 "x".py'): [(1, 2)]
+    }
+
+
+def test_changed_lines_quoted(repo):
+    name = 'q"uote\u00e9.py'
+    write(repo, name, "a = 1\n")
+    git(repo, "add", ".")
+    git(repo, "commit", "-q", "-m", "quoted")
+    write(repo, name, "a = 1\nb = 2\n")
+    obs = changed_lines(since="HEAD", cwd=repo)
+    assert obs == {os.path.join(repo, name): [(2, 2)]}
+
+
+def test_not_a_repo(tmpdir):
+    with pytest.raises(GitError):
+        changed_files(since="HEAD", cwd=str(tmpdir))
+
+
+def test_main_changed_since(repo, monkeypatch):
+    monkeypatch.chdir(repo)
+    write(repo, "new.py", "n    =    1\n")
+    assert main(["--jobs", "1", "--changed-since", "HEAD"]) == 0
+    assert read(repo, "new.py") == "n = 1\n"
+    # unchanged files are left alone, even if they are not formatted
+    assert read(repo, "b.py") == "x    =    1\n"
+    git(repo, "add", ".")
+    git(repo, "commit", "-q", "-m", "new")
+    write(repo, "sub/c.xsh", "y  =  2\n")
+    assert main(["--jobs", "1", "--changed-since", "HEAD~1", "sub"]) == 0
+    assert read(repo, "sub/c.xsh") == "y = 2\n"
+    assert read(repo, "b.py") == "x    =    1\n"
+
+
+def test_main_staged(repo, monkeypatch, capsys):
+    monkeypatch.chdir(repo)
+    write(repo, "b.py", "x   =   1\n")
+    write(repo, "sub/c.xsh", "y  =  2\n")
+    git(repo, "add", "b.py")
+    assert main(["--check", "--staged"]) == 1
+    err = capsys.readouterr().err
+    assert "would reformat " + os.path.join(repo, "b.py") in err
+    assert "c.xsh" not in err
+    assert main(["--jobs", "1", "--staged"]) == 0
+    assert read(repo, "b.py") == "x = 1\n"
+
+
+def test_main_changed_lines(repo, monkeypatch, capsys):
+    monkeypatch.chdir(repo)
+    write(repo, "a.py", "a  =  1\nb  =  2\nc  =  3\n")
+    git(repo, "commit", "-q", "-am", "unformatted")
+    write(repo, "a.py", "a  =  1\nb  =  20\nc  =  3\n")
+    write(repo, "new.py", "n    =    1\n")
+    args = ["--jobs", "1", "--changed-since", "HEAD", "--changed-lines"]
+    assert main(["--check"] + args) == 1
+    assert main(args) == 0
+    assert read(repo, "a.py") == "a  =  1\nb = 20\nc  =  3\n"
+    # untracked files are formatted whole
+    assert read(repo, "new.py") == "n = 1\n"
+    # the lines of staged files are found in the working tree
+    write(repo, "a.py", "a  =  1\nb  =  20\nc  =  30\n")
+    git(repo, "add", "a.py")
+    write(repo, "a.py", "x  =  0\na  =  1\nb  =  20\nc  =  30\n")
+    assert main(["--jobs", "1", "--staged", "--changed-lines"]) == 0
+    assert read(repo, "a.py") == "x = 0\na  =  1\nb = 20\nc = 30\n"
+    with pytest.raises(SystemExit):
+        main(["--changed-lines", "a.py"])
+    assert "--changed-lines requires" in capsys.readouterr().err
+
+
+def test_main_not_a_repo(tmpdir, monkeypatch, capsys):
+    monkeypatch.chdir(str(tmpdir))
+    assert main(["--changed-since", "HEAD"]) == 1
+    assert "error: git" in capsys.readouterr().err
@@ -0,0 +1,50 @@
+"""Tests that importing coral stays cheap"""
+import os
+import sys
+import subprocess
+
+import pytest
+
+# cumulative import time budget for 'import coral', in microseconds
+IMPORT_BUDGET = 100000
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importtime(module):
+    """Imports a module in a fresh interpreter, returning a dict mapping the
+    names of all modules that were imported to their cumulative import times.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+pytestmark = pytest.mark.skipif(
+    sys.version_info < (3, 7), reason="-X importtime requires Python 3.7+"
+)
+
+
+def test_import_coral_budget():
+    times = importtime("coral")
+    assert times["coral"] < IMPORT_BUDGET
+
+
+@pytest.mark.parametrize("module", ["coral", "coral.formatter", "coral.main"])
+def test_import_does_not_load_xonsh_parser(module):
+    times = importtime(module)
+    assert "xonsh.execer" not in times
+    assert "xonsh.lexer" not in times
@@ -0,0 +1,251 @@
+"""Tests the coral command line interface"""
+import os
+import json
+import time
+
+import pytest
+
+import coral.main
+from coral.main import (
+    FAILED,
+    REFORMATTED,
+    UNCHANGED,
+    FileResult,
+    collect_files,
+    format_file,
+    main,
+)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir_factory, monkeypatch):
+    d = str(tmpdir_factory.mktemp("cache"))
+    monkeypatch.setenv("CORAL_CACHE_DIR", d)
+    return d
+
+
+def write_files(root, files):
+    for name, content in files.items():
+        path = os.path.join(str(root), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+
+def read_file(root, name):
+    with open(os.path.join(str(root), name)) as f:
+        return f.read()
+
+
+def test_collect_files(tmpdir):
+    write_files(tmpdir, {
+        "a.py": "",
+        "b.txt": "",
+        "sub/c.xsh": "",
+        ".hidden/d.py": "",
+    })
+    obs = [os.path.relpath(p, str(tmpdir)) for p in collect_files([str(tmpdir)])]
+    assert obs == ["a.py", os.path.join("sub", "c.xsh")]
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_main_formats_files(tmpdir, jobs):
+    write_files(tmpdir, {
+        "a.py": "x    =    42\n",
+        "b.xsh": "x = 42\n",
+        "sub/c.py": "if    True  :  \n  pass  \n",
+    })
+    assert main(["--jobs", jobs, str(tmpdir)]) == 0
+    assert read_file(tmpdir, "a.py") == "x = 42\n"
+    assert read_file(tmpdir, "b.xsh") == "x = 42\n"
+    assert read_file(tmpdir, "sub/c.py") == "if True:\n    pass\n"
+
+
+def test_main_isolates_failures(tmpdir, capsys):
+    write_files(tmpdir, {
+        "bad.py": "def (:\n",
+        "good.py": "x    =    42\n",
+    })
+    assert main(["--jobs", "2", str(tmpdir)]) == 1
+    assert read_file(tmpdir, "bad.py") == "def (:\n"
+    assert read_file(tmpdir, "good.py") == "x = 42\n"
+    err = capsys.readouterr().err
+    assert "cannot format " + os.path.join(str(tmpdir), "bad.py") in err
+    assert "1 file failed to reformat" in err
+
+
+def test_main_skips_cached_files(tmpdir, monkeypatch):
+    write_files(tmpdir, {"a.py": "x    =    42\n"})
+    assert main(["--jobs", "1", str(tmpdir)]) == 0
+    assert read_file(tmpdir, "a.py") == "x = 42\n"
+    # the reformatted file is only cached once it is found to be unchanged
+    assert main(["--jobs", "1", str(tmpdir)]) == 0
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached file was parsed")
+
+    monkeypatch.setattr("coral.session.CoralSession.reformat", fail)
+    assert main(["--jobs", "1", str(tmpdir)]) == 0
+    assert main(["--jobs", "1", "--no-cache", str(tmpdir)]) == 1
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_main_profile(tmpdir, capsys, jobs):
+    write_files(tmpdir, {"a.py": "x    =    42\n", "b.py": "y = 1\n"})
+    profile_dir = os.path.join(str(tmpdir), "profiles")
+    args = ["--jobs", jobs, "--profile-dir", profile_dir, str(tmpdir)]
+    assert main(args) == 0
+    err = capsys.readouterr().err
+    assert "profiled 2 files" in err
+    assert "slowest files:" in err
+    assert os.path.exists(os.path.join(profile_dir, "parse.pstats"))
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_main_check(tmpdir, capsys, monkeypatch, jobs):
+    write_files(tmpdir, {"a.py": "x    =    42\n", "b.py": "y = 1\n"})
+    assert main(["--check", "--jobs", jobs, str(tmpdir)]) == 1
+    assert read_file(tmpdir, "a.py") == "x    =    42\n"
+    err = capsys.readouterr().err
+    assert "would reformat " + os.path.join(str(tmpdir), "a.py") in err
+    assert "b.py" not in err
+    assert "1 file would be reformatted, 1 file would be left unchanged" in err
+
+    def fail(*args, **kwargs):
+        raise AssertionError("checked file was parsed")
+
+    # files that were found to be formatted are not parsed again
+    monkeypatch.setattr("coral.session.CoralSession.is_formatted", fail)
+    b = os.path.join(str(tmpdir), "b.py")
+    assert main(["--check", "--jobs", "1", b]) == 0
+    err = capsys.readouterr().err
+    assert "0 files would be reformatted, 1 file would be left unchanged" in err
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_main_stream(tmpdir, capsys, jobs):
+    write_files(tmpdir, {
+        "a.py": "x    =    42\ndef f( a ) :\n    return  a\n",
+        "b.py": "y = 1\n",
+    })
+    exp = "x = 42\ndef f(a):\n    return a\n"
+    assert main(["--stream", "--check", "--jobs", jobs, str(tmpdir)]) == 1
+    assert main(["--stream", "--jobs", jobs, str(tmpdir)]) == 0
+    assert read_file(tmpdir, "a.py") == exp
+    assert read_file(tmpdir, "b.py") == "y = 1\n"
+    assert sorted(os.listdir(str(tmpdir))) == ["a.py", "b.py"]
+    err = capsys.readouterr().err
+    assert "1 file reformatted, 1 file left unchanged" in err
+
+
+def test_main_stream_check(tmpdir, capsys, monkeypatch):
+    write_files(tmpdir, {"a.py": "x    =    42\n", "b.py": "y = 1\n"})
+
+    def fail(*args, **kwargs):
+        raise AssertionError("checked file was written")
+
+    # checking only hashes the output, without a temporary file
+    monkeypatch.setattr("coral.main.AtomicWriter", fail)
+    assert main(["--stream", "--check", "--jobs", "1", str(tmpdir)]) == 1
+    assert read_file(tmpdir, "a.py") == "x    =    42\n"
+    err = capsys.readouterr().err
+    assert "1 file would be reformatted, 1 file would be left unchanged" in err
+
+
+def test_main_split(tmpdir, capsys):
+    write_files(tmpdir, {
+        "a.py": "x    =    42\ndef f( a ) :\n    return  a\ny = 1\n",
+        "b.xsh": "y = 1\n",
+    })
+    exp = "x = 42\ndef f(a):\n    return a\n\ny = 1\n"
+    assert main(["--split", "--check", "--jobs", "2", str(tmpdir)]) == 1
+    assert main(["--split", "--jobs", "2", str(tmpdir)]) == 0
+    assert read_file(tmpdir, "a.py") == exp
+    assert read_file(tmpdir, "b.xsh") == "y = 1\n"
+    err = capsys.readouterr().err
+    assert "1 file reformatted, 1 file left unchanged" in err
+
+
+def test_main_visit_stats(tmpdir, capsys):
+    write_files(tmpdir, {"src/a.py": "x    =    42\n", "src/b.py": "y = [1]\n"})
+    filename = os.path.join(str(tmpdir), "visits.json")
+    src = os.path.join(str(tmpdir), "src")
+    assert main(["--visit-stats", filename, "--jobs", "2", src]) == 0
+    with open(filename) as f:
+        visits = json.load(f)
+    assert visits["nodes"]["Assign"]["visits"] == 2
+    assert visits["nodes"]["List"]["visits"] == 1
+    assert "wrote " + filename in capsys.readouterr().err
+
+
+def test_format_file_writes_only_changes(tmpdir):
+    write_files(tmpdir, {"a.py": "x = 1\n", "b.py": "y    =    2\n"})
+    reformat = lambda inp, **kw: inp.replace("    =    ", " = ")
+    a, b = (os.path.join(str(tmpdir), name) for name in ["a.py", "b.py"])
+    os.utime(a, (1, 1))
+    os.utime(b, (1, 1))
+    assert format_file(a, reformat=reformat, fsync=True).status == UNCHANGED
+    assert format_file(b, reformat=reformat, fsync=True).status == REFORMATTED
+    assert os.stat(a).st_mtime == 1
+    assert os.stat(b).st_mtime != 1
+    assert read_file(tmpdir, "b.py") == "y = 2\n"
+    assert sorted(os.listdir(str(tmpdir))) == ["a.py", "b.py"]
+
+
+@pytest.mark.parametrize(
+    "out",
+    [
+        "y = <coral:<class 'Foo'> not implemented>\n",
+        "y = 3\n",
+        "y = (\n",
+    ],
+)
+def test_format_file_rejects_unsafe_output(tmpdir, out):
+    write_files(tmpdir, {"a.py": "y    =    2\n"})
+    path = os.path.join(str(tmpdir), "a.py")
+    result = format_file(path, reformat=lambda inp, **kw: out)
+    assert result.status == FAILED
+    assert "UnsafeFormatError" in result.message
+    assert read_file(tmpdir, "a.py") == "y    =    2\n"
+
+
+def test_format_file_utf8(tmpdir):
+    path = os.path.join(str(tmpdir), "a.py")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('s    =    "\u00e9"\n')
+    assert format_file(path, lang="python").status == REFORMATTED
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == 's = "\u00e9"\n'
+
+
+def _slow_format_file(path, **kwargs):
+    if path.endswith("slow.py"):
+        time.sleep(60)
+    return FileResult(path, UNCHANGED, None, None, None)
+
+
+def test_main_timeout(tmpdir, capsys, monkeypatch):
+    monkeypatch.setattr(coral.main, "format_file", _slow_format_file)
+    monkeypatch.setattr(coral.main, "_init_worker", lambda *args: None)
+    write_files(tmpdir, {"slow.py": "x = 1\n" * 10, "a.py": "y = 1\n"})
+    args = ["--timeout", "0.5", "--no-cache", "--jobs", "1", str(tmpdir)]
+    assert main(args) == 1
+    err = capsys.readouterr().err
+    path = os.path.join(str(tmpdir), "slow.py")
+    assert "error: {0} timed out after 0.5 s".format(path) in err
+    assert "0 files reformatted, 1 file left unchanged, 1 file timed out" in err
+
+
+def test_main_check_fail_fast(tmpdir, capsys):
+    write_files(tmpdir, {
+        "a.py": "x    =    42\n",
+        "b.py": "y    =    1\n",
+        "c.py": "z = 2\n",
+    })
+    assert main(["--check", "--fail-fast", "--jobs", "1", str(tmpdir)]) == 1
+    err = capsys.readouterr().err
+    assert "would reformat " + os.path.join(str(tmpdir), "a.py") in err
+    assert "b.py" not in err
+    assert "1 file would be reformatted, 0 files would be left unchanged" in err
+    with pytest.raises(SystemExit):
+        main(["--fail-fast", str(tmpdir)])
@@ -0,0 +1,83 @@
+"""Tests writing formatted files"""
+import os
+import stat
+
+import pytest
+
+from coral.output import AtomicWriter, fsync_dir, sync_files, write_atomic
+
+
+def test_write_atomic_keeps_mode(tmpdir):
+    path = str(tmpdir.join("a.py"))
+    with open(path, "w") as f:
+        f.write("x = 1\n")
+    os.chmod(path, 0o750)
+    write_atomic(path, "x = 2\n", fsync=True)
+    with open(path) as f:
+        assert f.read() == "x = 2\n"
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o750
+    assert os.listdir(str(tmpdir)) == ["a.py"]
+
+
+def test_write_atomic_follows_symlinks(tmpdir):
+    target = str(tmpdir.join("a.py"))
+    link = str(tmpdir.join("b.py"))
+    with open(target, "w") as f:
+        f.write("x = 1\n")
+    os.symlink(target, link)
+    write_atomic(link, "x = 2\n")
+    assert os.path.islink(link)
+    with open(target) as f:
+        assert f.read() == "x = 2\n"
+
+
+def test_atomic_writer_discards(tmpdir):
+    path = str(tmpdir.join("a.py"))
+    with open(path, "w") as f:
+        f.write("x = 1\n")
+    with AtomicWriter(path) as writer:
+        writer.write("x = 2\n")
+    with pytest.raises(ValueError):
+        with AtomicWriter(path) as writer:
+            writer.write("x = 3\n")
+            raise ValueError()
+    with open(path) as f:
+        assert f.read() == "x = 1\n"
+    assert os.listdir(str(tmpdir)) == ["a.py"]
+
+
+def test_sync_files(tmpdir, monkeypatch):
+    paths = [str(tmpdir.join(name)) for name in ["a.py", "b.py", "c/d.py"]]
+    tmpdir.mkdir("c")
+    for path in paths:
+        write_atomic(path, "x = 1\n")
+
+    def fail():
+        raise AssertionError("synced the whole system")
+
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "sync", fail, raising=False)
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or fsync(fd))
+    dirs = []
+    monkeypatch.setattr("coral.output.fsync_dir", dirs.append)
+    sync_files(paths)
+    assert len(synced) == 3
+    top = os.path.realpath(str(tmpdir))
+    assert dirs == [top, os.path.join(top, "c")]
+
+
+def test_atomic_writer_syncs_dir(tmpdir, monkeypatch):
+    dirs = []
+    monkeypatch.setattr("coral.output.fsync_dir", dirs.append)
+    path = str(tmpdir.join("a.py"))
+    write_atomic(path, "x = 1\n")
+    assert dirs == []
+    write_atomic(path, "x = 2\n", fsync=True)
+    assert dirs == [os.path.realpath(str(tmpdir))]
+
+
+def test_fsync_dir(tmpdir):
+    fsync_dir(str(tmpdir))
+    # directories that cannot be opened are skipped
+    fsync_dir(str(tmpdir.join("missing")))
@@ -0,0 +1,89 @@
+"""Tests formatting a single source with several processes"""
+import pytest
+
+from coral.formatter import reformat
+from coral.parallel import (
+    ParallelReformatter,
+    batch_chunks,
+    join_results,
+    reformat_parallel,
+    split_source,
+)
+
+from tools import MULTI_FUNCTION_SOURCE
+
+
+SOURCES = [
+    "x  =  1\n",
+    "x",
+    "# a comment\nx  =  1\ndef f( a ) :\n    return  a  # inline\n"
+    "    # trailing\n\ny = [1,\n 2]\nif x :\n  pass\nelse :\n  pass\nz=3\n",
+    "@dec\ndef f():\n  pass\nclass C:\n  x = 1\n# the end\n",
+    "x = 1\n" * 20 + "y  =  2\n",
+    # names defined by earlier statements are in the context
+    "ls = 1\nls -l\nx = 1\ny = 2\nls\n",
+    "echo hi\nx  =  $(pwd)\nfor i in x:\n  print( i )\nz = 1\n",
+    "while x:\n    a = 1\n# c\nz = 3\n",
+    MULTI_FUNCTION_SOURCE,
+    MULTI_FUNCTION_SOURCE * 8,
+]
+
+
+@pytest.fixture(scope="module")
+def reformatter():
+    with ParallelReformatter(jobs=2) as r:
+        yield r
+
+
+@pytest.mark.parametrize("inp", SOURCES)
+@pytest.mark.parametrize("lang", ["xonsh", "auto", "python"])
+def test_parallel_reformat(reformatter, inp, lang):
+    if lang == "python" and ("echo" in inp or "ls -l" in inp):
+        pytest.skip("xonsh code")
+    assert reformatter.reformat(inp, lang=lang) == reformat(inp, lang=lang)
+
+
+def test_parallel_reformat_while(reformatter):
+    inp = "x = 1\n" * 4 + "while x:\n    a  =  1\n# c\nz = 3\n"
+    exp = "x = 1\n" * 4 + "while x:\n    a = 1\n\n# c\nz = 3\n"
+    assert reformatter.reformat(inp) == exp
+
+
+@pytest.mark.parametrize("lang", ["xonsh", "auto", "python"])
+def test_parallel_reformat_unterminated(reformatter, lang):
+    inp = "x  =  1\ny  =  2"
+    if lang == "python":
+        assert reformatter.reformat(inp, lang=lang) == "x = 1\ny = 2\n"
+    else:
+        # the xonsh parser reads unterminated code as an expression
+        with pytest.raises(SyntaxError):
+            reformatter.reformat(inp, lang=lang)
+        with pytest.raises(SyntaxError):
+            reformat(inp, lang=lang)
+
+
+def test_parallel_reformat_error(reformatter):
+    # the first statement takes long to fail, and the others fail at once
+    # with another error, which is not the one that serial formatting raises
+    inp = "x = " + " + ".join(["a"] * 5000) + " % b\n" + "f(**k)\n" * 1000
+    with pytest.raises(KeyError):
+        reformatter.reformat(inp, lang="python")
+
+
+def test_reformat_parallel():
+    inp = MULTI_FUNCTION_SOURCE
+    assert reformat_parallel(inp, jobs=2) == reformat(inp)
+
+
+def test_batch_chunks():
+    chunks = split_source("a = 1\nb = 2\nc = 3\nd = 4\n")
+    assert chunks == ["a = 1\n", "b = 2\n", "c = 3\n", "d = 4\n"]
+    assert batch_chunks(chunks, 2) == [chunks[:2], chunks[2:]]
+    assert batch_chunks(chunks, 8) == [[chunk] for chunk in chunks]
+    assert batch_chunks(["x" * 10, "y", "z"], 3) == [["x" * 10], ["y", "z"]]
+
+
+def test_join_results():
+    assert join_results(["a = 1", "def f():\n    pass\n", "", "b = 2"]) == (
+        "a = 1\ndef f():\n    pass\n\nb = 2\n"
+    )
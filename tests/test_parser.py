@@ -1,7 +1,14 @@
 """Tests coral parser"""
+import io
+import os
 import ast
+import copy
+import time
+import inspect
+import pickle
 from textwrap import dedent
 from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
@@ -23,7 +30,25 @@ from xonsh.ast import (
     Str,
 )
 
-from coral.parser import Comment, NodeWithComment, IfWithComments, parse, add_comments
+from coral.parser import (
+    Comment,
+    CommentStore,
+    NodeWithComment,
+    IfWithComments,
+    parse,
+    add_comments,
+    merge_body_comments,
+    logical_line_starts,
+    module_names,
+    top_level_chunks,
+    top_level_starts,
+    thread_execer,
+    make_execer,
+    load_table,
+    read_table,
+    write_table,
+    Parser,
+)
 
 from tools import nodes_equal
 
@@ -53,6 +78,220 @@ def test_parse_inline_comment():
     assert comments == [Comment(s="# I'm a comment", lineno=1, col_offset=6)]
 
 
+def test_parse_failure_restores_state():
+    execer = thread_execer()
+    with pytest.raises(SyntaxError):
+        parse("def (:  # bad\n", debug_level=1)
+    assert execer.debug_level == 0
+    tree, comments, lines = parse("True  # good\n")
+    assert comments == [Comment(s="# good", lineno=1, col_offset=6)]
+
+
+def test_parse_threaded():
+    def check(i):
+        stmt = "x = {0}  ".format(i)
+        code = stmt + "# comment {0}\n# trailing {0}\n".format(i)
+        tree, comments, lines = parse(code)
+        assert comments == [
+            Comment(s="# comment {0}".format(i), lineno=1, col_offset=len(stmt)),
+            Comment(s="# trailing {0}".format(i), lineno=2, col_offset=0),
+        ]
+        assert tree.body[0].value.n == i
+        return thread_execer()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        execers = list(pool.map(check, range(200)))
+    assert thread_execer() not in execers
+
+
+@pytest.mark.parametrize("lang", ["python", "auto"])
+def test_parse_lang_only_comment(lang):
+    tree, comments, lines = parse("# I'm a comment\n", lang=lang)
+    assert tree is None
+    assert comments == [Comment(s="# I'm a comment", lineno=1, col_offset=0)]
+    assert lines == {1: "# I'm a comment\n"}
+
+
+@pytest.mark.parametrize("lang", ["python", "auto"])
+def test_parse_lang_inline_comment(lang):
+    code = "def f(x):\n    return x  # I'm a comment\n"
+    exp_tree, exp_comments, exp_lines = parse(code)
+    tree, comments, lines = parse(code, lang=lang)
+    assert nodes_equal(tree, exp_tree)
+    assert comments == exp_comments
+    assert lines == exp_lines
+
+
+def test_parse_lang_auto_falls_back():
+    tree, comments, lines = parse("x = $(ls)  # subproc\n", lang="auto")
+    assert isinstance(tree.body[0], Assign)
+    assert comments == [Comment(s="# subproc", lineno=1, col_offset=11)]
+    with pytest.raises(SyntaxError):
+        parse("x = $(ls)\n", lang="python")
+
+
+def test_parse_lang_invalid():
+    with pytest.raises(ValueError):
+        parse("x = 1\n", lang="cobol")
+
+
+#
+# parser table tests
+#
+
+
+def test_table_roundtrip(tmpdir):
+    table = load_table()
+    filename = os.path.join(str(tmpdir), "parser_table.pickle")
+    write_table(table, filename)
+    obs = read_table(filename)
+    assert obs._lr_signature == table._lr_signature
+    assert obs._lr_action == table._lr_action
+
+
+def test_read_table_rejects_other_versions(tmpdir, monkeypatch):
+    filename = os.path.join(str(tmpdir), "parser_table.pickle")
+    write_table(load_table(), filename)
+    monkeypatch.setattr("coral.parser.table_key", lambda: "other")
+    assert read_table(filename) is None
+    assert read_table(os.path.join(str(tmpdir), "missing.pickle")) is None
+
+
+def test_parser_uses_table():
+    parser = Parser()
+    tree = parser.parse("x = 42\n")
+    assert tree.body[0].value.n == 42
+
+
+#
+# comment storage tests
+#
+
+
+def test_comment_store():
+    source = "x = 1  # one\n# two\nif x:\n    pass\n"
+    store = CommentStore(source)
+    store.append("# one", 1, 7)
+    store.append("# two", 2, 0)
+    # not found verbatim in the source
+    store.append("# three", 2, 0)
+    assert len(store) == 3
+    assert store[0] == Comment(s="# one", lineno=1, col_offset=7)
+    assert store[-1] == Comment(s="# three", lineno=2, col_offset=0)
+    assert store[1:] == [
+        Comment(s="# two", lineno=2, col_offset=0),
+        Comment(s="# three", lineno=2, col_offset=0),
+    ]
+    assert store == list(store)
+    assert store.extra == ["# three"]
+    lines = store.lines()
+    assert lines == {1: "x = 1  # one\n", 2: "# two\n"}
+    assert lines.get(3, "") == ""
+
+
+def test_comment_store_without_source():
+    store = CommentStore()
+    store.append("# one", 1, 7, "x = 1  # one\n")
+    assert store == [Comment(s="# one", lineno=1, col_offset=7)]
+    assert store.lines() == {1: "x = 1  # one\n"}
+
+
+def test_comment_nodes_have_slots():
+    comment = Comment(s="# c", lineno=1, col_offset=0)
+    node = IfWithComments(
+        node=Comment(s="# n", lineno=1, col_offset=0),
+        comment=comment,
+        elsecomment=None,
+        lineno=1,
+        col_offset=0,
+    )
+    assert node == copy.deepcopy(node)
+    assert pickle.loads(pickle.dumps(node)) == node
+    with pytest.raises(AttributeError):
+        NodeWithComment(node=None, comment=comment).lineno
+
+
+#
+# statement chunk tests
+#
+
+
+def test_top_level_starts():
+    code = (
+        "x = (1,\n"
+        "  2)\n"
+        'y = """\n'
+        "z = 1\n"
+        '"""\n'
+        "@d\n"
+        "@e(1,\n"
+        " 2)\n"
+        "def f():\n"
+        "    pass\n"
+        "else_ = 1\n"
+        "if x:\n"
+        "  a\n"
+        "else:\n"
+        "  b\n"
+        "# c\n"
+        "w = 'a#' \\\n"
+        "  + 'b'\n"
+    )
+    assert logical_line_starts(code) == [1, 3, 6, 7, 9, 10, 11, 12, 13, 14, 15, 16, 17, 19]
+    assert top_level_starts(code) == [1, 3, 6, 11, 12, 17]
+
+
+def test_top_level_chunks():
+    code = (
+        "# c\n"
+        "x = (1,\n"
+        "  2)\n"
+        "@d\n"
+        "def f():\n"
+        "    pass\n"
+        "    # in f\n"
+        "if x:\n"
+        "  a\n"
+        "else:\n"
+        "  b\n"
+        "ls -l $(pwd)\n"
+        "y = 1"
+    )
+    obs = list(top_level_chunks(io.StringIO(code).readline))
+    assert obs == [
+        "# c\nx = (1,\n  2)\n",
+        "@d\ndef f():\n    pass\n    # in f\n",
+        "if x:\n  a\nelse:\n  b\n",
+        "ls -l $(pwd)\n",
+        "y = 1",
+    ]
+    assert list(top_level_chunks(io.StringIO("").readline)) == []
+    # code that the tokenizer cannot read is kept in one chunk
+    code = "x = 1\ny = (2,\n"
+    obs = list(top_level_chunks(io.StringIO(code).readline))
+    assert obs == ["x = 1\n", "y = (2,\n"]
+
+
+def test_module_names():
+    code = (
+        "import os.path, sys as system\n"
+        "from a import b\n"
+        "x, (y, z) = 1, (2, 3)\n"
+        "for i in range(3):\n"
+        "    j = i\n"
+        "def f(arg):\n"
+        "    local = 1\n"
+        "    global g\n"
+        "class C:\n"
+        "    attr = 1\n"
+        "del x\n"
+    )
+    names = module_names(code, ctx=set())
+    # as in xonsh, only the leftmost name of a nested target is added
+    assert names == {"os.path", "system", "b", "y", "i", "j", "f", "g", "C"}
+    assert "print" in module_names("")
+
+
 #
 # add_comments() tests
 #
@@ -70,6 +309,24 @@ def check_add_comments(code, exp_tree, debug_level=0):
     return tree
 
 
+def test_make_execer_attributes():
+    # make_execer() sets the attributes of an execer itself, since
+    # Execer.__init__() loads the xonsh builtins
+    from xonsh.execer import Execer
+
+    tree = ast.parse(dedent(inspect.getsource(Execer.__init__)))
+    exp = {
+        target.attr
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Assign)
+        for target in node.targets
+        if isinstance(target, ast.Attribute)
+        and isinstance(target.value, ast.Name)
+        and target.value.id == "self"
+    }
+    assert set(vars(make_execer())) == exp
+
+
 def test_add_only_comment():
     code = "# I'm a comment\n"
     exp = Module(body=[Comment(s="# I'm a comment", lineno=1, col_offset=0)])
@@ -216,6 +473,17 @@ def test_add_inline_comment_class():
     check_add_comments(code, exp)
 
 
+def test_add_comments_stop_at_next_statement():
+    # an indented comment after the next statement does not trail the
+    # function, so that each top-level statement gets the same comments
+    # whether it is parsed alone or with the rest of the code
+    code = "def f():\n    pass\nx = 1\n    # c\n"
+    tree, comments, lines = parse(code)
+    tree = add_comments(tree, comments, lines)
+    assert [type(node) for node in tree.body] == [FunctionDef, Assign, Comment]
+    assert len(tree.body[0].body) == 1
+
+
 def test_add_inline_comment_if_else():
     code = """
     # comment 1
@@ -449,3 +717,49 @@ def test_add_inline_comment_elif():
         ]
     )
     check_add_comments(code, exp)
+
+
+#
+# scaling tests
+#
+
+
+def test_merge_body_comments():
+    body = [
+        Expr(value=Name(id="x", ctx=ast.Load()), lineno=i, col_offset=0)
+        for i in (2, 3, 6)
+    ]
+    comments = [Comment(s="# c", lineno=i, col_offset=0) for i in (1, 4, 5, 7)]
+    merge_body_comments(body, comments)
+    assert [n.lineno for n in body] == [1, 2, 3, 4, 5, 6, 7]
+    assert comments == []
+
+
+def make_commented_module(n):
+    """Makes a module of n statements, each preceded by a comment line."""
+    body = []
+    comments = []
+    for i in range(n):
+        comments.append(Comment(s="# comment", lineno=2 * i + 1, col_offset=0))
+        value = Name(id="x", ctx=ast.Load())
+        body.append(Expr(value=value, lineno=2 * i + 2, col_offset=0))
+    return Module(body=body), comments
+
+
+def time_add_comments(n, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        tree, comments = make_commented_module(n)
+        t0 = time.perf_counter()
+        tree = add_comments(tree, comments, {})
+        best = min(best, time.perf_counter() - t0)
+    assert len(tree.body) == 2 * n
+    return best
+
+
+def test_add_comments_scales_linearly():
+    small = time_add_comments(1000, repeat=5)
+    large = time_add_comments(100000, repeat=1)
+    # 100x the comments should take roughly 100x the time, a quadratic
+    # algorithm would take 10000x
+    assert large < 1000 * small
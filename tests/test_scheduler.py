@@ -0,0 +1,65 @@
+"""Tests the scheduling of batch runs"""
+import os
+import time
+
+from coral.scheduler import (
+    Scheduler,
+    WorkerError,
+    WorkerTimeout,
+    largest_first,
+)
+
+
+def square(x):
+    return x * x
+
+
+def sleepy(x):
+    if x < 0:
+        time.sleep(60)
+    return x
+
+
+def crashy(x):
+    if x < 0:
+        os._exit(3)
+    if x == 0:
+        raise ValueError("zero")
+    return x
+
+
+def test_largest_first(tmpdir):
+    sizes = {"a": 1, "b": 30, "c": 2, "d": 30}
+    for name, size in sizes.items():
+        tmpdir.join(name).write("x" * size)
+    paths = [str(tmpdir.join(name)) for name in "abcd"] + ["missing"]
+    ordered = [os.path.basename(p) for p in largest_first(paths)]
+    assert ordered == ["b", "d", "c", "a", "missing"]
+
+
+def test_scheduler_imap():
+    with Scheduler(square, jobs=2) as scheduler:
+        results = list(scheduler.imap(range(10)))
+    assert sorted(r.item for r in results) == list(range(10))
+    assert all(r.ok and r.value == r.item * r.item for r in results)
+
+
+def test_scheduler_timeout():
+    t0 = time.monotonic()
+    with Scheduler(sleepy, jobs=2, timeout=0.5) as scheduler:
+        results = {r.item: r for r in scheduler.imap([-1, 1, 2, -2, 3])}
+        assert len(scheduler.workers) <= 2
+    assert time.monotonic() - t0 < 30
+    assert set(results) == {-1, 1, 2, -2, 3}
+    assert isinstance(results[-1].error, WorkerTimeout)
+    assert isinstance(results[-2].error, WorkerTimeout)
+    assert [results[i].value for i in (1, 2, 3)] == [1, 2, 3]
+
+
+def test_scheduler_lost_worker():
+    with Scheduler(crashy, jobs=1) as scheduler:
+        results = {r.item: r for r in scheduler.imap([-1, 0, 1])}
+    assert type(results[-1].error) is WorkerError
+    assert "exit code 3" in str(results[-1].error)
+    assert isinstance(results[0].error, ValueError)
+    assert results[1].value == 1
@@ -0,0 +1,104 @@
+"""Tests coral sessions"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from coral.cache import Cache, content_hash
+from coral.formatter import reformat
+from coral.session import CoralSession, ReformatResult
+from coral.stats import ReformatStats
+
+
+SOURCES = [
+    "x    =    42\n",
+    "def f( a ) :  # a function\n    return  a\n",
+    "# only a comment\n",
+    "ls -l\n",
+    "x = $HOME\n",
+]
+
+
+@pytest.mark.parametrize("lang", ["xonsh", "auto"])
+def test_reformat_many(lang):
+    session = CoralSession(lang=lang)
+    obs = list(session.reformat_many(SOURCES))
+    exp = [ReformatResult(reformat(s), None) for s in SOURCES]
+    assert obs == exp
+    assert all(r.ok for r in obs)
+
+
+def test_reformat_many_isolates_errors():
+    session = CoralSession()
+    obs = list(session.reformat_many(["x = 1\n", "def (:\n", "y  =  2\n"]))
+    assert obs[0] == ReformatResult("x = 1\n", None)
+    assert not obs[1].ok
+    assert isinstance(obs[1].error, SyntaxError)
+    assert obs[2] == ReformatResult("y = 2\n", None)
+
+
+def test_reformat_remembers_results(monkeypatch):
+    session = CoralSession(maxsize=1)
+    assert session.reformat("x  =  1\n") == "x = 1\n"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("remembered source was parsed")
+
+    monkeypatch.setattr(session, "parse", fail)
+    assert session.reformat("x  =  1\n") == "x = 1\n"
+    with pytest.raises(AssertionError):
+        session.reformat("y  =  2\n")
+
+
+def test_reformat_stats():
+    session = CoralSession()
+    stats = ReformatStats()
+    assert session.reformat(SOURCES[1], stats=stats) == reformat(SOURCES[1])
+    assert stats.comments == 1
+    assert stats.total > 0.0
+
+
+def test_session_cache(tmpdir):
+    filename = os.path.join(str(tmpdir), "cache.txt")
+    with CoralSession(cache=Cache(filename)) as session:
+        assert session.reformat("x  =  1\n") == "x = 1\n"
+    # outputs are only cached once they are found to be unchanged
+    assert content_hash("x = 1\n") not in Cache(filename)
+    with CoralSession(cache=Cache(filename)) as session:
+        assert session.reformat("x = 1\n") == "x = 1\n"
+    cache = Cache(filename)
+    assert content_hash("x = 1\n") in cache
+    assert content_hash("x  =  1\n") not in cache
+
+
+def test_session_is_formatted(tmpdir, monkeypatch):
+    filename = os.path.join(str(tmpdir), "cache.txt")
+    session = CoralSession(cache=Cache(filename))
+    assert not session.is_formatted("x  =  1\n")
+    assert session.is_formatted("x = 1\n")
+    assert content_hash("x = 1\n") in session.cache
+    assert content_hash("x  =  1\n") not in session.cache
+
+    def fail(*args, **kwargs):
+        raise AssertionError("formatted source was parsed")
+
+    monkeypatch.setattr(session, "parse", fail)
+    assert session.is_formatted("x = 1\n")
+
+
+def test_session_recovers_from_failed_format():
+    session = CoralSession()
+    session.formatter.inc_indent()
+    assert session.reformat("if x:\n  pass\n") == "if x:\n    pass\n"
+
+
+def test_sessions_threaded():
+    def check(i):
+        session = CoralSession()
+        sources = ["x{0} = {1}\n".format(i, j) for j in range(20)]
+        assert [r.output for r in session.reformat_many(sources)] == sources
+        return session.execer
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        execers = list(pool.map(check, range(8)))
+    assert len(set(map(id, execers))) == 8
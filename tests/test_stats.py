@@ -0,0 +1,88 @@
+"""Tests coral instrumentation"""
+import os
+import ast
+import json
+import pstats
+
+from coral.formatter import Formatter, reformat
+from coral.stats import STAGES, ProfileReport, ReformatStats, VisitStats
+
+
+SOURCE = "# a comment\nx    =    42\ndef f( a ) :\n    return  a  # inline\n"
+
+
+def test_reformat_stats():
+    stats = ReformatStats()
+    assert reformat(SOURCE, stats=stats) == reformat(SOURCE)
+    assert set(stats.times) == set(STAGES)
+    assert all(t >= 0.0 for t in stats.times.values())
+    assert stats.total == sum(stats.times.values())
+    assert stats.lines == 4
+    assert stats.comments == 2
+    assert stats.nodes > 5
+    assert stats.profiles is None
+
+
+def test_reformat_profile():
+    stats = ReformatStats(profile=True)
+    reformat(SOURCE, stats=stats)
+    assert set(stats.profiles) == set(STAGES)
+
+
+def test_profile_report(tmpdir):
+    report = ProfileReport()
+    for name in ["a.py", "b.py"]:
+        stats = ReformatStats(profile=True)
+        reformat(SOURCE, stats=stats)
+        report.add(name, stats)
+    assert report.lines == 8
+    assert report.comments == 4
+    assert [p for p, _ in report.slowest(1)] in (["a.py"], ["b.py"])
+    s = report.format()
+    assert "profiled 2 files" in s
+    assert "slowest files:" in s
+    filenames = report.dump(str(tmpdir))
+    assert sorted(os.path.basename(f) for f in filenames) == sorted(
+        stage + ".pstats" for stage in STAGES
+    )
+    assert pstats.Stats(filenames[0]).total_calls > 0
+
+
+def test_visit_stats():
+    # without inline comments, which are not formatted yet, so that the names
+    # in the function are visited too
+    source = "x    =    42\ndef f( a ) :\n    return  a\n"
+    stats = ReformatStats(visits=True)
+    assert reformat(source, stats=stats) == reformat(source)
+    visits = stats.visits
+    assert visits.entries["FunctionDef"][0] == 1
+    assert visits.entries["Name"][0] == 2
+    assert visits.fallbacks == 0
+    assert visits.visits == sum(e[0] for e in visits.entries.values())
+    assert visits.time >= 0.0
+    d = json.loads(json.dumps(stats.as_dict()))
+    assert d["visits"]["nodes"]["FunctionDef"]["visits"] == 1
+
+
+def test_visit_stats_fallbacks():
+    class Unknown(ast.expr):
+        pass
+
+    visits = VisitStats()
+    node = ast.Expr(value=ast.List(elts=[Unknown(), Unknown()], ctx=ast.Load()))
+    s = Formatter(visits=visits).visit(node)
+    assert "not implemented" in s
+    assert visits.entries["Unknown"] == [2, visits.entries["Unknown"][1], 2]
+    assert visits.entries["List"][2] == 0
+    assert visits.fallbacks == 2
+    assert "Unknown" in visits.format()
+
+
+def test_profile_report_visits():
+    report = ProfileReport()
+    for name in ["a.py", "b.py"]:
+        stats = ReformatStats(visits=True)
+        reformat(SOURCE, stats=stats)
+        report.add(name, stats)
+    assert report.visits.entries["FunctionDef"][0] == 2
+    assert "visited" in report.format()
@@ -0,0 +1,49 @@
+"""Tests coral visitor dispatch"""
+import ast
+
+from coral.formatter import Formatter, format
+from coral.parser import CommentAdder
+from coral.visitor import DispatchVisitor, dispatch_table
+
+
+class Names(DispatchVisitor, ast.NodeVisitor):
+    def generic_visit(self, node):
+        return "generic"
+
+    def visit_Name(self, node):
+        return node.id
+
+
+class UpperNames(Names):
+    def visit_Name(self, node):
+        return node.id.upper()
+
+
+def test_dispatch_table_is_per_class():
+    node = ast.Name(id="x", ctx=ast.Load())
+    assert Names().visit(node) == "x"
+    assert UpperNames().visit(node) == "X"
+    assert Names().visit(ast.Pass()) == "generic"
+    assert dispatch_table(Names) is not dispatch_table(UpperNames)
+    assert dispatch_table(Names)[ast.Name] is Names.visit_Name
+    assert dispatch_table(Names)[ast.Pass] is Names.generic_visit
+    assert Names().handlers is dispatch_table(Names)
+
+
+def test_dispatch_table_is_shared():
+    assert Formatter().handlers is Formatter().handlers
+    assert CommentAdder([]).handlers is CommentAdder([]).handlers
+    assert Formatter().handlers is not CommentAdder([]).handlers
+
+
+def test_formatter_subclass_override():
+    class Renamer(Formatter):
+        def visit_Name(self, node):
+            return "renamed_" + node.id
+
+    tree = ast.parse("x = y + 1\n")
+    formatter = Renamer()
+    formatter.reset()
+    formatter.emit(tree)
+    assert "".join(formatter.chunks) == "renamed_x = renamed_y + 1\n"
+    assert format(tree) == "x = y + 1\n"
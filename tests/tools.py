@@ -1,38 +1,105 @@
 """Some test tool helpers"""
 import ast
+import builtins
 from itertools import zip_longest
 
 
 def nodes_equal(x, y, check_attributes=True):
+    """Asserts that two trees are equal. This walks the trees with an explicit
+    stack, so that arbitrarily deep trees may be compared.
+    """
     __tracebackhide__ = True
-    assert type(x) == type(y), "Ast nodes do not have the same type: '%s' != '%s'" % (
-        type(x),
-        type(y),
-    )
-    if x is None and y is None:
-        return True
-    if check_attributes and isinstance(x, (ast.Expr, ast.FunctionDef, ast.ClassDef)):
-        assert (
-            x.lineno == y.lineno
-        ), "Ast nodes do not have the same line number : %s != %s" % (
-            x.lineno,
-            y.lineno,
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        assert type(x) == type(y), "Ast nodes do not have the same type: '%s' != '%s'" % (
+            type(x),
+            type(y),
         )
-        assert x.col_offset == y.col_offset, (
-            "Ast nodes do not have the same column offset number : %s != %s"
-            % (x.col_offset, y.col_offset)
-        )
-    for (xname, xval), (yname, yval) in zip(ast.iter_fields(x), ast.iter_fields(y)):
-        assert xname == yname, (
-            "Ast nodes fields differ : %s (of type %s) != %s (of type %s)"
-            % (xname, type(xval), yname, type(yval))
-        )
-        assert type(xval) == type(yval), (
-            "Ast nodes fields differ : %s (of type %s) != %s (of type %s)"
-            % (xname, type(xval), yname, type(yval))
-        )
-    for xchild, ychild in zip_longest(ast.iter_child_nodes(x), ast.iter_child_nodes(y)):
-        assert xchild is not None, "AST node has fewer childern"
-        assert ychild is not None, "AST node has more childern"
-        assert nodes_equal(xchild, ychild, check_attributes=check_attributes), "Ast node children differs"
+        if x is None and y is None:
+            continue
+        if check_attributes and isinstance(x, (ast.Expr, ast.FunctionDef, ast.ClassDef)):
+            assert (
+                x.lineno == y.lineno
+            ), "Ast nodes do not have the same line number : %s != %s" % (
+                x.lineno,
+                y.lineno,
+            )
+            assert x.col_offset == y.col_offset, (
+                "Ast nodes do not have the same column offset number : %s != %s"
+                % (x.col_offset, y.col_offset)
+            )
+        for (xname, xval), (yname, yval) in zip(ast.iter_fields(x), ast.iter_fields(y)):
+            assert xname == yname, (
+                "Ast nodes fields differ : %s (of type %s) != %s (of type %s)"
+                % (xname, type(xval), yname, type(yval))
+            )
+            assert type(xval) == type(yval), (
+                "Ast nodes fields differ : %s (of type %s) != %s (of type %s)"
+                % (xname, type(xval), yname, type(yval))
+            )
+        children = []
+        for xchild, ychild in zip_longest(ast.iter_child_nodes(x), ast.iter_child_nodes(y)):
+            assert xchild is not None, "AST node has fewer childern"
+            assert ychild is not None, "AST node has more childern"
+            children.append((xchild, ychild))
+        # visit the children in order, as the recursive comparison did
+        stack.extend(reversed(children))
     return True
+
+
+def xonsh_session():
+    """Returns the xonsh session, starting up a headless one the first time
+    this is called, for running xonsh code in tests. Parsing does not need
+    a session.
+    """
+    if not hasattr(builtins, "__xonsh__"):
+        from xonsh.main import setup
+
+        setup()
+    return builtins.__xonsh__
+
+
+# a module of several functions, with comments in the places that they are
+# attached to statements by
+MULTI_FUNCTION_SOURCE = '''"""A module."""
+x  =  1  # inline on a top-level line
+
+# a comment before a function
+def f( a ) :
+    """Docstring."""
+    b  =  a  # inline in a body
+    if b :
+        return  b
+        # trailing the if body
+    else :
+        pass
+    # trailing the if, indented
+    return  a
+    # trailing the function, indented
+
+# between functions
+@dec
+@dec2( 1 )
+def g( * args , ** kwargs ) :
+    for i in args :
+        print( i )
+    # trailing the loop
+    return  kwargs
+
+
+class C( object ) :
+    y  =  1  # inline in a class
+
+    def m( self ) :
+        return  self.y
+        # trailing a method
+
+    # trailing the class, indented
+y  =  [ 1 ,
+  2 ]  # inline after a bracket
+def h():
+    pass
+    # trailing the last function
+# the end
+'''